@@ -1,9 +1,10 @@
 """
 this script starts docker containers for
-    1. producers: 1 producer per active seismic device
+    1. producers: active seismic devices sharded across N producer processes
     2. output stream consumers: output accelerations and warning accelelrations
 """
 
+import sys
 from openeew.data.aws import AwsDataClient
 from subprocess import Popen
 from configparser import ConfigParser
@@ -13,6 +14,8 @@ config.read_file(open('kinesis.cfg'))
 OUTPUT_ACCEL_STREAM = config.get('KINESIS', 'output_accel_stream')
 OUTPUT_WARNING_STREAM = config.get('KINESIS', 'output_warning_stream')
 
+PRODUCER_PROCESSES = 8
+
 
 def get_active_devices(date_utc : str) -> list:
     """ get active seismic devices """
@@ -25,7 +28,16 @@ def get_active_devices(date_utc : str) -> list:
     return active
 
 
+def shard_devices(devices: list, processes: int) -> list:
+    """ split devices round-robin into at most N non-empty shards, 1 shard per producer process """
+    shards = [devices[i::processes] for i in range(processes)]
+    return [shard for shard in shards if shard]
+
+
 def main():
+    # number of producer processes can be passed as the only argument
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else PRODUCER_PROCESSES
+
     # setup dockers for consumers of 2 output streams
     stream_names = [OUTPUT_WARNING_STREAM, OUTPUT_ACCEL_STREAM]
     for stream in stream_names:
@@ -37,9 +49,9 @@ def main():
     date_utc = '2020-01-05 00:00:01'
     active = get_active_devices(date_utc)
 
-    for device in active:
-        cmd = ['docker-compose', 'run', '-e', 'DEVICE={}'.format(device), 'seismic-service']
-        with open("/tmp/output{}.log".format(device), "a") as output:
+    for i, shard in enumerate(shard_devices(active, processes)):
+        cmd = ['docker-compose', 'run', '-e', 'DEVICE={}'.format(','.join(shard)), 'seismic-service']
+        with open("/tmp/output-producer{}.log".format(i), "a") as output:
             process = Popen(cmd, stdout=output, stderr=output)
 
         #     subprocess.call("docker-compose run -e DEVICE={}  seismic-service".format(device),
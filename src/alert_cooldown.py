@@ -0,0 +1,89 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+# seconds a device stays silent after it was part of a published alert
+ALERT_COOLDOWN = 600
+ALERT_COOLDOWN_MAX_DEVICES = 100000
+
+
+class AlertCooldown:
+    def __init__(self,
+                 cooldown: float = ALERT_COOLDOWN,
+                 max_devices: int = ALERT_COOLDOWN_MAX_DEVICES,  # memory cap, oldest alerts are evicted first
+                 path: str = None):                              # local file keeping the state across restarts
+        """ devices that alerted recently, keyed by device id for O(1) lookups,
+            entries expire cooldown seconds after their alert, times are warning times in epoch seconds
+        """
+        self._cooldown = cooldown
+        self._max_devices = max_devices
+        self._path = path
+        self._lock = threading.Lock()
+
+        # device id -> time of its last alert, oldest alert first
+        self._alerted = OrderedDict()
+        self._now = 0.0
+        if path:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._alerted)
+
+    def active(self, device_id: str, time: float) -> bool:
+        """ True while the device is cooling down from an alert before time """
+        alerted = self._alerted.get(device_id)
+        return alerted is not None and 0 <= time - alerted < self._cooldown
+
+    def add(self, device_id: str, time: float):
+        with self._lock:
+            self._alerted.pop(device_id, None)
+            self._alerted[device_id] = time
+            self._now = max(self._now, time)
+            self._evict()
+
+    def _evict(self):
+        """ drop expired alerts from the oldest end, then whatever is above the memory cap """
+        while self._alerted:
+            device_id, alerted = next(iter(self._alerted.items()))
+            if self._now - alerted < self._cooldown and len(self._alerted) <= self._max_devices:
+                break
+            del self._alerted[device_id]
+
+    def load(self):
+        """ read the state saved by an earlier run, a missing or broken file starts empty """
+        try:
+            with open(self._path) as f:
+                alerted = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f'Error reading alert cooldown state {self._path}: {e}')
+            return
+
+        with self._lock:
+            for device_id, time in sorted(alerted.items(), key=lambda item: item[1]):
+                self._alerted[device_id] = time
+                self._now = max(self._now, time)
+            self._evict()
+        logging.info(f'Loaded {len(self._alerted)} devices in alert cooldown from {self._path}')
+
+    def save(self):
+        """ write the state to the local file, readers never see a partial file """
+        if not self._path:
+            return
+        with self._lock:
+            alerted = dict(self._alerted)
+        tmp_path = f'{self._path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(alerted, f)
+            os.replace(tmp_path, self._path)
+        except OSError as e:
+            logging.error(f'Error saving alert cooldown state {self._path}: {e}')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
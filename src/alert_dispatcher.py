@@ -0,0 +1,157 @@
+import logging
+import threading
+from time import time, sleep, monotonic
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import metrics
+
+ALERT_LATENCY = metrics.histogram('eew_alert_latency_seconds',
+                                  'Seconds from the warning window start to the last acknowledged publish',
+                                  buckets=metrics.ALERT_LATENCY_BUCKETS)
+PUBLISH_SECONDS = metrics.histogram('eew_alert_publish_seconds', 'Seconds to publish all messages of 1 alert')
+PUBLISHES = metrics.counter('eew_alert_publishes', 'SNS publish calls of alerts', ['result'])
+
+
+def percentiles(latencies: deque) -> dict:
+    """ p50, p99 and max of latencies in seconds, empty without latencies """
+    if not latencies:
+        return {}
+    p50, p99 = np.percentile(np.array(latencies), [50, 99])
+    return {'p50': round(float(p50), 3), 'p99': round(float(p99), 3), 'max': round(max(latencies), 3)}
+
+
+class StubSnsClient:
+    def __init__(self, publish_delay: float = 0.0):
+        """ in-process stand-in for the SNS calls of the dispatcher, publishes are kept in memory """
+        self._publish_delay = publish_delay
+        self._lock = threading.Lock()
+        self.subscriptions = []
+        self.messages = []
+
+    def create_topic(self, Name: str) -> dict:
+        return {'TopicArn': f'arn:aws:sns:local:000000000000:{Name}'}
+
+    def subscribe(self, TopicArn: str, Protocol: str, Endpoint: str) -> dict:
+        with self._lock:
+            self.subscriptions.append({'TopicArn': TopicArn, 'Protocol': Protocol, 'Endpoint': Endpoint})
+        return {'SubscriptionArn': f'{TopicArn}:{len(self.subscriptions)}'}
+
+    def list_subscriptions_by_topic(self, TopicArn: str, **kwargs) -> dict:
+        with self._lock:
+            return {'Subscriptions': [subscription for subscription in self.subscriptions
+                                      if subscription['TopicArn'] == TopicArn]}
+
+    def publish(self, TopicArn: str, Message: str) -> dict:
+        if self._publish_delay:
+            sleep(self._publish_delay)
+        with self._lock:
+            self.messages.append(Message)
+            return {'MessageId': str(len(self.messages))}
+
+
+class AlertDispatcher:
+    def __init__(self,
+                 sns_client,
+                 topic_name: str = 'notifications',
+                 numbers: list = (),   # phone numbers subscribed by SMS
+                 emails: list = (),    # email addresses subscribed by email
+                 max_workers: int = 4,
+                 latency_samples: int = 1000,
+                 ready_timeout: float = 10.0):  # seconds alerts wait for the topic after start, then are dropped
+        """ publish the messages of an alert concurrently and measure how long it took,
+            the topic and subscriptions are set up once in the background, only missing subscriptions are added,
+            alerts are published once both are set up
+        """
+        self._sns_client = sns_client
+        self._subscribers = [('sms', number) for number in numbers if number] + \
+                            [('email', email) for email in emails if email]
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='sns-publish')
+        self._topic_name = topic_name
+        self._topic_arn = None
+        self._ready = threading.Event()
+        self._ready_timeout = ready_timeout
+        self._ready_deadline = monotonic() + ready_timeout
+
+        # seconds from the warning window start to the last publish acknowledgement, and of the publish calls alone
+        self._alert_latencies = deque(maxlen=latency_samples)
+        self._publish_latencies = deque(maxlen=latency_samples)
+        self.stats = {'alerts': 0, 'publishes': 0, 'errors': 0, 'dropped': 0}
+
+    def start(self, retry_interval: float = 5.0):
+        self._ready_deadline = monotonic() + self._ready_timeout
+        threading.Thread(target=self._setup, args=(retry_interval,), name='sns-setup', daemon=True).start()
+
+    def _setup(self, retry_interval: float):
+        """ create the topic and subscribe, retried until both succeed, alerts are published once they have """
+        while True:
+            try:
+                if self._topic_arn is None:
+                    # Create the topic if it doesn't exist (this is idempotent)
+                    self._topic_arn = self._sns_client.create_topic(Name=self._topic_name)['TopicArn']
+                self._subscribe()
+                break
+            except Exception as generic:
+                logging.error(f'Error setting up SNS topic {self._topic_name}, retrying: {generic}')
+                sleep(retry_interval)
+        self._ready.set()
+
+    def _existing_subscriptions(self) -> set:
+        existing = set()
+        kwargs = {'TopicArn': self._topic_arn}
+        while True:
+            response = self._sns_client.list_subscriptions_by_topic(**kwargs)
+            existing.update((subscription['Protocol'], subscription['Endpoint'])
+                            for subscription in response.get('Subscriptions', []))
+            if not response.get('NextToken'):
+                return existing
+            kwargs['NextToken'] = response['NextToken']
+
+    def _subscribe(self):
+        """ add subscribers that are not subscribed yet """
+        existing = self._existing_subscriptions()
+        missing = [subscriber for subscriber in self._subscribers if subscriber not in existing]
+        for protocol, endpoint in missing:
+            self._sns_client.subscribe(TopicArn=self._topic_arn, Protocol=protocol, Endpoint=endpoint)
+        logging.info(f'Subscribed {len(missing)} of {len(self._subscribers)} alert subscribers')
+
+    def _publish(self, message: str) -> dict:
+        return self._sns_client.publish(Message=message, TopicArn=self._topic_arn)
+
+    def publish(self, messages: list, warning_t: float = None) -> bool:
+        """ publish all messages at once, returns after every publish is acknowledged,
+            warning_t is the epoch time of the window start of the first warning of the alert,
+            False if the alert was dropped because the topic is not set up
+        """
+        # alerts raised during startup wait for the topic, until ready_timeout seconds after start
+        if not self._ready.wait(max(0.0, self._ready_deadline - monotonic())):
+            self.stats['dropped'] += 1
+            PUBLISHES.labels('dropped').inc(len(messages))
+            logging.error(f'SNS topic {self._topic_name} is not set up, dropping alert: {messages[-1]}')
+            return False
+        start = monotonic()
+        futures = [self._executor.submit(self._publish, message) for message in messages]
+        wait(futures)
+        acknowledged = time()
+
+        self.stats['alerts'] += 1
+        for future in futures:
+            if future.exception() is not None:
+                self.stats['errors'] += 1
+                PUBLISHES.labels('error').inc()
+                logging.error(f'Error publishing alert: {future.exception()}')
+            else:
+                self.stats['publishes'] += 1
+                PUBLISHES.labels('ok').inc()
+        self._publish_latencies.append(monotonic() - start)
+        PUBLISH_SECONDS.observe(self._publish_latencies[-1])
+        if warning_t is not None:
+            self._alert_latencies.append(acknowledged - warning_t)
+            ALERT_LATENCY.observe(self._alert_latencies[-1])
+        return True
+
+    def report(self) -> dict:
+        """ counts and latency percentiles in seconds, alert latency is only meaningful for live readings """
+        return dict(self.stats,
+                    alert_latency=percentiles(self._alert_latencies),
+                    publish_latency=percentiles(self._publish_latencies))
@@ -0,0 +1,204 @@
+"""
+this script recomputes peak_accel and warnings of a date range straight from OpenEEW records,
+without replaying them through Kinesis, 1 process per CPU by default
+    python backfill.py mx "2020-01-05 00:00:00" "2020-01-07 00:00:00" 001,002,005 [processes]
+"""
+
+import os
+import sys
+import logging
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import psycopg2
+from openeew.data.aws import AwsDataClient
+from openeew.data.df import get_df_from_records
+from record_cache import RecordCache
+from detection import WARNING_THRESHOLD, ROWS_PRECEDING
+
+READING_COLUMNS = ['device_id', 'x', 'y', 'z', 'sample_t']
+
+# seconds read before a day, so its first windows see their preceding rows like the stream does
+LEAD_IN = 60
+
+# worker process state, set by _init_worker
+_data_client = None
+_record_cache = None
+
+
+def compute_peaks(readings_df: pd.DataFrame,
+                  threshold: float = WARNING_THRESHOLD,
+                  rows_preceding: int = ROWS_PRECEDING) -> tuple:
+    """ batch equivalent of the Kinesis Analytics pumps, see DetectionEngine:
+            peak_df     device_id, count, peak, second for every device and second
+            warning_df  device_id, acceleration, second where the MIN peak of the current
+                        and preceding rows of the device reaches threshold
+    """
+    acceleration = np.sqrt(readings_df['y'].values.astype(np.float64) ** 2 +
+                           readings_df['z'].values.astype(np.float64) ** 2)
+    seconds = (readings_df['sample_t'].values.astype(np.float64) * 1000).astype(np.int64) // 1000
+
+    peak_df = pd.DataFrame({'device_id': readings_df['device_id'].values.astype(str),
+                            'second': seconds,
+                            'acceleration': acceleration}) \
+        .groupby(['device_id', 'second'], sort=True)['acceleration'] \
+        .agg(count='size', peak='max') \
+        .reset_index()
+
+    peak_df['warning'] = peak_df.groupby('device_id')['peak'] \
+        .rolling(rows_preceding + 1, min_periods=1).min() \
+        .reset_index(level=0, drop=True)
+    warning_df = peak_df.loc[peak_df['warning'] >= threshold, ['device_id', 'warning', 'second']]
+    return peak_df[['device_id', 'count', 'peak', 'second']], warning_df
+
+
+def _format_times(seconds: pd.Series) -> np.ndarray:
+    """ seconds since epoch as Kinesis Analytics TIMESTAMP strings, e.g. 2020-01-05 04:39:00.000 """
+    return pd.to_datetime(seconds, unit='s').dt.strftime('%Y-%m-%d %H:%M:%S.000').values
+
+
+def to_stream_rows(peak_df: pd.DataFrame, warning_df: pd.DataFrame) -> tuple:
+    """ rows shaped like decoded DESTINATION_SQL_STREAM_001 and DESTINATION_SQL_STREAM_002 records """
+    accel_rows = [{'DEVICE_ID': device_id,
+                   'COUNT_ACCEL': int(count),
+                   'PEAK_ACCELERATION': float(peak),
+                   'ACCELERATION_TIME': time}
+                  for device_id, count, peak, time in zip(peak_df['device_id'].values,
+                                                          peak_df['count'].values,
+                                                          peak_df['peak'].values,
+                                                          _format_times(peak_df['second']))]
+    warning_rows = [{'DEVICE_ID': device_id,
+                     'WARNING_ACCELERATION': float(warning),
+                     'WARNING_TIME': time}
+                    for device_id, warning, time in zip(warning_df['device_id'].values,
+                                                        warning_df['warning'].values,
+                                                        _format_times(warning_df['second']))]
+    return accel_rows, warning_rows
+
+
+def partition_tasks(start_date: datetime, end_date: datetime, device_ids: list) -> list:
+    """ (device id, start, end) of every device and UTC day of the range """
+    tasks = []
+    day = datetime(start_date.year, start_date.month, start_date.day)
+    while day < end_date:
+        next_day = day + timedelta(days=1)
+        for device_id in device_ids:
+            tasks.append((device_id, max(day, start_date), min(next_day, end_date)))
+        day = next_day
+    return tasks
+
+
+def _init_worker(country: str, cache_dir: str):
+    global _data_client, _record_cache
+    _data_client = AwsDataClient(country)
+    _record_cache = RecordCache(cache_dir) if cache_dir else None
+
+
+def _read_records(country: str, device_id: str, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+    """ readings of 1 device like StreamProducer._get_raw_data, from the local cache when it has them """
+    if _record_cache is not None:
+        records_df = _record_cache.read_records(country, start_date, end_date, [device_id], _fetch_records)
+        return records_df if records_df is not None else pd.DataFrame(columns=READING_COLUMNS)
+    return _fetch_records(start_date, end_date, [device_id])
+
+
+def _fetch_records(start_date: datetime, end_date: datetime, device_ids: list) -> pd.DataFrame:
+    records = _data_client.get_filtered_records(str(start_date), str(end_date), device_ids)
+    if records:
+        return get_df_from_records(records)[READING_COLUMNS]
+    return pd.DataFrame(columns=READING_COLUMNS)
+
+
+def _backfill_task(country: str, dsn: str, device_id: str, start_date: datetime, end_date: datetime) -> tuple:
+    """ read, compute and save 1 device and day, returns (readings, peak rows, warning rows) """
+    from consumer import OutputAccelerationStream, OutputWarningStream, output_streams
+    accel_stream, warning_stream = output_streams()
+
+    readings_df = _read_records(country, device_id, start_date - timedelta(seconds=LEAD_IN), end_date)
+    if not len(readings_df):
+        return 0, 0, 0
+
+    peak_df, warning_df = compute_peaks(readings_df)
+    start = start_date.replace(tzinfo=timezone.utc).timestamp()
+    end = end_date.replace(tzinfo=timezone.utc).timestamp()
+    peak_df = peak_df[(peak_df['second'] >= start) & (peak_df['second'] < end)]
+    warning_df = warning_df[(warning_df['second'] >= start) & (warning_df['second'] < end)]
+    accel_rows, warning_rows = to_stream_rows(peak_df, warning_df)
+
+    # COPY through the staging table, rows already saved by the consumer or an earlier run are skipped
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                if accel_rows:
+                    OutputAccelerationStream(accel_stream).save_rows(cur, accel_rows)
+                if warning_rows:
+                    OutputWarningStream(warning_stream).save_rows(cur, warning_rows)
+    finally:
+        conn.close()
+    return len(readings_df), len(accel_rows), len(warning_rows)
+
+
+def backfill(country: str, start_date: datetime, end_date: datetime, device_ids: list,
+             processes: int = None, cache_dir: str = None):
+    """ recompute peak_accel and warnings of every device and day of the range on a process pool """
+    from consumer import OutputAccelerationStream, OutputWarningStream, output_streams, postgres_dsn
+    accel_stream, warning_stream = output_streams()
+    dsn = postgres_dsn()
+
+    # tables and daily partitions are created once, before the workers write concurrently
+    tasks = partition_tasks(start_date, end_date, device_ids)
+    days = sorted({task_start.date() for _, task_start, _ in tasks})
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                for stream in (OutputAccelerationStream(accel_stream),
+                               OutputWarningStream(warning_stream)):
+                    stream.setup_tbl(cur)
+                    stream.ensure_partitions(cur, days)
+    finally:
+        conn.close()
+
+    totals = np.zeros(3, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count(),
+                             initializer=_init_worker,
+                             initargs=(country, cache_dir)) as executor:
+        futures = {executor.submit(_backfill_task, country, dsn, *task): task for task in tasks}
+        for done, future in enumerate(as_completed(futures), 1):
+            device_id, task_start, task_end = futures[future]
+            try:
+                counts = future.result()
+            except Exception as generic:
+                logging.error(f'Error backfilling device {device_id} from {task_start} to {task_end}: {generic}')
+                continue
+            totals += counts
+            logging.info(f'{done}/{len(tasks)} device {device_id} {task_start:%Y-%m-%d}: {counts[0]} readings, '
+                         f'{counts[1]} peak rows, {counts[2]} warning rows')
+
+    logging.info(f'Backfill done: {totals[0]} readings, {totals[1]} peak rows, {totals[2]} warning rows')
+    return totals
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s:  %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S')
+
+    if len(sys.argv) not in (5, 6):
+        print('Please provide 4 or 5 arguments = country, start date, end date, '
+              'comma separated device ids and optionally the number of processes')
+        exit()
+
+    country = sys.argv[1]
+    start_date = datetime.fromisoformat(sys.argv[2])
+    end_date = datetime.fromisoformat(sys.argv[3])
+    device_ids = sys.argv[4].split(',')
+    processes = int(sys.argv[5]) if len(sys.argv) == 6 else None
+
+    backfill(country, start_date, end_date, device_ids, processes, os.environ.get('RECORD_CACHE_DIR'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import logging
+import random
+from time import sleep, monotonic
+from botocore.exceptions import ClientError
+import metrics
+
+# Kinesis PutRecords limits
+MAX_BATCH_RECORDS = 500
+MAX_BATCH_BYTES = 5 * 1024 * 1024
+MAX_RECORD_BYTES = 1024 * 1024
+
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'InternalFailure')
+
+RECORDS_SENT = metrics.counter('eew_kinesis_records_sent', 'Records accepted by Kinesis', ['stream'])
+RECORDS_DROPPED = metrics.counter('eew_kinesis_records_dropped', 'Records given up after retries or too large',
+                                  ['stream'])
+PUT_BATCH_RECORDS = metrics.histogram('eew_kinesis_put_batch_records', 'Records per PutRecords batch', ['stream'],
+                                      buckets=metrics.SIZE_BUCKETS)
+PUT_SECONDS = metrics.histogram('eew_kinesis_put_seconds', 'Latency of 1 PutRecords or PutRecord call',
+                                ['stream', 'operation'])
+THROTTLES = metrics.counter('eew_kinesis_throttles', 'Kinesis calls or entries rejected by throughput limits',
+                            ['stream', 'operation'])
+
+
+class KinesisBatcher:
+    def __init__(self,
+                 kinesis_client,
+                 stream_name: str,
+                 max_records: int = MAX_BATCH_RECORDS,
+                 max_bytes: int = MAX_BATCH_BYTES,
+                 linger_time: float = 0.5,   # seconds a record may wait for its batch to fill up
+                 max_retries: int = 8,
+                 backoff_base: float = 0.05,  # seconds, doubled on every retry
+                 backoff_max: float = 5.0):
+        """ accumulate records into PutRecords calls up to the Kinesis count and size limits,
+            re-send only the failed entries of a call with exponential backoff
+        """
+        self._kinesis = kinesis_client
+        self._stream_name = stream_name
+
+        self._max_records = min(max_records, MAX_BATCH_RECORDS)
+        self._max_bytes = min(max_bytes, MAX_BATCH_BYTES)
+        self._linger_time = linger_time
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+
+        self._records = []
+        self._batch_bytes = 0
+        self._batch_opened = None
+
+        self.stats = {'batches': 0, 'records': 0, 'bytes': 0, 'retries': 0, 'dropped': 0}
+
+        self._records_sent = RECORDS_SENT.labels(stream_name)
+        self._records_dropped = RECORDS_DROPPED.labels(stream_name)
+        self._batch_records = PUT_BATCH_RECORDS.labels(stream_name)
+        self._put_seconds = PUT_SECONDS.labels(stream_name, 'PutRecords')
+        self._throttles = THROTTLES.labels(stream_name, 'PutRecords')
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def add(self, data, partition_key: str):
+        """ queue 1 record, flushing first if it does not fit into the current batch """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        record_bytes = len(data) + len(partition_key.encode('utf-8'))
+        if record_bytes > MAX_RECORD_BYTES:
+            logging.error(f'Dropping record of {record_bytes} bytes for partition key {partition_key}, '
+                          f'Kinesis limit is {MAX_RECORD_BYTES}')
+            self.stats['dropped'] += 1
+            self._records_dropped.inc()
+            return
+
+        if self._records and (len(self._records) >= self._max_records
+                              or self._batch_bytes + record_bytes > self._max_bytes):
+            self.flush()
+
+        if not self._records:
+            self._batch_opened = monotonic()
+        self._records.append({'Data': data, 'PartitionKey': partition_key})
+        self._batch_bytes += record_bytes
+
+        if len(self._records) >= self._max_records:
+            self.flush()
+        else:
+            self.poll()
+
+    def add_many(self, payloads: list, partition_keys: list):
+        for data, partition_key in zip(payloads, partition_keys):
+            self.add(data, partition_key)
+
+    def poll(self):
+        """ flush the current batch once its oldest record has lingered long enough """
+        if self._records and monotonic() - self._batch_opened >= self._linger_time:
+            self.flush()
+
+    def wait(self, seconds: float):
+        """ sleep between adds, the current batch is flushed as soon as it has lingered long enough """
+        end = monotonic() + seconds
+        if self._records and self._batch_opened + self._linger_time < end:
+            sleep(max(0.0, self._batch_opened + self._linger_time - monotonic()))
+            self.flush()
+        sleep(max(0.0, end - monotonic()))
+
+    def flush(self):
+        """ send the current batch, retrying failed entries until all succeed or retries run out """
+        if not self._records:
+            return
+
+        records, batch_bytes = self._records, self._batch_bytes
+        self._records, self._batch_bytes, self._batch_opened = [], 0, None
+
+        start = monotonic()
+        retries = 0
+        dropped = 0
+        pending = records
+        while pending:
+            call_start = monotonic()
+            try:
+                response = self._kinesis.put_records(StreamName=self._stream_name, Records=pending)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in THROTTLING_ERRORS:
+                    raise
+                failed = pending  # whole call was rejected
+            else:
+                self._put_seconds.observe(monotonic() - call_start)
+                if response.get('FailedRecordCount', 0) == 0:
+                    break
+                # entries of the response are in the same order as the request
+                failed = [record for record, result in zip(pending, response['Records'])
+                          if 'ErrorCode' in result]
+            self._throttles.inc(len(failed))
+
+            if retries >= self._max_retries:
+                logging.error(f'Dropping {len(failed)} of {len(records)} records '
+                              f'after {retries} retries to {self._stream_name}')
+                dropped = len(failed)
+                self.stats['dropped'] += dropped
+                self._records_dropped.inc(dropped)
+                break
+
+            retries += 1
+            sleep(self._backoff(retries))
+            pending = failed
+
+        elapsed = monotonic() - start
+        self.stats['batches'] += 1
+        self.stats['records'] += len(records)
+        self.stats['bytes'] += batch_bytes
+        self.stats['retries'] += retries
+        self._records_sent.inc(len(records) - dropped)
+        self._batch_records.observe(len(records))
+        logging.info(f'PutRecords {len(records)} records, {batch_bytes} bytes in {elapsed:.3f} s '
+                     f'({len(records) / elapsed if elapsed > 0 else 0:.0f} records/s), retries {retries}')
+
+    def _backoff(self, retries: int) -> float:
+        """ exponential backoff with full jitter """
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * 2 ** retries))
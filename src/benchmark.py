@@ -0,0 +1,515 @@
+"""
+this is an ancillary script to measure hot paths of the pipeline without AWS
+    encoding: columnar batch encoding vs per-row json.dumps of a multi-minute interval
+    codec:    bytes per reading and encode/decode throughput of binary records vs json.dumps
+    detection: readings/s of DetectionEngine for thousands of devices at 32 Hz
+    sta_lta:  StaLtaDetector triggers on quiet and noisy sites compared with the Kinesis Analytics rule,
+              time to warning of both, then readings/s of the trigger alone and with per second peaks
+    backfill: readings/s of the batch peaks and warnings of backfill.py
+    postgres: rows/s of COPY vs execute_values into peak_accel of the local PostgreSQL (postgres.cfg),
+              rows go to a temporary table shadowing peak_accel, existing data is not touched
+    e2e:      a window with synthetic quakes at the 4 corners of the network, 8 s apart, replayed at sensor speed
+              through producer, Kinesis Analytics and both consumers on the in-memory transport
+              (EEW_TRANSPORT=memory), latency percentiles from the warning time to the alert sink over every
+              warning and from the first warning to the alert over every event, CPU seconds per stage,
+              consumers write to a scratch schema of the local PostgreSQL that is dropped afterwards
+    replay:   the e2e replay of a recorded OpenEEW window, warmed in RECORD_CACHE_DIR by record_cache.py,
+              takes the same 4 arguments: country, start date, end date and comma separated device ids
+    picks:    PWavePicker on binary records of 32 and 8 samples with injected onsets, pick error and delay,
+              then the e2e replay with binary records and a pick consumer on the input stream that publishes
+              the alerts instead of the warnings consumer (ALERT_SOURCE=picks), pick error and alert latency,
+              compare with e2e for the latency of the warnings path
+    metrics:  cost of counter, gauge and histogram updates and of the instrumentation of 1 GetRecords call,
+              then of a scrape of the HTTP endpoint
+the correctness checks of these paths are the tests in tests/, run with python -m pytest
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import urllib.request
+from datetime import datetime, timedelta
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+from record_cache import RecordCache, CACHE_DIR
+from producer import StreamProducer
+from record_codec import encode_interval, decode_records
+from detection import DetectionEngine, StaLtaDetector
+from backfill import compute_peaks, to_stream_rows
+from synthetic import synthetic_readings, sites_with_shaking, first_warnings, p_wave_sites, first_picks
+import metrics
+
+
+def _encode_per_row(accelerator_data: pd.DataFrame) -> list:
+    """ per-row encoding as done before the columnar path """
+    return [json.dumps(dict(reading._asdict())) for reading in accelerator_data.itertuples()]
+
+
+def bench_encoding(seconds: int = 300):
+    readings_df = synthetic_readings(seconds=seconds)
+    num_readings = len(readings_df)
+
+    start = timer()
+    _encode_per_row(readings_df)
+    per_row = timer() - start
+
+    start = timer()
+    StreamProducer._encode_records(readings_df)
+    columnar = timer() - start
+
+    logging.info(f'encoding {num_readings} readings ({seconds} s interval)')
+    logging.info(f'per-row json.dumps: {per_row:.3f} s, {num_readings / per_row:,.0f} readings/s')
+    logging.info(f'columnar to_json:   {columnar:.3f} s, {num_readings / columnar:,.0f} readings/s')
+    logging.info(f'speedup: {per_row / columnar:.1f}x')
+
+
+def bench_codec(devices: int = 100, seconds: int = 60, readings_per_record: int = 32):
+    readings_df = synthetic_readings(devices=devices, seconds=seconds)
+    num_readings = len(readings_df)
+
+    start = timer()
+    json_payloads = _encode_per_row(readings_df)
+    json_encode = timer() - start
+
+    start = timer()
+    decode_records([{'Data': data} for data in json_payloads])
+    json_decode = timer() - start
+
+    start = timer()
+    binary_payloads, _, _ = encode_interval(readings_df, readings_per_record)
+    binary_encode = timer() - start
+
+    start = timer()
+    decode_records([{'Data': data} for data in binary_payloads])
+    binary_decode = timer() - start
+
+    json_bytes = sum(len(data.encode('utf-8')) for data in json_payloads)
+    binary_bytes = sum(len(data) for data in binary_payloads)
+
+    logging.info(f'{num_readings} readings of {devices} devices, {readings_per_record} readings per binary record')
+    logging.info(f'json:   {json_bytes / num_readings:.1f} bytes/reading, {len(json_payloads)} records, '
+                 f'encode {num_readings / json_encode:,.0f} readings/s, '
+                 f'decode {num_readings / json_decode:,.0f} readings/s')
+    logging.info(f'binary: {binary_bytes / num_readings:.1f} bytes/reading, {len(binary_payloads)} records, '
+                 f'encode {num_readings / binary_encode:,.0f} readings/s, '
+                 f'decode {num_readings / binary_decode:,.0f} readings/s')
+
+
+def bench_detection(devices: int = 5000, seconds: int = 10, frequency: int = 32):
+    readings_df = synthetic_readings(devices=devices, seconds=seconds, frequency=frequency)
+    # deliver readings as the stream does, 1 second of all devices per batch
+    readings_df = readings_df.sort_values('sample_t', kind='mergesort')
+    batches = np.array_split(np.arange(len(readings_df)), seconds)
+    device_ids = readings_df['device_id'].values
+    sample_t = readings_df['sample_t'].values
+    x = readings_df['x'].values
+    y = readings_df['y'].values
+    z = readings_df['z'].values
+
+    engine = DetectionEngine()
+    accel_rows = 0
+    start = timer()
+    for batch in batches:
+        rows = engine.process(device_ids[batch], sample_t[batch], x[batch], y[batch], z[batch])
+        accel_rows += len(rows[0])
+    elapsed = timer() - start
+
+    num_readings = len(readings_df)
+    logging.info(f'{devices} devices at {frequency} Hz, {seconds} s: {elapsed:.3f} s, '
+                 f'{num_readings / elapsed:,.0f} readings/s, {accel_rows} peak acceleration rows')
+    logging.info(f'real-time capacity on 1 core: {num_readings / elapsed / frequency:,.0f} devices')
+
+
+def time_to_warning(onset: float = 40.0, start_t: float = 1578199140.0):
+    """ seconds from the onset to the warning of StaLtaDetector and of the Kinesis Analytics rule
+        on the same quiet and noisy sites, with the sites that warned without shaking
+    """
+    readings_df, shaking_ids = sites_with_shaking(onset=onset, start_t=start_t)
+    triggered = first_warnings(StaLtaDetector(peaks=False), readings_df)
+    false_triggers = [device_id for device_id in triggered if device_id not in shaking_ids]
+    delays = np.array([emitted - start_t - onset for device_id, (_, emitted) in triggered.items()
+                       if device_id in shaking_ids])
+    logging.info(f'STA/LTA: {len(false_triggers)} sites triggered without shaking, '
+                 f'{len(delays)} of {len(shaking_ids)} shaking sites triggered'
+                 + (f', time to warning median {np.median(delays):.3f} s, max {delays.max():.3f} s'
+                    if len(delays) else ''))
+
+    warned = first_warnings(DetectionEngine(), readings_df)
+    false_warnings = [device_id for device_id in warned if device_id not in shaking_ids]
+    warned = first_warnings(DetectionEngine(), readings_df, after=start_t + onset)
+    delays = np.array([emitted - start_t - onset for device_id, (_, emitted) in warned.items()
+                       if device_id in shaking_ids])
+    logging.info(f'Kinesis Analytics rule: {len(false_warnings)} sites warned without shaking, '
+                 f'{len(delays)} of {len(shaking_ids)} shaking sites warned after the onset'
+                 + (f', time to warning median {np.median(delays):.3f} s' if len(delays) else ''))
+
+
+def bench_sta_lta(devices: int = 10000, seconds: int = 10, frequency: int = 32):
+    time_to_warning()
+
+    readings_df = synthetic_readings(devices=devices, seconds=seconds, frequency=frequency)
+    readings_df = readings_df.sort_values('sample_t', kind='mergesort')
+    num_readings = len(readings_df)
+    columns = [readings_df[column].values for column in ('device_id', 'sample_t', 'x', 'y', 'z')]
+
+    # the stream delivers 1 second or a 32 sample record of all devices per batch, or quarter seconds
+    for peaks in (False, True):
+        for batches_per_second in (1, 4):
+            batches = np.array_split(np.arange(num_readings), seconds * batches_per_second)
+            detector = StaLtaDetector(peaks=peaks)
+            start = timer()
+            for batch in batches:
+                detector.process(*(column[batch] for column in columns))
+            elapsed = timer() - start
+            logging.info(f'{"trigger and peaks" if peaks else "trigger"}, {1 / batches_per_second:g} s batches, '
+                         f'{devices} devices at {frequency} Hz, {seconds} s: {elapsed:.3f} s, '
+                         f'{num_readings / elapsed:,.0f} readings/s, '
+                         f'real-time capacity on 1 core: {num_readings / elapsed / frequency:,.0f} devices')
+
+
+def pick_delays(readings_per_record: int = 32):
+    """ error of the picked onsets, and seconds from the onset to the trigger and to the pick """
+    readings_df, onsets = p_wave_sites()
+    start = timer()
+    picks, num_records = first_picks(readings_df, readings_per_record)
+    elapsed = timer() - start
+
+    onset = np.array([onsets[device_id] for device_id in picks])
+    pick_t, trigger_t, released = (np.array(values) for values in zip(*picks.values()))
+    errors = pick_t - onset
+    logging.info(f'{readings_per_record} samples per record, {num_records} records in {elapsed:.3f} s: '
+                 f'{len(picks)} of {len(onsets)} onsets picked, '
+                 f'pick error median {np.median(errors) * 1000:+.0f} ms, max {np.abs(errors).max() * 1000:.0f} ms, '
+                 f'trigger {np.median(trigger_t - onset):.3f} s and pick out {np.median(released - onset):.3f} s '
+                 f'after the onset (median), at most {(released - onset).max():.3f} s')
+
+
+def bench_picks():
+    for readings_per_record in (32, 8):
+        pick_delays(readings_per_record)
+    bench_e2e(record_format='binary', picks=True)
+
+
+def bench_backfill(devices: int = 100, seconds: int = 600, frequency: int = 32):
+    readings_df = synthetic_readings(devices=devices, seconds=seconds, frequency=frequency)
+    # without gravity, and strong shaking on every device for 5 seconds, so there are warnings to compare
+    readings_df['z'] += 1
+    shaking = readings_df['sample_t'] - readings_df['sample_t'].min()
+    readings_df.loc[(shaking >= 100) & (shaking < 105), 'y'] = 0.8
+
+    start = timer()
+    accel_rows, warning_rows = to_stream_rows(*compute_peaks(readings_df))
+    elapsed = timer() - start
+
+    logging.info(f'{devices} devices at {frequency} Hz, {seconds} s: {elapsed:.3f} s, '
+                 f'{len(readings_df) / elapsed:,.0f} readings/s, '
+                 f'{len(accel_rows)} peak rows, {len(warning_rows)} warning rows')
+
+
+def synthetic_peak_rows(devices: int = 1000, seconds: int = 100) -> list:
+    """ decoded DESTINATION_SQL_STREAM_001 rows, 1 per device per second """
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2020-01-05 04:39:00', periods=seconds, freq='s').strftime('%Y-%m-%d %H:%M:%S.000')
+    peaks = rng.uniform(0, 0.4, devices * seconds)
+    return [{'DEVICE_ID': f'{device:03d}',
+             'COUNT_ACCEL': 32,
+             'PEAK_ACCELERATION': float(peaks[i * devices + device]),
+             'ACCELERATION_TIME': time}
+            for i, time in enumerate(times) for device in range(devices)]
+
+
+def bench_postgres(batch_size: int = 1000):
+    # imported here, consumer reads postgres.cfg on first use
+    import psycopg2
+    from consumer import OutputAccelerationStream, postgres_dsn
+
+    rows = synthetic_peak_rows()
+    batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+
+    conn = psycopg2.connect(postgres_dsn())
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    # temporary table comes first in the search path, so it shadows peak_accel for this session
+    cur.execute("""CREATE TEMP TABLE peak_accel (
+                        device_id               VARCHAR(5) NOT NULL,
+                        count_acceleration      INTEGER,
+                        peak_acceleration       NUMERIC,
+                        acceleration_time       TIMESTAMP,
+                        id                      SERIAL PRIMARY KEY,
+                        UNIQUE (device_id, acceleration_time)
+                   );""")
+
+    stream = OutputAccelerationStream('benchmark')
+    for name, save in (('execute_values', stream.insert_rows), ('COPY', stream.copy_rows)):
+        cur.execute('TRUNCATE peak_accel')
+        start = timer()
+        for batch in batches:
+            save(cur, batch)
+        elapsed = timer() - start
+
+        # a replayed batch is skipped, not saved twice
+        save(cur, batches[0])
+        cur.execute('SELECT count(*) FROM peak_accel')
+        assert cur.fetchone()[0] == len(rows)
+        logging.info(f'{name}: {len(rows)} rows in batches of {batch_size}, {elapsed:.3f} s, '
+                     f'{len(rows) / elapsed:,.0f} rows/s')
+    conn.close()
+
+
+def synthetic_quakes(devices: int = 400,
+                     seconds: int = 60,
+                     frequency: int = 32,
+                     quakes: int = 4,
+                     shaking_devices: int = 10,
+                     first_start: int = 20,
+                     spacing: int = 8,
+                     shaking_seconds: int = 6,
+                     start_t: float = 1578199140.0) -> tuple:
+    """ readings without gravity of devices on a 10 km grid around Mexico City, quakes start every spacing seconds
+        at the corners of the grid in turn, the devices closest to each epicenter shake above the warning threshold,
+        corners are far enough apart for every quake to be its own event,
+        returns (readings_df, devices, (epicenter device ids, onset) of every quake)
+    """
+    side = int(np.ceil(np.sqrt(devices)))
+    offsets = np.arange(side) - side // 2
+    grid = [(19.43 + row * 0.09, -99.13 + col * 0.095) for row in offsets for col in offsets]
+    grid.sort(key=lambda location: (location[0] - 19.43) ** 2 + (location[1] + 99.13) ** 2)
+    device_list = [{'device_id': f'{device:03d}', 'latitude': latitude, 'longitude': longitude}
+                   for device, (latitude, longitude) in zip(range(devices), grid)]
+    latitudes = np.array([device['latitude'] for device in device_list])
+    longitudes = np.array([device['longitude'] for device in device_list])
+    corners = [(latitudes.min(), longitudes.min()), (latitudes.max(), longitudes.max()),
+               (latitudes.min(), longitudes.max()), (latitudes.max(), longitudes.min())]
+
+    readings_df = synthetic_readings(devices=devices, seconds=seconds, frequency=frequency, start_t=start_t)
+    readings_df['z'] += 1
+    elapsed = readings_df['sample_t'] - start_t
+    events = []
+    for quake in range(quakes):
+        latitude, longitude = corners[quake % len(corners)]
+        closest = np.argsort((latitudes - latitude) ** 2 + (longitudes - longitude) ** 2)[:shaking_devices]
+        shaking_ids = [device_list[i]['device_id'] for i in closest]
+        onset = first_start + quake * spacing
+        shaking = readings_df['device_id'].isin(shaking_ids) & (elapsed >= onset) & (elapsed < onset + shaking_seconds)
+        readings_df.loc[shaking, 'y'] = 0.8
+        events.append((shaking_ids, start_t + onset))
+    return readings_df, device_list, events
+
+
+def _thread_cpu() -> dict:
+    """ CPU seconds of the live threads grouped by stage, from their thread names """
+    stages = ('analytics', 'shard', 'decode', 'db-sink', 'alert-sink', 'sns-publish', 's3-prefetch')
+    cpu = {}
+    for thread in threading.enumerate():
+        stage = next((stage for stage in stages if thread.name.startswith(stage)), None)
+        if stage is not None and thread.ident is not None:
+            try:
+                seconds = time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+            except OSError:
+                continue
+            cpu[stage] = cpu.get(stage, 0.0) + seconds
+    return cpu
+
+
+def _log_latency(name: str, latency: dict, clock_offset: float):
+    """ percentiles of a consumer report, replayed times are shifted to the replay clock """
+    if latency:
+        logging.info(f'{name}: ' + ', '.join(f'{key} {value - clock_offset:.3f} s' for key, value in latency.items()))
+    else:
+        logging.info(f'{name}: none')
+
+
+def replay(device_ids: list, start_date: datetime, end_date: datetime, cache: RecordCache, country: str = 'mx',
+           min_stations: int = 3, record_format: str = 'json', picks: bool = False) -> tuple:
+    """ replay a window of the record cache at sensor speed through producer, Kinesis Analytics and the consumers
+        on the in-memory transport, consumers write to a scratch schema of the local PostgreSQL that is dropped
+        afterwards, device locations come from DEVICES_FILE or S3,
+        with picks a pick consumer of the input stream publishes the alerts instead of the warnings consumer,
+        returns the consumer reports of the accelerations, warnings and, with picks, input stream,
+        and the saved pick times
+    """
+    os.environ['EEW_TRANSPORT'] = 'memory'
+    # imported here, they read postgres.cfg and kinesis.cfg on import
+    import psycopg2
+    from setup_kinesis_analytics import AwsSetup, INPUT_STREAM
+    from consumer import StreamConsumer, StreamFactory, output_streams, postgres_dsn
+
+    # every connection of the consumers uses the scratch schema
+    admin = psycopg2.connect(postgres_dsn())
+    admin.autocommit = True
+    admin_cur = admin.cursor()
+    admin_cur.execute('DROP SCHEMA IF EXISTS eew_benchmark CASCADE')
+    admin_cur.execute('CREATE SCHEMA eew_benchmark')
+    os.environ['PGOPTIONS'] = '-c search_path=eew_benchmark'
+    try:
+        aws = AwsSetup()
+        aws.create_application()
+
+        stream_names = list(output_streams()) + ([INPUT_STREAM] if picks else [])
+        alert_source = 'picks' if picks else 'warnings'
+        consumers = [StreamConsumer(StreamFactory.produce_stream(stream_name, alert_source=alert_source),
+                                    alert_min_stations=min_stations)
+                     for stream_name in stream_names]
+        for consumer in consumers:
+            threading.Thread(target=consumer.consume_records, name='consumer', daemon=True).start()
+        AwsSetup.start_application()
+
+        producer = StreamProducer(device_ids,
+                                  country=country,
+                                  stream_name=INPUT_STREAM,
+                                  start_date=start_date,
+                                  end_date=end_date,
+                                  kinesis_produce_many=True,
+                                  prefetch_intervals=2,
+                                  record_cache=cache,
+                                  record_format=record_format)
+        start = timer()
+        producer_cpu = time.thread_time()
+        producer.produce()
+        producer_cpu = time.thread_time() - producer_cpu
+        elapsed = timer() - start
+        time.sleep(3)  # last windows, db commits and alerts
+
+        cpu = dict(_thread_cpu(), producer=producer_cpu)
+        reports = [consumer.report() for consumer in consumers]
+        logging.info(f'{len(device_ids)} devices, {(end_date - start_date).total_seconds():.0f} s '
+                     f'replayed in {elapsed:.1f} s')
+        # the consumer of the alert source is the last one
+        alerting = reports[-1]
+        logging.info(f'Events of the {alert_source}: {alerting["Event associator stats"]}')
+        _log_latency(f'Latency from the warning time of the {alert_source} to the alert sink',
+                     alerting['Warning latency'], producer.clock_offset)
+        _log_latency(f'Latency from the first warning time of the {alert_source} to the alert',
+                     alerting['Alert dispatcher stats']['alert_latency'], producer.clock_offset)
+        pick_times = []
+        if picks:
+            admin_cur.execute('SELECT extract(epoch FROM pick_time) FROM eew_benchmark.picks')
+            pick_times = [float(pick_time) for pick_time, in admin_cur.fetchall()]
+        for stage, seconds_cpu in sorted(cpu.items(), key=lambda item: -item[1]):
+            logging.info(f'CPU {stage}: {seconds_cpu:.2f} s, {seconds_cpu / elapsed:.1%} of a core')
+        for name, values in alerting.items():
+            logging.info(f'{name}: {values}')
+
+        for line in metrics.REGISTRY.expose().splitlines():
+            if line.startswith(('eew_kinesis_records', 'eew_db_rows_saved', 'eew_alert_publishes')):
+                logging.info(f'metric {line}')
+        return reports, pick_times
+    finally:
+        admin_cur.execute('DROP SCHEMA IF EXISTS eew_benchmark CASCADE')
+        admin.close()
+
+
+def bench_e2e(devices: int = 400, seconds: int = 60, frequency: int = 32, quakes: int = 4, min_stations: int = 3,
+              record_format: str = 'json', picks: bool = False):
+    readings_df, device_list, events = synthetic_quakes(devices=devices, seconds=seconds, frequency=frequency,
+                                                        quakes=quakes)
+    start_date = datetime(2020, 1, 5, 4, 39, 0)
+    end_date = start_date + timedelta(seconds=seconds)
+
+    work_dir = tempfile.mkdtemp(prefix='eew-e2e-')
+    try:
+        # the synthetic window is read by the producer from its record cache, as if it came from S3
+        cache = RecordCache(os.path.join(work_dir, 'cache'))
+        device_ids = [device['device_id'] for device in device_list]
+        block_start, block_end = cache.aligned(start_date, end_date)
+        cache.put_records('mx', block_start, block_end, device_ids, readings_df)
+
+        devices_file = os.path.join(work_dir, 'devices.json')
+        with open(devices_file, 'w') as f:
+            json.dump(device_list, f)
+        os.environ['DEVICES_FILE'] = devices_file
+
+        logging.info(f'{quakes} quakes, {devices} devices at {frequency} Hz, {record_format} records')
+        _, pick_times = replay(device_ids, start_date, end_date, cache, min_stations=min_stations,
+                               record_format=record_format, picks=picks)
+        if picks:
+            # error of every pick from the closest onset, replayed times are not shifted in the picks table
+            onsets = np.array([onset for _, onset in events])
+            errors = np.array([pick_time - onsets[np.abs(onsets - pick_time).argmin()] for pick_time in pick_times])
+            logging.info(f'{len(errors)} picks saved for {len(events) * len(events[0][0])} shaking devices' +
+                         (f', error from the onset median {np.median(errors):+.3f} s, '
+                          f'max {np.abs(errors).max():.3f} s' if len(errors) else ''))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def bench_replay(country: str, start: str, end: str, device_ids: str):
+    """ a recorded OpenEEW window of RECORD_CACHE_DIR, warmed with record_cache.py and the same arguments,
+        device locations of DEVICES_FILE or S3 as of the start of the window, records of RECORD_FORMAT
+    """
+    os.environ.setdefault('DEVICES_AS_OF', start)
+    cache = RecordCache(os.environ.get('RECORD_CACHE_DIR', CACHE_DIR))
+    replay(device_ids.split(','), datetime.fromisoformat(start), datetime.fromisoformat(end), cache, country,
+           record_format=os.environ.get('RECORD_FORMAT', 'json'))
+
+
+def bench_metrics(updates: int = 1000000, records_per_read: int = 100):
+    counter = metrics.counter('eew_benchmark_updates', 'Benchmark counter', ['stream']).labels('benchmark')
+    gauge = metrics.gauge('eew_benchmark_value', 'Benchmark gauge', ['stream']).labels('benchmark')
+    histogram = metrics.histogram('eew_benchmark_seconds', 'Benchmark histogram', ['stream']).labels('benchmark')
+
+    for name, update in (('counter inc', counter.inc),
+                         ('gauge set', gauge.set),
+                         ('histogram observe', histogram.observe)):
+        start = timer()
+        for i in range(updates):
+            update(0.01)
+        logging.info(f'{name}: {(timer() - start) / updates * 1e9:.0f} ns')
+
+    # what _consume_shard adds to every GetRecords call
+    start = timer()
+    for i in range(updates):
+        read_start = time.monotonic()
+        histogram.observe(time.monotonic() - read_start)
+        counter.inc(records_per_read)
+        histogram.observe(records_per_read)
+        gauge.set(0)
+    per_read = (timer() - start) / updates
+    logging.info(f'instrumentation of 1 GetRecords call: {per_read * 1e6:.2f} us, '
+                 f'{per_read / records_per_read * 1e9:.0f} ns per record at {records_per_read} records per call')
+
+    server = metrics.start_http_server(0, '127.0.0.1')
+    try:
+        start = timer()
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            text = response.read().decode('utf-8')
+        elapsed = timer() - start
+    finally:
+        server.shutdown()
+    logging.info(f'scrape: {len(text.splitlines())} lines, {len(text)} bytes in {elapsed * 1000:.1f} ms')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s:  %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S')
+
+    benchmarks = {'encoding': bench_encoding,
+                  'codec': bench_codec,
+                  'detection': bench_detection,
+                  'sta_lta': bench_sta_lta,
+                  'backfill': bench_backfill,
+                  'postgres': bench_postgres,
+                  'e2e': bench_e2e,
+                  'replay': bench_replay,
+                  'picks': bench_picks,
+                  'metrics': bench_metrics}
+
+    # replay takes the arguments of record_cache.py for the window to replay
+    arguments = 4 if sys.argv[1:2] == ['replay'] else 0
+    if len(sys.argv) != 2 + arguments or sys.argv[1] not in benchmarks:
+        print(f'Please provide 1 argument = benchmark: {", ".join(benchmarks)}, '
+              f'replay takes 4 more = country, start date, end date and comma separated device ids')
+        exit()
+
+    benchmarks[sys.argv[1]](*sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+
+class CheckpointStore:
+    def __init__(self, stream_name: str, table_name: str = 'kinesis_checkpoints'):
+        """ sequence number of the last saved record of every shard of a stream, kept in PostgreSQL
+            so it is committed in the same transaction as the rows it covers
+        """
+        self._stream_name = stream_name
+        self._table_name = table_name
+
+    def setup(self, cur: psycopg2.extensions.cursor):
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {self._table_name} (
+                            stream_name             VARCHAR(128) NOT NULL,
+                            shard_id                VARCHAR(128) NOT NULL,
+                            sequence_number         VARCHAR(128) NOT NULL,
+                            updated_at              TIMESTAMP NOT NULL DEFAULT now(),
+                            PRIMARY KEY (stream_name, shard_id)
+                        );""")
+
+    def load(self, cur: psycopg2.extensions.cursor) -> dict:
+        """ shard id -> sequence number to resume after, empty before the table exists """
+        cur.execute("SELECT to_regclass(%s)", (self._table_name,))
+        if cur.fetchone()[0] is None:
+            return {}
+        cur.execute(f"SELECT shard_id, sequence_number FROM {self._table_name} WHERE stream_name = %s",
+                    (self._stream_name,))
+        return dict(cur.fetchall())
+
+    def save(self, cur: psycopg2.extensions.cursor, positions: dict):
+        """ upsert the read positions of several shards """
+        psycopg2.extras.execute_values(cur,
+                                       f"""INSERT INTO {self._table_name} (stream_name, shard_id, sequence_number)
+                                           VALUES %s
+                                           ON CONFLICT (stream_name, shard_id) DO UPDATE
+                                           SET sequence_number = EXCLUDED.sequence_number, updated_at = now()""",
+                                       [(self._stream_name, shard_id, sequence_number)
+                                        for shard_id, sequence_number in positions.items()])
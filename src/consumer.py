@@ -1,247 +1,771 @@
+from time import time, sleep, monotonic
+STARTED = monotonic()  # cold start reference, before the imports below
+
+import io
 import os
-import boto3
+import csv
+import transport
+import metrics
 import json
 import logging
-from datetime import datetime, timedelta
+import threading
+from collections import deque
 from configparser import ConfigParser
 import psycopg2
 import psycopg2.extensions
 import psycopg2.extras
-from openeew.data.aws import AwsDataClient
+from device_registry import DeviceRegistry
+from event_associator import EventAssociator, warning_timestamp
+from alert_cooldown import AlertCooldown, ALERT_COOLDOWN
+from alert_dispatcher import AlertDispatcher, percentiles
+from rate_limiter import TokenBucket, AdaptivePoller, ReadMetrics
+from pipeline import Stage, Batch
+from db import ConnectionManager, TransactionBatcher, CONNECTION_ERRORS
+from schema import PartitionedTable
+from checkpoint import CheckpointStore
+
+# Kinesis limit of reads per shard per second
+SHARD_READS_PER_SECOND = 5
+
+# share of the input stream's reads per shard per second taken by the pick consumer, Kinesis Analytics reads the rest
+INPUT_SHARD_READS_PER_SECOND = 2
+
+# streams whose consumer publishes the alerts, the other one only saves its rows so that no event is alerted twice
+ALERT_SOURCES = ('warnings', 'picks')
+
+# seconds between reads of an idle shard, shards of streams with alerts are read at every token instead
+IDLE_POLL_INTERVAL = 1.0
+
+# attempts to save a batch before it is dropped
+DB_WRITE_ATTEMPTS = 5
+
+# a transaction is committed after this many rows or this many seconds
+DB_TRANSACTION_ROWS = 5000
+DB_TRANSACTION_DELAY = 0.5
+
+# rows kept in memory while the tables cannot be set up, more are dropped
+DB_PENDING_ROWS = 100000
+
+# batches of alerting streams waiting for room in the db sink, the oldest are dropped beyond this
+DB_BACKLOG_BATCHES = 10000
+
+# seconds to wait for the checkpoints, the shards are read from LATEST without them
+CHECKPOINT_LOAD_TIMEOUT = 5
+
+# seconds between creating partitions ahead of time and applying retention
+TABLE_MAINTENANCE_INTERVAL = 3600
+
+# an alert is published once this many devices within the radius warn within the window
+ALERT_MIN_STATIONS = 3
+ALERT_RADIUS_KM = 50.0
+ALERT_WINDOW = 10.0
+
+# seconds between attempts of the background setup of tables and alert subscribers
+SETUP_RETRY_INTERVAL = 5
+
+# seconds alerts wait for device metadata and the SNS topic after start, later alerts without them are dropped
+SETUP_WAIT_TIMEOUT = 10
+
+# transaction advisory lock serializing table setup of consumers that start together
+SETUP_LOCK_KEY = 7301
+
+# Kinesis error codes of reads over the shard limits
+THROTTLING_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException')
+
+RECORDS_RECEIVED = metrics.counter('eew_kinesis_records_received', 'Records read from Kinesis', ['stream'])
+GET_BATCH_RECORDS = metrics.histogram('eew_kinesis_get_batch_records', 'Records per GetRecords call', ['stream'],
+                                      buckets=metrics.SIZE_BUCKETS)
+GET_SECONDS = metrics.histogram('eew_kinesis_get_seconds', 'Latency of 1 GetRecords call', ['stream'])
+MILLIS_BEHIND_LATEST = metrics.gauge('eew_kinesis_millis_behind_latest', 'MillisBehindLatest of the last GetRecords',
+                                     ['stream', 'shard'])
+THROTTLES = metrics.counter('eew_kinesis_throttles', 'Kinesis calls or entries rejected by throughput limits',
+                            ['stream', 'operation'])
+READ_ERRORS = metrics.counter('eew_kinesis_read_errors', 'Failed GetRecords calls', ['stream'])
+WARNING_LATENCY = metrics.histogram('eew_warning_window_latency_seconds',
+                                    'Seconds from the warning window start to the alert sink, live readings only',
+                                    buckets=metrics.ALERT_LATENCY_BUCKETS)
+PICKS = metrics.counter('eew_picks', 'P-wave picks of the input stream')
+PICK_LATENCY = metrics.histogram('eew_pick_latency_seconds',
+                                 'Seconds from the onset to the decoded pick, only meaningful for live readings',
+                                 buckets=metrics.ALERT_LATENCY_BUCKETS)
 
 # from collections import namedtuple
 # from postgres_sql import *
 
-config = ConfigParser()
-config.read_file(open('postgres.cfg'))
+_config = None
+
+
+def read_config() -> ConfigParser:
+    """ postgres.cfg and kinesis.cfg, read on first use instead of on import """
+    global _config
+    if _config is None:
+        config = ConfigParser()
+        config.read_file(open('postgres.cfg'))
+        config.read_file(open('kinesis.cfg'))
+        _config = config
+    return _config
+
+
+def postgres_dsn(with_dbname: bool = True) -> str:
+    config = read_config()
+    dbname = f" dbname={config.get('POSTGRES', 'dbname')}" if with_dbname else ''
+    return f"host={config.get('POSTGRES', 'dbhost')}{dbname} " \
+           f"user={config.get('POSTGRES', 'dbuser')} password={config.get('POSTGRES', 'dbpassword')}"
+
+
+def error_code(generic: Exception) -> str:
+    """ error code of a botocore ClientError, botocore is not imported to keep startup short """
+    return getattr(generic, 'response', {}).get('Error', {}).get('Code')
+
+
+def _parents(shard: dict) -> list:
+    """ ids of the shards a shard was split or merged from """
+    return [parent for parent in (shard.get('ParentShardId'), shard.get('AdjacentParentShardId')) if parent]
 
-DBHOST = config.get('POSTGRES', 'dbhost')
-DBNAME = config.get('POSTGRES', 'dbname')
-DBUSER = config.get('POSTGRES', 'dbuser')
-DBPASSWORD = config.get('POSTGRES', 'dbpassword')
 
-SNS_SUBSCRIBERS = config.get('SNS_SUBSCRIBERS', 'numbers')
-EMAIL_SUBSCRIBERS = config.get('EMAIL_SUBSCRIBERS', 'emails')
+def input_stream() -> str:
+    return read_config().get('KINESIS', 'input_stream')
 
-config_kin = ConfigParser()
-config_kin.read_file(open('kinesis.cfg'))
-OUTPUT_ACCEL_STREAM = config_kin.get('KINESIS', 'output_accel_stream')
-OUTPUT_WARNING_STREAM = config_kin.get('KINESIS', 'output_warning_stream')
+
+def output_streams() -> tuple:
+    """ names of the acceleration and warning output streams """
+    config = read_config()
+    return config.get('KINESIS', 'output_accel_stream'), config.get('KINESIS', 'output_warning_stream')
 
 
 class AbstractStream:
-    def __init__(self, name: str, postgres_page_size: int = 1000):
+    def __init__(self, name: str, postgres_page_size: int = 1000, postgres_copy: bool = True):
         self._stream_name = name
         self._stream_table_name = ''
+        self._stream_table_columns = []  # table columns in the order of the stream's record keys
+        self._stream_time_key = ''  # record key of the time column the table is partitioned on
+        self._table = None  # PartitionedTable
         self._postgres_page_size = postgres_page_size
+        self._postgres_copy = postgres_copy  # COPY FROM STDIN, or INSERT with execute_values
+        self.raises_alerts = False  # rows are warnings that are associated into alerts
+        self.shard_reads_per_second = SHARD_READS_PER_SECOND  # share of the Kinesis read limit of every shard
 
     @property
     def stream_name(self) -> str:
         return self._stream_name
 
     def setup_tbl(self, cur: psycopg2.extensions.cursor):
-        pass
+        """ setup destination table in PostgreSQL, existing data is kept"""
+        if self._table is not None:
+            self._table.setup(cur)
+
+    def maintain_tbl(self, cur: psycopg2.extensions.cursor):
+        """ create partitions ahead of time and apply retention"""
+        if self._table is not None:
+            self._table.maintain(cur)
+
+    def ensure_partitions(self, cur: psycopg2.extensions.cursor, days: list):
+        """ create the daily partitions of past days before a bulk load"""
+        if self._table is not None:
+            self._table.ensure_partitions(cur, days)
+
+    @staticmethod
+    def decode_records(records: list) -> list:
+        """rows of a Kinesis stream batch, 1 dict per record in column order"""
+        return [json.loads(record["Data"]) for record in records]
 
     def save_to_postgres(self, cur: psycopg2.extensions.cursor, records: list):
         """save data from a Kinesis stream to a postgres table"""
+        self.save_rows(cur, self.decode_records(records))
+
+    def save_rows(self, cur: psycopg2.extensions.cursor, rows: list):
+        """save decoded rows of a Kinesis stream to a postgres table"""
 
-        record_iterator = (tuple(json.loads(record["Data"]).values()) for record in records)
+        if self._table is not None:
+            # replayed data may be days away from the partitions created ahead of today
+            self._table.ensure_partitions_for(cur, [row.get(self._stream_time_key) for row in rows])
+
+        if self._postgres_copy:
+            # a failed COPY inserts nothing, the savepoint keeps an open transaction usable
+            in_transaction = not cur.connection.autocommit
+            if in_transaction:
+                cur.execute('SAVEPOINT copy_rows')
+            try:
+                self.copy_rows(cur, rows)
+                return
+            except CONNECTION_ERRORS:
+                raise
+            except psycopg2.Error as e:
+                if in_transaction:
+                    cur.execute('ROLLBACK TO SAVEPOINT copy_rows')
+                logging.warning(f'COPY into {self._stream_table_name} failed, using INSERT: {e}')
+        self.insert_rows(cur, rows)
+
+    def copy_rows(self, cur: psycopg2.extensions.cursor, rows: list):
+        """save decoded rows with COPY FROM STDIN into a session staging table,
+            then move them to the table skipping rows already saved, rows are written as CSV into a text buffer,
+            which quotes values with commas, quotes or line breaks and writes None as the unquoted empty NULL
+        """
+
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(row.values() for row in rows)
+        buffer.seek(0)
+
+        columns = ', '.join(self._stream_table_columns)
+        staging_table = f'{self._stream_table_name}_staging'
+        cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging_table} AS "
+                    f"SELECT {columns} FROM {self._stream_table_name} WITH NO DATA")
+        cur.execute(f"TRUNCATE {staging_table}")
+        cur.copy_expert(f"COPY {staging_table} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cur.execute(f"INSERT INTO {self._stream_table_name} ({columns}) SELECT {columns} FROM {staging_table} "
+                    f"ON CONFLICT DO NOTHING")
+
+    def insert_rows(self, cur: psycopg2.extensions.cursor, rows: list):
+        """save decoded rows with INSERT ... VALUES pages, skipping rows already saved"""
+
+        record_iterator = (tuple(row.values()) for row in rows)
         psycopg2.extras.execute_values(cur,  # db cursor
-                                       f"INSERT INTO {self._stream_table_name} VALUES %s;",
+                                       f"INSERT INTO {self._stream_table_name} "
+                                       f"({', '.join(self._stream_table_columns)}) VALUES %s "
+                                       f"ON CONFLICT DO NOTHING;",
                                        record_iterator,  # iterator
                                        page_size=self._postgres_page_size)
 
 
 class OutputAccelerationStream(AbstractStream):
-    def __init__(self, name: str, postgres_page_size: int = 1000):
+    def __init__(self, name: str, postgres_page_size: int = 1000, postgres_copy: bool = True,
+                 retention_days: int = None):
 
-        super(OutputAccelerationStream, self).__init__(name, postgres_page_size)
+        super(OutputAccelerationStream, self).__init__(name, postgres_page_size, postgres_copy)
         self._stream_table_name = 'peak_accel'
-
-    def setup_tbl(self, cur: psycopg2.extensions.cursor):
-        """ setup destination tables in PostgreSQL"""
-        try:
-            cur.execute(f"DROP table IF EXISTS {self._stream_table_name}")
-            cur.execute(f"""CREATE TABLE IF NOT EXISTS {self._stream_table_name} ( 
-                                device_id 				VARCHAR(5) NOT NULL, 
-                                count_acceleration    	INTEGER,
-                                peak_acceleration    	NUMERIC,
-                                acceleration_time		TIMESTAMP,                                
-                                id 						SERIAL PRIMARY KEY
-                          );""")
-        except psycopg2.Error as e:
-            print(e)
+        self._stream_table_columns = ['device_id', 'count_acceleration', 'peak_acceleration', 'acceleration_time']
+        self._stream_time_key = 'ACCELERATION_TIME'
+        self._table = PartitionedTable(self._stream_table_name,
+                                       'acceleration_time',
+                                       """device_id               VARCHAR(5) NOT NULL,
+                                          count_acceleration      INTEGER,
+                                          peak_acceleration       NUMERIC""",
+                                       retention_days=retention_days)
 
 
 class OutputWarningStream(AbstractStream):
-    def __init__(self, name: str, postgres_page_size: int = 1000):
-        super(OutputWarningStream, self).__init__(name, postgres_page_size)
+    def __init__(self, name: str, postgres_page_size: int = 1000, postgres_copy: bool = True,
+                 retention_days: int = None,
+                 raises_alerts: bool = True):  # False = warnings are only saved, the picks are alerted
+        super(OutputWarningStream, self).__init__(name, postgres_page_size, postgres_copy)
         self._stream_table_name = 'warnings'
-
-    def setup_tbl(self, cur: psycopg2.extensions.cursor):
-        """ setup destination tables in PostgreSQL"""
-        try:
-            cur.execute(f"DROP table IF EXISTS {self._stream_table_name}")
-            cur.execute(f"""CREATE TABLE IF NOT EXISTS {self._stream_table_name} ( 
-                            device_id 				VARCHAR(5) NOT NULL, 
-                            warning_acceleration 	NUMERIC,
-                            warning_time			TIMESTAMP,
-                            id 						SERIAL PRIMARY KEY
-                          );""")
-        except psycopg2.Error as e:
-            print(e)
+        self._stream_table_columns = ['device_id', 'warning_acceleration', 'warning_time']
+        self._stream_time_key = 'WARNING_TIME'
+        self._table = PartitionedTable(self._stream_table_name,
+                                       'warning_time',
+                                       """device_id               VARCHAR(5) NOT NULL,
+                                          warning_acceleration    NUMERIC""",
+                                       retention_days=retention_days)
+        self.raises_alerts = raises_alerts
+
+
+class InputPickStream(AbstractStream):
+    def __init__(self, name: str, postgres_page_size: int = 1000, postgres_copy: bool = True,
+                 retention_days: int = None,
+                 detector: str = 'p_wave',  # name of create_detector, warnings of other detectors are picks too
+                 raises_alerts: bool = True):  # False = picks are only saved, the warnings stream is alerted
+        """ raw readings of the input stream, the rows are P-wave picks of PWavePicker in the warning schema,
+            a pick is alerted from the batch that triggers it, without waiting for the Kinesis Analytics windows
+            and the warnings stream, Kinesis Analytics and this consumer share the 5 reads per shard per second,
+            this consumer takes INPUT_SHARD_READS_PER_SECOND of them
+        """
+        # imported here, pandas is only needed to decode raw readings
+        from detection import create_detector
+
+        super(InputPickStream, self).__init__(name, postgres_page_size, postgres_copy)
+        self._stream_table_name = 'picks'
+        self._stream_table_columns = ['device_id', 'pick_acceleration', 'pick_time', 'trigger_time']
+        self._stream_time_key = 'WARNING_TIME'
+        self._table = PartitionedTable(self._stream_table_name,
+                                       'pick_time',
+                                       """device_id               VARCHAR(5) NOT NULL,
+                                          pick_acceleration       NUMERIC,
+                                          trigger_time            TIMESTAMP""",
+                                       retention_days=retention_days)
+        self._picker = create_detector(detector)
+        self.raises_alerts = raises_alerts
+        self.shard_reads_per_second = INPUT_SHARD_READS_PER_SECOND
+
+    def decode_records(self, records: list) -> list:
+        """ picks of a batch of raw readings, the picker keeps the state of every device across batches,
+            warnings without a trigger time were triggered at their warning time
+        """
+        picks = [{'DEVICE_ID': warning['DEVICE_ID'],
+                  'WARNING_ACCELERATION': warning['WARNING_ACCELERATION'],
+                  'WARNING_TIME': warning['WARNING_TIME'],
+                  'TRIGGER_TIME': warning.get('TRIGGER_TIME', warning['WARNING_TIME'])}
+                 for warning in self._picker.process_records(records)[1]]
+        if picks:
+            PICKS.inc(len(picks))
+            decoded = time()
+            for pick in picks:
+                PICK_LATENCY.observe(decoded - warning_timestamp(pick['WARNING_TIME']))
+        return picks
 
 
 class StreamFactory:
 
     @staticmethod
-    def produce_stream(stream_name: str) -> AbstractStream:
-        if stream_name == OUTPUT_ACCEL_STREAM:
+    def produce_stream(stream_name: str, retention_days: int = None, pick_detector: str = 'p_wave',
+                       alert_source: str = 'warnings') -> AbstractStream:
+        """ alert_source is the stream that is alerted, warnings or picks """
+        if alert_source not in ALERT_SOURCES:
+            raise ValueError(f'Alert source must be one of {", ".join(ALERT_SOURCES)}, not {alert_source}')
+        output_accel_stream, output_warning_stream = output_streams()
+        if stream_name == input_stream():
+            return InputPickStream(name=stream_name, retention_days=retention_days, detector=pick_detector,
+                                   raises_alerts=alert_source == 'picks')
+        if stream_name == output_accel_stream:
             return OutputAccelerationStream(
-                name=stream_name)
+                name=stream_name,
+                retention_days=retention_days)
         else:
-            return OutputWarningStream(name=OUTPUT_WARNING_STREAM)
+            return OutputWarningStream(name=output_warning_stream, retention_days=retention_days,
+                                       raises_alerts=alert_source == 'warnings')
 
 
 class StreamConsumer:
     def __init__(self, stream_obj: AbstractStream,
-                 kinesis_records_limit=1000):
+                 kinesis_records_limit=1000,
+                 shard_refresh_interval=30,   # seconds between checks for new shards after resharding
+                 alert_min_stations=ALERT_MIN_STATIONS,
+                 shard_reads_per_second=None):  # reads per shard per second, None = the share of the stream
         """ initialize Kinesis as consumer input,
             SNS as alert publishing system,
-            PostgreSQL as output storage system
+            PostgreSQL as output storage system,
+            only what the first read needs is done here, tables, topic and device metadata are set up
+            in the background once consume_records has started the readers
         """
+        self._created = monotonic()
+        self.startup = {}  # seconds from cold start to startup milestones
         self._kinesis_records_limit = kinesis_records_limit
+        self._shard_refresh_interval = shard_refresh_interval
         self._stream_obj = stream_obj
+        self._alert_min_stations = alert_min_stations
+        self._shard_reads_per_second = shard_reads_per_second or stream_obj.shard_reads_per_second
 
-        # set up PostgreSQL to save calculated accelerations
+        # set up PostgreSQL to save calculated accelerations and the read position of every shard,
+        # only the checkpoints are read now, tables are checked in the background
         # self._setup_db()  # run this only once
-        self._connect_db()  # sets up db cursor
-        stream_obj.setup_tbl(self._cur)
+        self._connect_db()  # sets up db connection pool
+        self._db_ready = threading.Event()
+        self._checkpoint_store = CheckpointStore(stream_obj.stream_name)
+        self._checkpoints = self._load_checkpoints(CHECKPOINT_LOAD_TIMEOUT)
 
         # set up Kinesis to read output stream
         self._setup_kinesis()
 
         # setup notification system to publish alerts
         self._setup_sns()
-        self._sent_sms = {}
+        # devices of published alerts stay silent for their cooldown, also across restarts
+        self._alerted = AlertCooldown(cooldown=float(os.environ.get('ALERT_COOLDOWN', ALERT_COOLDOWN)),
+                                      path=os.environ.get('ALERT_STATE_FILE'))
+
+        # device locations for alert messages and event association, kept in memory
+        self._setup_devices()
+        self._devices_deadline = monotonic() + SETUP_WAIT_TIMEOUT
+        # seconds from the warning window start to the alert sink, the WARNING_TIME of the Kinesis Analytics rule
+        # is the start of its 1 second window, up to 1 second before the reading, the one of a pick is its onset
+        self._warning_latencies = deque(maxlen=1000)
+        self._associator = EventAssociator(self._devices,
+                                           min_stations=self._alert_min_stations,
+                                           radius_km=ALERT_RADIUS_KM,
+                                           window=ALERT_WINDOW)
+
+        # fetch -> decode -> db sink, decode -> alert sink
+        self._setup_pipeline()
 
     def _setup_db(self):
         """setup database in PostgreSQL"""
-        conn = psycopg2.connect(f"host={DBHOST} user={DBUSER} password={DBPASSWORD}")
+        conn = psycopg2.connect(postgres_dsn(with_dbname=False))
         conn.set_session(autocommit=True)
         cur = conn.cursor()
-        cur.execute(f"DROP DATABASE IF EXISTS {DBNAME}")
-        cur.execute(f"CREATE DATABASE {DBNAME} WITH ENCODING 'utf8' TEMPLATE template0")
+        dbname = read_config().get('POSTGRES', 'dbname')
+        cur.execute(f"DROP DATABASE IF EXISTS {dbname}")
+        cur.execute(f"CREATE DATABASE {dbname} WITH ENCODING 'utf8' TEMPLATE template0")
         conn.close()
 
     def _connect_db(self):
-        """ connect to postgreSQL database"""
-        conn = psycopg2.connect(f"host={DBHOST} dbname={DBNAME} user={DBUSER} password={DBPASSWORD}")
-        conn.set_session(autocommit=True)
-        self._cur = conn.cursor()
+        """ connect to postgreSQL database, connections are reopened when they break"""
+        self._db = ConnectionManager(postgres_dsn())
 
-    def _setup_kinesis(self):
-        """ setup Kinesis connection and shard iterator"""
+    def _load_checkpoints(self, timeout: float) -> dict:
+        """ read positions of the last run, empty if PostgreSQL does not answer within timeout seconds,
+            alerting does not wait for the database
+        """
+        loaded = {}
 
-        self._kinesis = boto3.client('kinesis')
-        response = self._kinesis.describe_stream(StreamName=self._stream_obj.stream_name)
+        def load():
+            try:
+                with self._db.connection() as conn:
+                    with conn.cursor() as cur:
+                        loaded['checkpoints'] = self._checkpoint_store.load(cur)
+            except Exception as generic:
+                loaded['error'] = generic
 
-        shard_id = response['StreamDescription']['Shards'][0]['ShardId']
-        shard_iterator = self._kinesis.get_shard_iterator(StreamName=self._stream_obj.stream_name,
-                                                          ShardId=shard_id,
-                                                          ShardIteratorType='LATEST')  # 'LATEST' or 'TRIM_HORIZON'
-        self._shard_it = shard_iterator['ShardIterator']
+        loader = threading.Thread(target=load, name='checkpoint-load', daemon=True)
+        loader.start()
+        loader.join(timeout)
+        if 'checkpoints' in loaded:
+            return loaded['checkpoints']
+        logging.error(f'Cannot load Kinesis checkpoints, reading open shards from LATEST: '
+                      f'{loaded.get("error", f"no answer within {timeout} s")}')
+        return {}
 
-    def _setup_sns(self):
-        """ setup notification system, SNS"""
-        self._sns_client = boto3.client("sns")
-
-        # Create the topic if it doesn't exist (this is idempotent)
-        topic = self._sns_client.create_topic(Name="notifications")
-        self._topic_arn = topic['TopicArn']  # get its Amazon Resource Name
-
-        numbers = SNS_SUBSCRIBERS.split(',')
-        # Add SMS Subscribers
-        for number in numbers:
-            self._sns_client.subscribe(
-                TopicArn=self._topic_arn,
-                Protocol='sms',
-                Endpoint=number  # <-- number who'll receive an SMS message.
-            )
-        emails = EMAIL_SUBSCRIBERS.split(',')
-        # Add SMS Subscribers
-        for email in emails:
-            self._sns_client.subscribe(
-                TopicArn=self._topic_arn,
-                Protocol='email',
-                Endpoint=email  # <-- email address who'll receive an alert message.
-            )
-
-
-    def _get_device_location(self, device_id: str, alert_date: str, country: str = 'mx') -> dict:
-        data_client = AwsDataClient(country)
-
-        devices = data_client.get_devices_as_of_date(alert_date)
-        location = {}
-        for device in devices:
-            if device['device_id'] == device_id:
-                location = {'latitude': device['latitude'], 'longitude': device['longitude']}
-        return location
-
-    def _send_sms(self, records: list):
-        """ Send a message when new records show up in warnings stream
-            The closest device should send message first
-            All other devices will have a time lag
+    def _setup_kinesis(self):
+        """ setup Kinesis connection, shards with a checkpoint are read after it,
+            open shards without a checkpoint are read from the LATEST record
         """
-        if records and len(records):
-            data = json.loads(records[0]["Data"])
-            device_id = data.get('DEVICE_ID')
 
-            if device_id not in self._sent_sms:
-                location = self._get_device_location(device_id, data.get('WARNING_TIME')[:-4])
-                message = f"Detected ground shaking above threshold {data.get('WARNING_ACCELERATION')}, " \
-                          f"time {data.get('WARNING_TIME')}, " \
-                          f"by device {device_id} at {str(location)}"
+        self._kinesis = transport.client('kinesis')
+        self._shard_readers = {}  # shard id -> reader thread
+        self.read_metrics = {}  # shard id -> read rate and lag of its reader
+        self._first_reads = {}  # shard id -> sequence number of the first record read
+        self._rewinds = {}  # shard id -> (iterator type, sequence number) to read again from, after dropped rows
 
-                # Publish a message.
-                self._sns_client.publish(Message="Warning!", TopicArn=self._topic_arn)
-                self._sns_client.publish(Message=message, TopicArn=self._topic_arn)
+        # closed shards read to the end, or closed before start
+        self._open_shards, self._finished_shards = self.start_positions(self._list_shards(), self._checkpoints)
 
-                self._sent_sms.update({data.get('DEVICE_ID'): data.get('WARNING_TIME')[:-4]})
+    @staticmethod
+    def start_positions(shards: list, checkpoints: dict) -> tuple:
+        """ (shards read now, after their checkpoint or from LATEST, set of shards never read),
+            descendants of checkpointed shards are neither, they were created by a resharding while the consumer
+            was down and are read from TRIM_HORIZON by _discover_shards once their parents are read to the end
+        """
+        listed = {shard['ShardId']: shard for shard in shards}
+
+        def after_checkpoint(shard: dict) -> bool:
+            return any(parent in checkpoints or (parent in listed and after_checkpoint(listed[parent]))
+                       for parent in _parents(shard))
+
+        open_shards, finished_shards = [], set()
+        for shard in shards:
+            shard_id = shard['ShardId']
+            if shard_id in checkpoints:
+                # also closed shards, they may have records after the checkpoint
+                open_shards.append(shard_id)
+            elif after_checkpoint(shard):
+                continue
+            elif 'EndingSequenceNumber' in shard['SequenceNumberRange']:
+                finished_shards.add(shard_id)
+            else:
+                # a new stream, or a shard without records during the last run
+                open_shards.append(shard_id)
+        return open_shards, finished_shards
+
+    def _list_shards(self) -> list:
+        """ all shards of the stream, including parents and children of a resharding """
+        shards = []
+        response = self._kinesis.list_shards(StreamName=self._stream_obj.stream_name)
+        shards.extend(response['Shards'])
+        while response.get('NextToken'):
+            response = self._kinesis.list_shards(NextToken=response['NextToken'])
+            shards.extend(response['Shards'])
+        return shards
+
+    def _start_shard_reader(self, shard_id: str, iterator_type: str):
+        """ read a shard, after its checkpoint if it has one """
+        sequence_number = self._checkpoints.get(shard_id)
+        if sequence_number is not None:
+            iterator_type = 'AFTER_SEQUENCE_NUMBER'
+        reader = threading.Thread(target=self._consume_shard,
+                                  args=(shard_id, iterator_type, sequence_number),
+                                  name=f'shard-{shard_id}',
+                                  daemon=True)
+        self._shard_readers[shard_id] = reader
+        reader.start()
+        logging.info(f'Reading shard {shard_id} from {iterator_type}')
+
+    def _discover_shards(self):
+        """ start readers for children of closed shards once all their parents are read to the end """
+        known = set(self._shard_readers) | self._finished_shards
+        shards = self._list_shards()
+        listed = {shard['ShardId'] for shard in shards}
+        for shard in shards:
+            shard_id = shard['ShardId']
+            if shard_id in known:
+                continue
+            # a parent missing from the listed shards has expired from the stream
+            if all(parent not in listed or parent in self._finished_shards for parent in _parents(shard)):
+                self._start_shard_reader(shard_id, 'TRIM_HORIZON')
+
+    def _setup_pipeline(self, queue_size: int = 16):
+        """ stages connected by bounded queues, the alert sink never waits behind a db write """
+        self._is_warning_stream = self._stream_obj.raises_alerts
+
+        self._db_writer = TransactionBatcher(self._db,
+                                             self._stream_obj.save_rows,
+                                             max_rows=DB_TRANSACTION_ROWS,
+                                             max_delay=DB_TRANSACTION_DELAY,
+                                             max_attempts=DB_WRITE_ATTEMPTS,
+                                             max_pending=DB_PENDING_ROWS,
+                                             checkpoint=self._checkpoint_store.save,
+                                             ready=self._db_ready,
+                                             reread=self._reread_shards,
+                                             name=self._stream_obj.stream_name)
+        self._db_sink = Stage('db-sink', self._db_writer.add, queue_size, on_idle=self._db_writer.poll)
+        self._alert_sink = Stage('alert-sink', self._send_sms, 4 * queue_size)
+        self._db_backlog = deque()  # batches of an alerting stream the db sink had no room for
+        self._decoder = Stage('decode', self._decode, queue_size,
+                              on_idle=self._flush_db_backlog if self._is_warning_stream else None)
+        self._stages = [self._decoder, self._db_sink, self._alert_sink]
+
+    def _decode(self, records: list):
+        """ decode stage: parse a fetched batch once, alerts go out before the rows are queued for the db,
+            only streams without alerts wait for the db sink
+        """
+        rows = Batch(self._stream_obj.decode_records(records), records.shard_id, records.sequence_number,
+                     records.rereads)
+        if not self._is_warning_stream:
+            self._db_sink.put(rows)
+            return
+        if rows:
+            self._alert_sink.put(rows)
+        self._db_backlog.append(rows)
+        self._flush_db_backlog()
+
+    def _flush_db_backlog(self):
+        """ queue waiting batches for the db sink while it has room, beyond DB_BACKLOG_BATCHES the oldest are
+            dropped and their shards are read again
+        """
+        while self._db_backlog and self._db_sink.offer(self._db_backlog[0]):
+            self._db_backlog.popleft()
+        while len(self._db_backlog) > DB_BACKLOG_BATCHES:
+            self._db_writer.drop(self._db_backlog.popleft(), 'waiting for the PostgreSQL writer')
+
+    def _reread_shards(self, saved: dict):
+        """ read shards with dropped rows again after their last saved rows, or their checkpoint at start,
+            or from their first record read, rows saved twice are skipped by the tables
+        """
+        for shard_id, sequence_number in saved.items():
+            sequence_number = sequence_number or self._checkpoints.get(shard_id)
+            if sequence_number is not None:
+                self._rewinds[shard_id] = ('AFTER_SEQUENCE_NUMBER', sequence_number)
+            else:
+                self._rewinds[shard_id] = ('AT_SEQUENCE_NUMBER', self._first_reads[shard_id])
 
-    def consume_records(self) -> None:
-        """read output stream from Kinesis after Kinesis Analytics processing"""
+    def _setup_sns(self):
+        """ setup notification system, SNS, the topic and subscribers are set up in the background"""
+        self._dispatcher = AlertDispatcher(transport.client("sns"),
+                                           numbers=read_config().get('SNS_SUBSCRIBERS', 'numbers').split(','),
+                                           emails=read_config().get('EMAIL_SUBSCRIBERS', 'emails').split(','),
+                                           ready_timeout=SETUP_WAIT_TIMEOUT)
+
+    def _setup_devices(self, country: str = 'mx'):
+        """ device metadata, loaded and refreshed in the background"""
+        self._devices = DeviceRegistry(country,
+                                       as_of=os.environ.get('DEVICES_AS_OF'),
+                                       devices_file=os.environ.get('DEVICES_FILE'))
+
+    def _send_sms(self, rows: list):
+        """ Send a message when enough nearby devices show up in warnings stream
+            Warnings are associated into events, 1 message per event
+            The device that triggered first is named in the message
+        """
+        received = time()
+        for row in rows:
+            self._warning_latencies.append(received - warning_timestamp(row.get('WARNING_TIME')))
+            WARNING_LATENCY.observe(self._warning_latencies[-1])
+
+        # warnings that arrive during startup wait for the device locations, not longer than the setup timeout
+        if not self._devices.wait_loaded(max(0.0, self._devices_deadline - monotonic())):
+            logging.error(f'Device metadata is not loaded, {len(rows)} warnings cannot be located, not alerting them')
+            return
+        rows = [row for row in rows
+                if not self._alerted.active(row.get('DEVICE_ID'), warning_timestamp(row.get('WARNING_TIME')))]
+        for event in self._associator.add(rows):
+            data = event.first_warning
+            device_id = data.get('DEVICE_ID')
+            location = self._devices.location(device_id)
+            message = f"Detected ground shaking above threshold {event.peak_acceleration}, " \
+                      f"time {data.get('WARNING_TIME')}, " \
+                      f"by device {device_id} at {str(location)}, " \
+                      f"confirmed by {len(event)} devices around " \
+                      f"{event.latitude:.3f}, {event.longitude:.3f}"
+
+            # Publish both messages at once, latency is measured from the window start of the first warning
+            if not self._dispatcher.publish(["Warning!", message], warning_timestamp(data.get('WARNING_TIME'))):
+                continue
+            logging.info(f'Published event {event.event_id}: {message}')
+
+            for device, (warning_time, _, _) in event.warnings.items():
+                self._alerted.add(device, warning_time)
+            self._alerted.save()
 
-        # the limit is 5 reads from output stream per second = use 5 tokens per second to meter reads
-        end_time = datetime.now() + timedelta(seconds=1)
-        tokens = 5
+    def consume_records(self) -> None:
+        """read output stream from Kinesis after Kinesis Analytics processing, 1 reader per shard"""
+
+        for stage in self._stages:
+            stage.start()
+        for shard_id in self._open_shards:
+            self._start_shard_reader(shard_id, 'LATEST')  # 'LATEST' or 'TRIM_HORIZON'
+        self._discover_shards()
+        self.startup['readers_started'] = round(monotonic() - STARTED, 3)
+
+        # off the read path: tables, SNS topic and subscribers, device metadata
+        threading.Thread(target=self._setup_tbl, name='db-setup', daemon=True).start()
+        self._dispatcher.start(SETUP_RETRY_INTERVAL)
+        self._devices.start()
+        self._devices_deadline = monotonic() + SETUP_WAIT_TIMEOUT
+
+        maintained = monotonic()
         while True:
+            sleep(self._shard_refresh_interval)
+            if self._db_ready.is_set() and monotonic() - maintained >= TABLE_MAINTENANCE_INTERVAL:
+                maintained = monotonic()
+                self._maintain_tbl()
+            for name, values in self.report().items():
+                logging.info(f'{name}: {values}')
             try:
-                while datetime.now() <= end_time:
-                    if tokens > 0:
-                        # read records from Kinesis
-                        records = self._kinesis.get_records(ShardIterator=self._shard_it,
-                                                            Limit=self._kinesis_records_limit)
-                        logging.info(str(records['ResponseMetadata']['HTTPHeaders']['date']) + ' ' + str(tokens) + ' '
-                                     + str(len(records["Records"])))
-
-                        # save records into Postgres, each stream corresponds to a table
-                        self._stream_obj.save_to_postgres(self._cur, records["Records"])
-                        self._shard_it = records["NextShardIterator"]
-
-                        # TODO define how to send message only for the first device that shows up in warning stream
-                        if 'warning' in self._stream_obj.stream_name.lower():
-                            self._send_sms(records["Records"])
+                self._discover_shards()
+            except Exception as generic:
+                logging.error(f'Error while listing Kinesis shards: {generic}')
+
+    def report(self) -> dict:
+        """ metrics of every shard reader and stage since the last report, writer and alert stats """
+        report = {f'Shard {shard_id} read metrics': read_metrics.report()
+                  for shard_id, read_metrics in list(self.read_metrics.items())}
+        report.update({f'Stage {stage.name} metrics': stage.report() for stage in self._stages})
+        report['PostgreSQL writer stats'] = dict(self._db_writer.stats, backlog=len(self._db_backlog))
+        report['Startup seconds'] = self.startup
+        if self._is_warning_stream:
+            report['Event associator stats'] = self._associator.stats
+            report['Alert dispatcher stats'] = self._dispatcher.report()
+            report['Warning latency'] = percentiles(self._warning_latencies)
+        return report
+
+    def _setup_tbl(self):
+        """ create tables and partitions if needed, rows are kept in memory until they exist """
+        while not self._db_ready.is_set():
+            try:
+                with self._db.connection() as conn:
+                    with conn.cursor() as cur:
+                        # concurrent CREATE TABLE IF NOT EXISTS of the same table can fail
+                        cur.execute('SELECT pg_advisory_xact_lock(%s)', (SETUP_LOCK_KEY,))
+                        self._stream_obj.setup_tbl(cur)
+                        self._checkpoint_store.setup(cur)
+                self._db_ready.set()
+                self.startup['db_ready'] = round(monotonic() - STARTED, 3)
+                logging.info(f'PostgreSQL tables are ready, startup: {self.startup}')
+            except Exception as generic:
+                logging.error(f'Error setting up PostgreSQL tables, retrying: {generic}')
+                sleep(SETUP_RETRY_INTERVAL)
 
-                        tokens -= 1
+    def _maintain_tbl(self):
+        try:
+            with self._db.connection(autocommit=True) as conn:
+                with conn.cursor() as cur:
+                    self._stream_obj.maintain_tbl(cur)
+        except psycopg2.Error as e:
+            logging.error(f'Error maintaining PostgreSQL partitions: {e}')
 
-                end_time = end_time + timedelta(seconds=1)
-                tokens = 5
+    def _get_shard_iterator(self, shard_id: str, iterator_type: str, sequence_number: str = None) -> str:
+        """ iterator of a shard, retried until Kinesis answers, e.g. when GetShardIterator is throttled at startup,
+            a sequence number the shard does not accept anymore is replaced by TRIM_HORIZON
+        """
+        stream_name = self._stream_obj.stream_name
+        attempt = 0
+        while True:
+            position = {'StartingSequenceNumber': sequence_number} if sequence_number is not None else {}
+            try:
+                return self._kinesis.get_shard_iterator(StreamName=stream_name,
+                                                        ShardId=shard_id,
+                                                        ShardIteratorType=iterator_type,
+                                                        **position)['ShardIterator']
+            except Exception as generic:
+                code = error_code(generic)
+                if sequence_number is not None and code == 'InvalidArgumentException':
+                    # e.g. the checkpoint is older than the stream retention
+                    logging.error(f'Cannot resume shard {shard_id} after {sequence_number}, '
+                                  f'reading from TRIM_HORIZON: {generic}')
+                    iterator_type, sequence_number = 'TRIM_HORIZON', None
+                    continue
+                if code in THROTTLING_ERRORS:
+                    THROTTLES.labels(stream_name, 'GetShardIterator').inc()
+                attempt += 1
+                logging.error(f'Error getting an iterator of Kinesis shard {shard_id}, attempt {attempt}: {generic}')
+                sleep(min(attempt, 5))
+
+    def _consume_shard(self, shard_id: str, iterator_type: str, sequence_number: str = None) -> None:
+        """ fetch stage: read 1 shard until it is closed by resharding """
+
+        shard_it = self._get_shard_iterator(shard_id, iterator_type, sequence_number)
+        resume = (iterator_type, sequence_number)  # where a new iterator starts if this one expires
+        rereads = 0
+
+        # the limit is 5 reads per shard per second for all consumers, every shard has its own budget,
+        # without bursts: a full bucket of `rate` tokens plus its refill would be over the limit within 1 second
+        reads_per_second = self._shard_reads_per_second
+        tokens = TokenBucket(rate=reads_per_second, capacity=1)
+        # a new warning is read within 1 token interval, not after the back off of an idle shard
+        poller = AdaptivePoller(self._kinesis_records_limit,
+                                max_interval=1 / reads_per_second if self._is_warning_stream
+                                else max(IDLE_POLL_INTERVAL, 1 / reads_per_second))
+        read_metrics = self.read_metrics[shard_id] = ReadMetrics()
+        stream_name = self._stream_obj.stream_name
+        records_received = RECORDS_RECEIVED.labels(stream_name)
+        batch_records = GET_BATCH_RECORDS.labels(stream_name)
+        get_seconds = GET_SECONDS.labels(stream_name)
+        millis_behind_latest = MILLIS_BEHIND_LATEST.labels(stream_name, shard_id)
+        while shard_it:
+            try:
+                rewind = self._rewinds.pop(shard_id, None)
+                if rewind is not None:
+                    # rows of this shard were dropped, their checkpoint waits until they are saved
+                    rereads += 1
+                    logging.warning(f'Reading shard {shard_id} again from {rewind[0]} {rewind[1]}')
+                    shard_it = self._get_shard_iterator(shard_id, *rewind)
+                    resume = rewind
+
+                tokens.acquire()  # sleeps until the next read is allowed
+
+                # read records from Kinesis
+                read_start = monotonic()
+                records = self._kinesis.get_records(ShardIterator=shard_it,
+                                                    Limit=self._kinesis_records_limit)
+                get_seconds.observe(monotonic() - read_start)
+                if 'first_get_records' not in self.startup:
+                    self.startup['first_get_records'] = round(monotonic() - STARTED, 3)
+                    self.startup['first_get_records_since_init'] = round(monotonic() - self._created, 3)
+                    logging.info(f'First get_records, startup: {self.startup}')
+                num_records = len(records["Records"])
+                if num_records:
+                    resume = ('AFTER_SEQUENCE_NUMBER', records["Records"][-1]['SequenceNumber'])
+                    self._first_reads.setdefault(shard_id, records["Records"][0]['SequenceNumber'])
+                millis_behind = records.get('MillisBehindLatest', 0)
+                records_received.inc(num_records)
+                batch_records.observe(num_records)
+                millis_behind_latest.set(millis_behind)
+                logging.debug(str(records['ResponseMetadata']['HTTPHeaders']['date']) + ' ' + shard_id + ' '
+                              + str(num_records) + ' ' + str(millis_behind))
+
+                # waits while the decode stage is full, so reads of streams without alerts slow down with the db
+                if num_records:
+                    self._decoder.put(Batch(records["Records"], shard_id, records["Records"][-1]['SequenceNumber'],
+                                            rereads))
+
+                # a closed shard has no next iterator once all its records are read
+                shard_it = records.get("NextShardIterator")
+
+                # back off on empty reads, read again right away when behind
+                poll_interval = poller.update(num_records, millis_behind)
+                read_metrics.update(num_records, millis_behind, poll_interval)
+                if shard_it and poll_interval > 0:
+                    sleep(poll_interval)
 
-            except psycopg2.Error as e:
-                logging.error(f'Error saving data in PostgreSQL: {e}')
             except Exception as generic:
-                logging.error(f'Error while consuming data from Kinesis: {generic}')
+                code = error_code(generic)
+                if code in THROTTLING_ERRORS:
+                    THROTTLES.labels(stream_name, 'GetRecords').inc()
+                else:
+                    READ_ERRORS.labels(stream_name).inc()
+                logging.error(f'Error while consuming data from Kinesis shard {shard_id}: {generic}')
+                if code == 'ExpiredIteratorException':
+                    # iterators live 5 minutes, e.g. the reader waited that long for a full decode stage
+                    shard_it = self._get_shard_iterator(shard_id, *resume)
+
+        self._finished_shards.add(shard_id)
+        logging.info(f'Shard {shard_id} has been closed and read to the end')
 
 
 def main():
@@ -252,8 +776,23 @@ def main():
     stream_name = os.environ['STREAM_NAME']
     logging.info('Stream_name is {}'.format(stream_name))
 
-    output_stream = StreamFactory.produce_stream(stream_name)
-    consumer = StreamConsumer(output_stream, kinesis_records_limit=10000)
+    metrics_port = os.environ.get('METRICS_PORT')
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
+
+    retention_days = os.environ.get('RETENTION_DAYS')
+    # detector of the picks of the input stream, DETECTOR is the one of the local Kinesis Analytics
+    pick_detector = os.environ.get('PICK_DETECTOR', 'p_wave')
+    # only the consumer of the alert source publishes alerts, warnings or picks
+    alert_source = os.environ.get('ALERT_SOURCE', 'warnings')
+    output_stream = StreamFactory.produce_stream(stream_name, int(retention_days) if retention_days else None,
+                                                 pick_detector, alert_source)
+    alert_min_stations = int(os.environ.get('ALERT_MIN_STATIONS', ALERT_MIN_STATIONS))
+    # reads per shard per second, by default the share of the stream: all of an output stream, part of the input
+    shard_reads_per_second = os.environ.get('SHARD_READS_PER_SECOND')
+    consumer = StreamConsumer(output_stream, kinesis_records_limit=10000, alert_min_stations=alert_min_stations,
+                              shard_reads_per_second=float(shard_reads_per_second) if shard_reads_per_second
+                              else None)
     consumer.consume_records()
 
 
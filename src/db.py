@@ -0,0 +1,196 @@
+import logging
+import threading
+from time import sleep, monotonic
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
+import metrics
+
+# errors after which a connection cannot be used anymore
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+ROWS_SAVED = metrics.counter('eew_db_rows_saved', 'Rows committed to PostgreSQL', ['stream'])
+ROWS_DROPPED = metrics.counter('eew_db_rows_dropped', 'Rows given up after all attempts', ['stream'])
+TRANSACTION_ROWS = metrics.histogram('eew_db_transaction_rows', 'Rows per PostgreSQL transaction', ['stream'],
+                                     buckets=metrics.SIZE_BUCKETS)
+TRANSACTION_SECONDS = metrics.histogram('eew_db_transaction_seconds', 'Latency of 1 insert and commit', ['stream'])
+DB_ERRORS = metrics.counter('eew_db_errors', 'Failed PostgreSQL transactions', ['stream'])
+
+
+class ConnectionManager:
+    def __init__(self, dsn: str, max_connections: int = 4):
+        """ pool of PostgreSQL connections, broken connections are closed and replaced on next use """
+        self._dsn = dsn
+        self._pool = psycopg2.pool.ThreadedConnectionPool(0, max_connections, dsn)
+
+    @contextmanager
+    def connection(self, autocommit: bool = False):
+        """ borrow a connection, committed on success and rolled back on error """
+        conn = self._pool.getconn()
+        conn.autocommit = autocommit
+        try:
+            yield conn
+            if not autocommit:
+                conn.commit()
+        except CONNECTION_ERRORS:
+            self._pool.putconn(conn, close=True)
+            conn = None
+            raise
+        except Exception:
+            if not autocommit and not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                self._pool.putconn(conn, close=bool(conn.closed))
+
+    def close(self):
+        self._pool.closeall()
+
+
+class TransactionBatcher:
+    def __init__(self,
+                 connections: ConnectionManager,
+                 write,                    # function(cursor, rows) saving rows in the open transaction
+                 max_rows: int = 5000,     # rows per transaction
+                 max_delay: float = 0.5,   # seconds a row may wait for its commit
+                 max_attempts: int = 5,
+                 max_pending: int = 100000,  # rows held back before ready, more are dropped
+                 checkpoint=None,          # function(cursor, {shard id: sequence number}) saving read positions
+                 ready=None,               # threading.Event set once the tables exist, None = ready now
+                 reread=None,              # function({shard id: last saved sequence number or None}) reading
+                                           # the shards of dropped rows again after their last saved rows
+                 name: str = ''):          # stream label of the metrics
+        """ group rows of several batches into 1 transaction, committed by size or age,
+            so at most max_delay seconds of rows are waiting for a commit,
+            read positions of the batches are checkpointed in the same transaction as their rows,
+            rows are held back until ready is set, up to max_pending rows,
+            the checkpoint of a shard with dropped rows is held back until the shard has been read again
+            and saved up to the dropped rows, so a restart never skips them
+        """
+        self._connections = connections
+        self._write = write
+        self._max_rows = max_rows
+        self._max_delay = max_delay
+        self._max_attempts = max_attempts
+        self._max_pending = max_pending
+        self._checkpoint = checkpoint
+        self._ready = ready
+        self._reread = reread
+
+        self._rows = []
+        self._positions = {}  # shard id -> sequence number of the last pending row
+        self._rereads = {}  # shard id -> rereads of the last pending batch
+        self._opened = None
+        self._saved = {}  # shard id -> last checkpointed sequence number
+        self._unsaved = {}  # shard id -> (last dropped sequence number, rereads of its batch)
+        self._recovered = set()  # shards with dropped rows whose pending rows were read again past them
+        self._lock = threading.Lock()  # batches of alerting streams are dropped by the decode stage
+
+        self.stats = {'transactions': 0, 'rows': 0, 'reconnects': 0, 'dropped': 0}
+
+        self._rows_saved = ROWS_SAVED.labels(name)
+        self._rows_dropped = ROWS_DROPPED.labels(name)
+        self._transaction_rows = TRANSACTION_ROWS.labels(name)
+        self._transaction_seconds = TRANSACTION_SECONDS.labels(name)
+        self._errors = DB_ERRORS.labels(name)
+
+    def add(self, rows: list):
+        if not self._rows and not self._positions:
+            self._opened = monotonic()
+        self._rows.extend(rows)
+        shard_id = getattr(rows, 'shard_id', None)
+        if shard_id is not None:
+            self._positions[shard_id] = rows.sequence_number
+            self._rereads[shard_id] = rows.rereads
+            with self._lock:
+                dropped = self._unsaved.get(shard_id)
+                # read again after the drop and up to the dropped rows
+                if dropped is not None and rows.rereads > dropped[1] and \
+                        int(rows.sequence_number) >= int(dropped[0]):
+                    self._recovered.add(shard_id)
+        if len(self._rows) >= self._max_rows:
+            self.commit()
+        else:
+            self.poll()
+
+    def poll(self):
+        """ commit once the oldest pending row has waited max_delay """
+        if (self._rows or self._positions) and monotonic() - self._opened >= self._max_delay:
+            self.commit()
+
+    def commit(self):
+        if not self._rows and not self._positions:
+            return
+        if self._ready is not None and not self._ready.is_set():
+            if len(self._rows) > self._max_pending:
+                rows, positions, rereads = self._rows, self._positions, self._rereads
+                self._rows, self._positions, self._rereads, self._opened = [], {}, {}, None
+                self._drop(rows, positions, rereads, 'while the PostgreSQL tables are not ready')
+            return
+        rows, positions, rereads = self._rows, self._positions, self._rereads
+        self._rows, self._positions, self._rereads, self._opened = [], {}, {}, None
+        with self._lock:
+            recovered = self._recovered & set(positions)
+            checkpoints = {shard_id: sequence_number for shard_id, sequence_number in positions.items()
+                           if shard_id not in self._unsaved or shard_id in recovered}
+
+        for attempt in range(1, self._max_attempts + 1):
+            start = monotonic()
+            try:
+                with self._connections.connection() as conn:
+                    with conn.cursor() as cur:
+                        if rows:
+                            self._write(cur, rows)
+                        if checkpoints and self._checkpoint is not None:
+                            self._checkpoint(cur, checkpoints)
+                self._transaction_seconds.observe(monotonic() - start)
+                self.stats['transactions'] += 1
+                self.stats['rows'] += len(rows)
+                self._rows_saved.inc(len(rows))
+                self._transaction_rows.observe(len(rows))
+                with self._lock:
+                    self._saved.update(checkpoints)
+                    for shard_id in recovered:
+                        # a later drop is waiting for another read
+                        if rereads[shard_id] > self._unsaved[shard_id][1]:
+                            del self._unsaved[shard_id]
+                            self._recovered.discard(shard_id)
+                if recovered:
+                    logging.info(f'Dropped rows of shards {sorted(recovered)} are saved, checkpointing them again')
+                return
+            except CONNECTION_ERRORS as e:
+                # the broken connection has been dropped from the pool, the next attempt reconnects
+                self.stats['reconnects'] += 1
+                logging.error(f'Lost PostgreSQL connection, attempt {attempt}: {e}')
+            except psycopg2.Error as e:
+                logging.error(f'Error saving data in PostgreSQL, attempt {attempt}: {e}')
+            self._errors.inc()
+            sleep(min(attempt, 5))
+
+        self._drop(rows, positions, rereads, f'after {self._max_attempts} attempts')
+
+    def drop(self, rows: list, reason: str):
+        """ give up a batch that was never added, e.g. one that could not be queued for the writer """
+        shard_id = getattr(rows, 'shard_id', None)
+        if shard_id is None:
+            self._drop(rows, {}, {}, reason)
+        else:
+            self._drop(rows, {shard_id: rows.sequence_number}, {shard_id: rows.rereads}, reason)
+
+    def _drop(self, rows: list, positions: dict, rereads: dict, reason: str):
+        """ give up rows, their shards keep the checkpoint of the last saved rows until they are read again """
+        self.stats['dropped'] += len(rows)
+        self._rows_dropped.inc(len(rows))
+        with self._lock:
+            for shard_id, sequence_number in positions.items():
+                dropped = self._unsaved.get(shard_id)
+                if dropped is not None and int(dropped[0]) > int(sequence_number):
+                    sequence_number = dropped[0]
+                self._unsaved[shard_id] = (sequence_number, rereads[shard_id])
+                self._recovered.discard(shard_id)
+            saved = {shard_id: self._saved.get(shard_id) for shard_id in positions}
+        logging.error(f'Dropping {len(rows)} rows {reason}, holding back the checkpoints of shards {sorted(saved)} '
+                      f'until they are read again')
+        if saved and self._reread is not None:
+            self._reread(saved)
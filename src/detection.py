@@ -0,0 +1,445 @@
+import json
+import numpy as np
+from record_codec import decode_records
+
+# same rule as KINESIS_ANALYTICS_CODE in setup_kinesis_analytics.py
+WARNING_THRESHOLD = 0.5
+ROWS_PRECEDING = 3
+
+NO_WINDOW = np.iinfo(np.int64).min
+
+# STA/LTA trigger, seconds of the short and long term averages of the signal energy,
+# a device triggers when their ratio reaches TRIGGER_ON and is re-armed once it drops below TRIGGER_OFF
+STA_SECONDS = 0.5
+LTA_SECONDS = 30.0
+TRIGGER_ON = 5.0
+TRIGGER_OFF = 1.5
+# seconds of readings of a device before it may trigger
+TRIGGER_WARMUP = 10.0
+# RMS acceleration of the short window below which a device never triggers,
+# keeps dead quiet sensors from triggering on their least significant bit
+TRIGGER_MIN_ACCELERATION = 0.05
+
+# OpenEEW sensors sample at 32 Hz
+SAMPLE_RATE = 32
+
+# seconds of samples up to the trigger in which the AIC picker looks for the onset
+AIC_WINDOW = 2.0
+
+
+def _format_times(seconds: np.ndarray) -> list:
+    """ seconds since epoch as Kinesis Analytics TIMESTAMP strings, e.g. 2020-01-05 04:39:00.000 """
+    return [f'{t[:10]} {t[11:]}.000' for t in np.datetime_as_string(seconds.astype('datetime64[s]'), unit='s')]
+
+
+def _format_millis(sample_t: np.ndarray) -> list:
+    """ epoch seconds as TIMESTAMP strings with milliseconds, e.g. 2020-01-05 04:39:00.125 """
+    millis = np.floor(np.asarray(sample_t, dtype=np.float64) * 1000).astype('datetime64[ms]')
+    return [f'{t[:10]} {t[11:]}' for t in np.datetime_as_string(millis, unit='ms')]
+
+
+class Detector:
+    def __init__(self):
+        """ detection stage: readings of any devices in, rows of DESTINATION_SQL_STREAM_001 (peaks per second)
+            and DESTINATION_SQL_STREAM_002 (warnings) out,
+            per device state lives in NumPy arrays indexed by a device slot, subclasses grow them in _extend
+        """
+        self._slots = {}  # device id -> slot
+        self._device_ids = np.empty(0, dtype=object)  # slot -> device id
+        self.late_samples = 0  # samples older than state the device already moved past
+
+    def process(self, device_ids, sample_t, x, y, z) -> tuple:
+        """ feed a batch of readings, returns (acceleration rows, warning rows) """
+        raise NotImplementedError
+
+    def process_records(self, records: list) -> tuple:
+        """ feed a batch of input stream records, JSON or binary """
+        readings_df = decode_records(records)
+        return self.process(readings_df['device_id'].values,
+                            readings_df['sample_t'].values,
+                            readings_df['x'].values,
+                            readings_df['y'].values,
+                            readings_df['z'].values)
+
+    def flush(self) -> tuple:
+        """ rows still held back, e.g. at the end of a replay """
+        return [], []
+
+    def _extend(self, extra: int):
+        pass
+
+    def _grow(self, capacity: int):
+        extra = capacity - len(self._device_ids)
+        if extra <= 0:
+            return
+        self._device_ids = np.concatenate((self._device_ids, np.empty(extra, dtype=object)))
+        self._extend(extra)
+
+    def _slots_for(self, device_ids: np.ndarray) -> np.ndarray:
+        """ slot of every device id, new devices get the next free slot """
+        slots = np.empty(len(device_ids), dtype=np.int64)
+        for i, device_id in enumerate(device_ids):
+            slot = self._slots.get(device_id)
+            if slot is None:
+                slot = len(self._slots)
+                if slot >= len(self._device_ids):
+                    self._grow(2 * len(self._device_ids))
+                self._slots[device_id] = slot
+                self._device_ids[slot] = str(device_id)
+            slots[i] = slot
+        return slots
+
+    def _slots_of(self, device_ids) -> np.ndarray:
+        unique_ids, inverse = np.unique(np.asarray(device_ids, dtype=object).astype(str), return_inverse=True)
+        return self._slots_for(unique_ids)[inverse.ravel()]
+
+
+class DetectionEngine(Detector):
+    def __init__(self,
+                 threshold: float = WARNING_THRESHOLD,
+                 rows_preceding: int = ROWS_PRECEDING,
+                 capacity: int = 1024):  # devices the state arrays are sized for, grown on demand
+        """ streaming equivalent of the Kinesis Analytics pumps:
+                STREAM_PUMP_001  acceleration = SQRT(y*y + z*z), sample_tt truncated to milliseconds
+                STREAM_PUMP_002  COUNT and MAX acceleration per device and second (STAGGER window),
+                                 rows of DESTINATION_SQL_STREAM_001
+                STREAM_PUMP_003  MIN peak acceleration over the current and 3 preceding rows per device,
+                                 rows >= threshold go to DESTINATION_SQL_STREAM_002
+            the preceding peaks of every device are a ring buffer row of _history
+        """
+        super(DetectionEngine, self).__init__()
+        self._threshold = threshold
+        self._rows_preceding = rows_preceding
+
+        # open per-second window of every device
+        self._open_second = np.empty(0, dtype=np.int64)
+        self._open_count = np.empty(0, dtype=np.int64)
+        self._open_peak = np.empty(0, dtype=np.float64)
+
+        # peaks of the last closed windows, oldest first, +inf where a device has fewer rows
+        self._history = np.empty((0, rows_preceding), dtype=np.float64)
+        self._grow(capacity)
+
+    def _extend(self, extra: int):
+        self._open_second = np.concatenate((self._open_second, np.full(extra, NO_WINDOW, dtype=np.int64)))
+        self._open_count = np.concatenate((self._open_count, np.zeros(extra, dtype=np.int64)))
+        self._open_peak = np.concatenate((self._open_peak, np.full(extra, -np.inf)))
+        self._history = np.concatenate((self._history, np.full((extra, self._rows_preceding), np.inf)))
+
+    def process(self, device_ids, sample_t, x, y, z) -> tuple:
+        """ feed a batch of readings of any devices, in any order within the batch,
+            returns rows of DESTINATION_SQL_STREAM_001 and DESTINATION_SQL_STREAM_002 of the windows it closed,
+            x is not used by the Kinesis Analytics rule
+        """
+        if not len(device_ids):
+            return [], []
+        slots = self._slots_of(device_ids)
+
+        # STREAM_PUMP_001
+        y = np.asarray(y, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+        acceleration = np.sqrt(y * y + z * z)
+        seconds = (np.asarray(sample_t, dtype=np.float64) * 1000).astype(np.int64) // 1000
+
+        order = np.lexsort((seconds, slots))
+        slots, seconds, acceleration = slots[order], seconds[order], acceleration[order]
+
+        late = seconds < self._open_second[slots]
+        if late.any():
+            self.late_samples += int(late.sum())
+            slots, seconds, acceleration = slots[~late], seconds[~late], acceleration[~late]
+            if not len(slots):
+                return [], []
+
+        # STREAM_PUMP_002, 1 group per device and second
+        starts = np.flatnonzero(np.r_[True, (slots[1:] != slots[:-1]) | (seconds[1:] != seconds[:-1])])
+        group_slot = slots[starts]
+        group_second = seconds[starts]
+        group_peak = np.maximum.reduceat(acceleration, starts)
+        group_count = np.diff(np.r_[starts, len(slots)])
+
+        first_of_slot = np.r_[True, group_slot[1:] != group_slot[:-1]]
+        last_of_slot = np.r_[group_slot[1:] != group_slot[:-1], True]
+
+        # the first group of a device may continue its open window
+        open_second = self._open_second[group_slot]
+        merge = group_second == open_second
+        group_peak[merge] = np.maximum(group_peak[merge], self._open_peak[group_slot[merge]])
+        group_count[merge] += self._open_count[group_slot[merge]]
+
+        # windows close when a later second of the same device shows up
+        closing = first_of_slot & ~merge & (open_second != NO_WINDOW)
+        closing_slot = group_slot[closing]
+        closed_slot = np.concatenate((closing_slot, group_slot[~last_of_slot]))
+        closed_second = np.concatenate((self._open_second[closing_slot], group_second[~last_of_slot]))
+        closed_count = np.concatenate((self._open_count[closing_slot], group_count[~last_of_slot]))
+        closed_peak = np.concatenate((self._open_peak[closing_slot], group_peak[~last_of_slot]))
+
+        # the last group of every device stays open
+        open_slot = group_slot[last_of_slot]
+        self._open_second[open_slot] = group_second[last_of_slot]
+        self._open_count[open_slot] = group_count[last_of_slot]
+        self._open_peak[open_slot] = group_peak[last_of_slot]
+
+        order = np.lexsort((closed_second, closed_slot))
+        return self._emit(closed_slot[order], closed_second[order], closed_count[order], closed_peak[order])
+
+    def flush(self) -> tuple:
+        """ close the open window of every device, e.g. at the end of a replay """
+        slots = np.flatnonzero(self._open_second[:len(self._slots)] != NO_WINDOW)
+        rows = self._emit(slots, self._open_second[slots], self._open_count[slots], self._open_peak[slots])
+        self._open_second[slots] = NO_WINDOW
+        self._open_count[slots] = 0
+        self._open_peak[slots] = -np.inf
+        return rows
+
+    def _emit(self, slots: np.ndarray, seconds: np.ndarray, counts: np.ndarray, peaks: np.ndarray) -> tuple:
+        """ rows of both destination streams for closed windows ordered by device and second """
+        if not len(slots):
+            return [], []
+
+        # STREAM_PUMP_003, each device's history is placed in front of its new peaks,
+        # so the sliding MIN never reaches into another device
+        w = self._rows_preceding
+        segment_start = np.r_[True, slots[1:] != slots[:-1]]
+        segment_slots = slots[segment_start]
+        segment = np.cumsum(segment_start) - 1
+        positions = np.arange(len(slots)) + w * (segment + 1)
+
+        combined = np.empty(len(slots) + w * len(segment_slots))
+        combined[positions] = peaks
+        history_positions = (np.flatnonzero(segment_start) + w * np.arange(len(segment_slots)))[:, None] + np.arange(w)
+        combined[history_positions] = self._history[segment_slots]
+
+        warning_accel = peaks.copy()
+        for j in range(1, w + 1):
+            warning_accel = np.minimum(warning_accel, combined[positions - j])
+
+        # keep the last w peaks of every device
+        segment_ends = positions[np.r_[np.flatnonzero(segment_start)[1:], len(slots)] - 1] + 1
+        self._history[segment_slots] = combined[segment_ends[:, None] - w + np.arange(w)]
+
+        device_ids = self._device_ids[slots]
+        times = _format_times(seconds)
+        accel_rows = [{'DEVICE_ID': device_id,
+                       'COUNT_ACCEL': int(count),
+                       'PEAK_ACCELERATION': float(peak),
+                       'ACCELERATION_TIME': time}
+                      for device_id, count, peak, time in zip(device_ids, counts, peaks, times)]
+
+        warning = np.flatnonzero(warning_accel >= self._threshold)
+        warning_rows = [{'DEVICE_ID': device_ids[i],
+                         'WARNING_ACCELERATION': float(warning_accel[i]),
+                         'WARNING_TIME': times[i]}
+                        for i in warning]
+        return accel_rows, warning_rows
+
+
+class StaLtaDetector(Detector):
+    def __init__(self,
+                 sta: float = STA_SECONDS,
+                 lta: float = LTA_SECONDS,
+                 trigger_on: float = TRIGGER_ON,
+                 trigger_off: float = TRIGGER_OFF,
+                 warmup: float = TRIGGER_WARMUP,
+                 min_acceleration: float = TRIGGER_MIN_ACCELERATION,
+                 sample_rate: float = SAMPLE_RATE,
+                 peaks: bool = True,     # per second peaks of DESTINATION_SQL_STREAM_001 from DetectionEngine
+                 capacity: int = 1024):  # devices the state arrays are sized for, grown on demand
+        """ recursive short term / long term average trigger of every device on its raw samples:
+                the offset of every component, e.g. gravity, follows the long term average and is removed,
+                the energy x*x + y*y + z*z of what remains is averaged over sta and lta seconds,
+                a device triggers when sta / lta reaches trigger_on, as lta follows the noise of its site,
+                quiet and noisy sites get a threshold of their own, it is re-armed below trigger_off
+            1 warning row per trigger, WARNING_TIME is the sample_t of the trigger in milliseconds,
+            WARNING_ACCELERATION the RMS acceleration of the short window,
+            all devices of a batch advance together, 1 NumPy step per sample position of a device
+        """
+        super(StaLtaDetector, self).__init__()
+        # weight of a new sample in the exponential averages
+        self._sta_alpha = 1 - np.exp(-1 / (sta * sample_rate))
+        self._lta_alpha = 1 - np.exp(-1 / (lta * sample_rate))
+        self._trigger_on = trigger_on
+        self._trigger_off = trigger_off
+        self._warmup_samples = warmup * sample_rate
+        self._min_energy = min_acceleration ** 2
+        self._peaks = DetectionEngine(capacity=capacity) if peaks else None
+
+        self._offset = np.empty((0, 3), dtype=np.float64)
+        self._sta = np.empty(0, dtype=np.float64)
+        self._lta = np.empty(0, dtype=np.float64)
+        self._seen = np.empty(0, dtype=np.int64)  # samples of the device so far
+        self._triggered = np.empty(0, dtype=bool)
+        self._last_t = np.empty(0, dtype=np.float64)  # sample_t of the last processed sample
+        self._grow(capacity)
+
+        self.triggers = 0
+
+    def _extend(self, extra: int):
+        self._offset = np.concatenate((self._offset, np.zeros((extra, 3))))
+        self._sta = np.concatenate((self._sta, np.zeros(extra)))
+        self._lta = np.concatenate((self._lta, np.zeros(extra)))
+        self._seen = np.concatenate((self._seen, np.zeros(extra, dtype=np.int64)))
+        self._triggered = np.concatenate((self._triggered, np.zeros(extra, dtype=bool)))
+        self._last_t = np.concatenate((self._last_t, np.full(extra, -np.inf)))
+
+    def process(self, device_ids, sample_t, x, y, z) -> tuple:
+        """ feed a batch of readings of any devices, samples of a device have to arrive in time order
+            across batches, within a batch any order is fine
+        """
+        accel_rows = self._peaks.process(device_ids, sample_t, x, y, z)[0] if self._peaks is not None else []
+        if not len(device_ids):
+            return accel_rows, []
+        slots = self._slots_of(device_ids)
+        sample_t = np.asarray(sample_t, dtype=np.float64)
+        readings = np.column_stack((x, y, z)).astype(np.float64)
+
+        order = np.lexsort((sample_t, slots))
+        slots, sample_t, readings = slots[order], sample_t[order], readings[order]
+
+        # samples at or before the last processed sample of their device are duplicates or late
+        fresh = sample_t > self._last_t[slots]
+        if not fresh.all():
+            self.late_samples += int((~fresh).sum())
+            slots, sample_t, readings = slots[fresh], sample_t[fresh], readings[fresh]
+            if not len(slots):
+                return accel_rows, []
+
+        # position of every sample among the samples of its device in this batch
+        starts = np.flatnonzero(np.r_[True, slots[1:] != slots[:-1]])
+        counts = np.diff(np.r_[starts, len(slots)])
+        rank = np.arange(len(slots)) - np.repeat(starts, counts)
+        self._last_t[slots[starts]] = sample_t[starts + counts - 1]
+
+        # the offset of a new device starts at its first sample instead of 0
+        new = self._seen[slots[starts]] == 0
+        self._offset[slots[starts[new]]] = readings[starts[new]]
+
+        by_rank = np.argsort(rank, kind='stable')
+        ends = np.cumsum(np.bincount(rank))
+        warning_rows = []
+        for begin, end in zip(np.r_[0, ends[:-1]], ends):
+            i = by_rank[begin:end]
+            device = slots[i]
+            signal = readings[i] - self._offset[device]
+            self._record(device, sample_t[i], signal)
+            self._offset[device] += self._lta_alpha * signal
+            energy = np.einsum('ij,ij->i', signal, signal)
+            sta = self._sta[device] + self._sta_alpha * (energy - self._sta[device])
+            lta = self._lta[device] + self._lta_alpha * (energy - self._lta[device])
+            seen = self._seen[device] + 1
+            self._sta[device], self._lta[device], self._seen[device] = sta, lta, seen
+
+            # averages that started at 0 are scaled up by the weight they are still missing
+            sta = sta / (1 - (1 - self._sta_alpha) ** seen)
+            ratio = sta * (1 - (1 - self._lta_alpha) ** seen) / np.maximum(lta, np.finfo(np.float64).tiny)
+
+            was_triggered = self._triggered[device]
+            on = ~was_triggered & (ratio >= self._trigger_on) & (seen >= self._warmup_samples) & \
+                (sta >= self._min_energy)
+            off = was_triggered & (ratio < self._trigger_off)
+            self._triggered[device] = (was_triggered | on) & ~off
+            if on.any():
+                self.triggers += int(on.sum())
+                warning_rows += self._trigger(device[on], sample_t[i[on]], np.sqrt(sta[on]))
+        return accel_rows, warning_rows
+
+    def _record(self, slots: np.ndarray, sample_t: np.ndarray, signal: np.ndarray):
+        """ called with the offset free sample of every device before the trigger is checked """
+        pass
+
+    def _trigger(self, slots: np.ndarray, sample_t: np.ndarray, rms: np.ndarray) -> list:
+        """ warning rows of the devices that triggered at sample_t """
+        return [{'DEVICE_ID': device_id,
+                 'WARNING_ACCELERATION': float(acceleration),
+                 'WARNING_TIME': time}
+                for device_id, acceleration, time in zip(self._device_ids[slots], rms, _format_millis(sample_t))]
+
+    def flush(self) -> tuple:
+        return (self._peaks.flush()[0] if self._peaks is not None else []), []
+
+
+def aic_onsets(window: np.ndarray) -> np.ndarray:
+    """ index of the first sample after the onset in every trace of window (traces, samples, components),
+        the split k minimizing k log(var(samples before k)) + (n - k - 1) log(var(samples from k)),
+        variances summed over components, at least 2 samples on either side
+    """
+    n = window.shape[1]
+    cumulative = np.cumsum(window, axis=1)
+    cumulative_squares = np.cumsum(window * window, axis=1)
+    k = np.arange(1, n)
+
+    before, before_squares = cumulative[:, :-1], cumulative_squares[:, :-1]
+    after, after_squares = cumulative[:, -1:] - before, cumulative_squares[:, -1:] - before_squares
+    n_before, n_after = k[None, :, None], (n - k)[None, :, None]
+    var_before = (before_squares / n_before - (before / n_before) ** 2).sum(axis=2)
+    var_after = (after_squares / n_after - (after / n_after) ** 2).sum(axis=2)
+
+    tiny = np.finfo(np.float64).tiny
+    aic = k * np.log(np.maximum(var_before, tiny)) + (n - k - 1) * np.log(np.maximum(var_after, tiny))
+    return np.argmin(aic[:, 1:-1], axis=1) + 2
+
+
+class PWavePicker(StaLtaDetector):
+    def __init__(self,
+                 aic_window: float = AIC_WINDOW,
+                 sample_rate: float = SAMPLE_RATE,
+                 capacity: int = 1024,
+                 **kwargs):  # trigger settings of StaLtaDetector
+        """ StaLtaDetector trigger refined to the onset sample with the Akaike information criterion
+            over the last aic_window seconds of offset free samples up to the trigger, see aic_onsets,
+            a pick comes out of the batch that triggers, e.g. 1 binary record of 32 samples, no window has to close,
+            picks have the warning schema with WARNING_TIME at the onset in milliseconds, plus TRIGGER_TIME
+        """
+        self._window = max(int(round(aic_window * sample_rate)), 5)
+        # last samples of every device, a ring buffer row each, _head is the next position to write
+        self._buffer = np.empty((0, self._window, 3), dtype=np.float64)
+        self._buffer_t = np.empty((0, self._window), dtype=np.float64)
+        self._head = np.empty(0, dtype=np.int64)
+        super(PWavePicker, self).__init__(sample_rate=sample_rate, peaks=False, capacity=capacity, **kwargs)
+        # the window is full before a device may trigger
+        self._warmup_samples = max(self._warmup_samples, self._window)
+
+    def _extend(self, extra: int):
+        super(PWavePicker, self)._extend(extra)
+        self._buffer = np.concatenate((self._buffer, np.zeros((extra, self._window, 3))))
+        self._buffer_t = np.concatenate((self._buffer_t, np.zeros((extra, self._window))))
+        self._head = np.concatenate((self._head, np.zeros(extra, dtype=np.int64)))
+
+    def _record(self, slots: np.ndarray, sample_t: np.ndarray, signal: np.ndarray):
+        head = self._head[slots]
+        self._buffer[slots, head] = signal
+        self._buffer_t[slots, head] = sample_t
+        self._head[slots] = (head + 1) % self._window
+
+    def _trigger(self, slots: np.ndarray, sample_t: np.ndarray, rms: np.ndarray) -> list:
+        # oldest sample first, the trigger sample is the last one
+        order = (self._head[slots][:, None] + np.arange(self._window)) % self._window
+        onsets = aic_onsets(self._buffer[slots[:, None], order])
+        onset_t = self._buffer_t[slots[:, None], order][np.arange(len(slots)), onsets]
+        return [{'DEVICE_ID': device_id,
+                 'WARNING_ACCELERATION': float(acceleration),
+                 'WARNING_TIME': onset,
+                 'TRIGGER_TIME': trigger}
+                for device_id, acceleration, onset, trigger in zip(self._device_ids[slots],
+                                                                   rms,
+                                                                   _format_millis(onset_t),
+                                                                   _format_millis(sample_t))]
+
+
+# detectors of the streaming stage by name, see create_detector
+DETECTORS = {'peak': DetectionEngine, 'sta_lta': StaLtaDetector, 'p_wave': PWavePicker}
+
+
+def create_detector(name: str = 'peak', **kwargs) -> Detector:
+    """ peak: the Kinesis Analytics rule, sta_lta: StaLtaDetector on the raw samples,
+        p_wave: PWavePicker, sta_lta refined to the onset sample
+    """
+    if name not in DETECTORS:
+        raise ValueError(f'Detector must be one of {", ".join(DETECTORS)}, not {name}')
+    return DETECTORS[name](**kwargs)
+
+
+def to_kinesis_records(rows: list) -> list:
+    """ rows shaped like Kinesis records of the output streams, as read by StreamConsumer """
+    return [{'Data': json.dumps(row)} for row in rows]
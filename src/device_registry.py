@@ -0,0 +1,134 @@
+import json
+import logging
+import threading
+from datetime import datetime
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.2
+
+# seconds between attempts of the first load
+LOAD_RETRY_INTERVAL = 5
+
+
+def haversine_km(latitude: float, longitude: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """ great-circle distances from 1 point to arrays of points, all in degrees """
+    lat1, lon1 = np.radians(latitude), np.radians(longitude)
+    lat2, lon2 = np.radians(latitudes), np.radians(longitudes)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialGrid:
+    def __init__(self, latitudes: np.ndarray, longitudes: np.ndarray, cell_degrees: float = 0.25):
+        """ uniform latitude/longitude grid over device positions, cell -> positions of the devices in it """
+        self._cell_degrees = cell_degrees
+        self._cells = {}
+        rows = np.floor(latitudes / cell_degrees).astype(np.int64)
+        cols = np.floor(longitudes / cell_degrees).astype(np.int64)
+        for i, cell in enumerate(zip(rows.tolist(), cols.tolist())):
+            self._cells.setdefault(cell, []).append(i)
+        self._cells = {cell: np.array(positions) for cell, positions in self._cells.items()}
+
+    def candidates(self, latitude: float, longitude: float, radius_km: float) -> np.ndarray:
+        """ positions of devices in the cells overlapping the bounding box of the radius """
+        lat_degrees = radius_km / KM_PER_DEGREE
+        lon_degrees = radius_km / (KM_PER_DEGREE * max(np.cos(np.radians(latitude)), 0.01))
+        row_min, row_max = (int(np.floor((latitude + sign * lat_degrees) / self._cell_degrees)) for sign in (-1, 1))
+        col_min, col_max = (int(np.floor((longitude + sign * lon_degrees) / self._cell_degrees)) for sign in (-1, 1))
+
+        found = [self._cells[(row, col)]
+                 for row in range(row_min, row_max + 1)
+                 for col in range(col_min, col_max + 1)
+                 if (row, col) in self._cells]
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+
+class DeviceRegistry:
+    def __init__(self,
+                 country: str = 'mx',
+                 as_of: str = None,          # UTC date of the device metadata, None = now
+                 ttl: float = 3600,          # seconds between background refreshes
+                 devices_file: str = None):  # JSON list of device_id, latitude, longitude read instead of S3
+        """ device metadata loaded once and refreshed in the background,
+            lookups by device id are dict lookups, radius queries go through a spatial grid
+        """
+        self._country = country
+        self._as_of = as_of
+        self._ttl = ttl
+        self._devices_file = devices_file
+
+        # device id -> location, arrays and grid for distance queries, swapped as 1 snapshot on refresh
+        self._snapshot = ({}, np.empty(0, dtype=object), np.empty(0), np.empty(0),
+                          SpatialGrid(np.empty(0), np.empty(0)))
+        self._stopped = threading.Event()
+        self._loaded = threading.Event()
+
+    def load(self):
+        """ read device metadata from S3 using OpenEEW API, or from the local devices file """
+        as_of = self._as_of or datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        if self._devices_file:
+            with open(self._devices_file) as f:
+                devices = json.load(f)
+        else:
+            # imported here, openeew is only needed once the first lookup needs locations
+            from openeew.data.aws import AwsDataClient
+            devices = AwsDataClient(self._country).get_devices_as_of_date(as_of)
+
+        locations = {device['device_id']: {'latitude': device['latitude'], 'longitude': device['longitude']}
+                     for device in devices}
+        device_ids = np.array(list(locations), dtype=object)
+        latitudes = np.array([location['latitude'] for location in locations.values()], dtype=np.float64)
+        longitudes = np.array([location['longitude'] for location in locations.values()], dtype=np.float64)
+        self._snapshot = (locations, device_ids, latitudes, longitudes, SpatialGrid(latitudes, longitudes))
+        self._loaded.set()
+        logging.info(f'Loaded {len(locations)} devices of {self._country} as of {as_of}')
+
+    def start(self):
+        """ load and refresh every ttl seconds in the background, lookups are empty until the first load """
+        threading.Thread(target=self._refresh, name='device-registry', daemon=True).start()
+
+    def wait_loaded(self, timeout: float = None) -> bool:
+        """ wait for the first load, True once device metadata is available """
+        return self._loaded.wait(timeout)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _refresh(self):
+        """ first load right away and retried until it succeeds, then a refresh every ttl seconds """
+        delay = 0
+        while not self._stopped.wait(delay):
+            try:
+                self.load()
+            except Exception as generic:
+                # keep answering from the previous snapshot
+                logging.error(f'Error refreshing device metadata: {generic}')
+            delay = self._ttl if self._loaded.is_set() else LOAD_RETRY_INTERVAL
+
+    def __len__(self) -> int:
+        return len(self._snapshot[0])
+
+    def location(self, device_id: str) -> dict:
+        """ latitude and longitude of a device, empty if it is unknown """
+        return self._snapshot[0].get(device_id, {})
+
+    def nearest(self, latitude: float, longitude: float, count: int = 1) -> list:
+        """ (device id, distance in km) of the closest devices, closest first """
+        _, device_ids, latitudes, longitudes, _ = self._snapshot
+        if not len(device_ids):
+            return []
+        distances = haversine_km(latitude, longitude, latitudes, longitudes)
+        count = min(count, len(distances))
+        closest = np.argpartition(distances, count - 1)[:count]
+        closest = closest[np.argsort(distances[closest])]
+        return [(device_ids[i], float(distances[i])) for i in closest]
+
+    def within_radius(self, latitude: float, longitude: float, radius_km: float) -> list:
+        """ (device id, distance in km) of all devices within radius_km, closest first """
+        _, device_ids, latitudes, longitudes, grid = self._snapshot
+        candidates = grid.candidates(latitude, longitude, radius_km)
+        distances = haversine_km(latitude, longitude, latitudes[candidates], longitudes[candidates])
+        inside = np.flatnonzero(distances <= radius_km)
+        inside = inside[np.argsort(distances[inside])]
+        return [(device_ids[candidates[i]], float(distances[i])) for i in inside]
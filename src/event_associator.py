@@ -0,0 +1,158 @@
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from device_registry import DeviceRegistry, haversine_km
+
+
+def warning_timestamp(warning_time: str) -> float:
+    """ epoch seconds of a WARNING_TIME like 2020-01-05 04:39:00.000, milliseconds included """
+    seconds = datetime.strptime(warning_time[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    return seconds + float(warning_time[19:] or 0)
+
+
+class Event:
+    def __init__(self, event_id: int):
+        """ warnings of several devices attributed to the same shaking """
+        self.event_id = event_id
+        self.warnings = {}  # device id -> (time, acceleration, warning row) of its first warning
+        self.latitude = 0.0
+        self.longitude = 0.0
+        self.first_time = None
+        self.last_time = None
+        self.published = False
+
+    def add(self, device_id: str, time: float, acceleration: float, location: dict, row: dict):
+        if device_id in self.warnings:
+            return
+        self.warnings[device_id] = (time, acceleration, row)
+        # running centroid of the triggered devices
+        n = len(self.warnings)
+        self.latitude += (location['latitude'] - self.latitude) / n
+        self.longitude += (location['longitude'] - self.longitude) / n
+        self.first_time = time if self.first_time is None else min(self.first_time, time)
+        self.last_time = time if self.last_time is None else max(self.last_time, time)
+
+    @property
+    def first_warning(self) -> dict:
+        """ warning row of the device triggered first, usually the closest to the epicenter """
+        return min(self.warnings.values(), key=lambda warning: warning[0])[2]
+
+    @property
+    def peak_acceleration(self) -> float:
+        return max(acceleration for _, acceleration, _ in self.warnings.values())
+
+    def __len__(self) -> int:
+        return len(self.warnings)
+
+
+class EventAssociator:
+    def __init__(self,
+                 devices: DeviceRegistry,
+                 min_stations: int = 3,       # devices that must agree before an event is published
+                 radius_km: float = 50.0,     # distance between a device and its neighbours or the event centroid
+                 window: float = 10.0,        # seconds within which warnings of the same event arrive
+                 event_expiry: float = 60.0):  # seconds after its last warning an event is closed
+        """ cluster warnings by time and space, 1 alert per event once min_stations nearby devices agree,
+            times are warning times so replayed data associates like live data
+        """
+        self._devices = devices
+        self._min_stations = min_stations
+        self._radius_km = radius_km
+        self._window = window
+        self._event_expiry = event_expiry
+
+        self._pending = {}      # device id -> (time, acceleration, row, location) of unassociated warnings
+        self._expiry = deque()  # (time, device id) of pending warnings, oldest first
+        self._events = []
+        self._event_of = {}     # device id -> open event it belongs to
+        self._next_event_id = 1
+        self._now = 0.0
+
+        self.stats = {'warnings': 0, 'unknown_devices': 0, 'events': 0, 'published': 0}
+
+    def add(self, rows: list) -> list:
+        """ associate a batch of warning rows, returns the events that reached min_stations with it """
+        ready = []
+        for row in rows:
+            event = self._associate(row)
+            if event is not None and not event.published and len(event) >= self._min_stations:
+                event.published = True
+                self.stats['published'] += 1
+                ready.append(event)
+        return ready
+
+    def _associate(self, row: dict):
+        self.stats['warnings'] += 1
+        device_id = row.get('DEVICE_ID')
+        if device_id in self._event_of:
+            return None
+
+        location = self._devices.location(device_id)
+        if not location:
+            self.stats['unknown_devices'] += 1
+            return None
+
+        time = warning_timestamp(row.get('WARNING_TIME'))
+        acceleration = float(row.get('WARNING_ACCELERATION') or 0.0)
+        self._expire(time)
+
+        event = self._nearby_event(time, location)
+        if event is None:
+            event = self._new_event(device_id, time, location)
+        if event is None:
+            # no neighbour agrees yet, wait for one within the window
+            if device_id not in self._pending:
+                self._pending[device_id] = (time, acceleration, row, location)
+                self._expiry.append((time, device_id))
+            return None
+
+        self._pending.pop(device_id, None)
+        event.add(device_id, time, acceleration, location, row)
+        self._event_of[device_id] = event
+        return event
+
+    def _nearby_event(self, time: float, location: dict):
+        """ open event whose centroid is within radius and whose last warning is within the window """
+        for event in self._events:
+            if time - event.last_time <= self._window and \
+                    haversine_km(location['latitude'], location['longitude'],
+                                 event.latitude, event.longitude) <= self._radius_km:
+                return event
+        return None
+
+    def _new_event(self, device_id: str, time: float, location: dict):
+        """ event of a device and the pending warnings of its neighbours, None without neighbours """
+        neighbours = [neighbour for neighbour, _ in
+                      self._devices.within_radius(location['latitude'], location['longitude'], self._radius_km)
+                      if neighbour != device_id and neighbour in self._pending and
+                      abs(time - self._pending[neighbour][0]) <= self._window]
+        if not neighbours and self._min_stations > 1:
+            return None
+
+        event = Event(self._next_event_id)
+        self._next_event_id += 1
+        self._events.append(event)
+        self.stats['events'] += 1
+        for neighbour in neighbours:
+            neighbour_time, acceleration, row, neighbour_location = self._pending.pop(neighbour)
+            event.add(neighbour, neighbour_time, acceleration, neighbour_location, row)
+            self._event_of[neighbour] = event
+        return event
+
+    def _expire(self, time: float):
+        """ drop pending warnings older than the window and close events older than their expiry """
+        self._now = max(self._now, time)
+        while self._expiry and self._now - self._expiry[0][0] > self._window:
+            expired_time, device_id = self._expiry.popleft()
+            pending = self._pending.get(device_id)
+            if pending is not None and pending[0] == expired_time:
+                del self._pending[device_id]
+
+        if any(self._now - event.last_time > self._event_expiry for event in self._events):
+            closed = [event for event in self._events if self._now - event.last_time > self._event_expiry]
+            self._events = [event for event in self._events if self._now - event.last_time <= self._event_expiry]
+            for event in closed:
+                for device_id in event.warnings:
+                    self._event_of.pop(device_id, None)
+                logging.info(f'Closed event {event.event_id} with {len(event)} devices, '
+                             f'published: {event.published}')
@@ -0,0 +1,231 @@
+"""
+counters, gauges and histograms of producer and consumer in the Prometheus text format,
+start_http_server serves them on http://<addr>:<port>/metrics, METRICS_PORT enables it in the scripts,
+metrics are created once per process, modules asking for the same name share it
+"""
+
+import math
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, AWS and PostgreSQL calls
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# records or rows per call
+SIZE_BUCKETS = (1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# seconds from the warning window start to the alert
+ALERT_LATENCY_BUCKETS = (0.25, 0.5, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    if value != value:
+        return 'NaN'
+    return repr(float(value))
+
+
+def _escape(text: str) -> str:
+    return text.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class CounterValue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0.0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def samples(self, name: str, labels: str) -> list:
+        return [f'{name}_total{labels} {_format_value(self._value)}']
+
+
+class GaugeValue:
+    def __init__(self):
+        self._value = 0.0
+
+    def set(self, value: float):
+        # a single assignment, no lock needed
+        self._value = value
+
+    def samples(self, name: str, labels: str) -> list:
+        return [f'{name}{labels} {_format_value(self._value)}']
+
+
+class HistogramValue:
+    def __init__(self, buckets: tuple):
+        self._lock = threading.Lock()
+        self._upper_bounds = list(buckets)
+        self._counts = [0] * (len(buckets) + 1)  # the last bucket is +Inf
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def samples(self, name: str, labels: str) -> list:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        # bucket labels go after the labels of the metric
+        prefix = labels[:-1] + ',' if labels else '{'
+        samples = []
+        cumulative = 0
+        for upper_bound, count in zip(self._upper_bounds + [math.inf], counts):
+            cumulative += count
+            samples.append(f'{name}_bucket{prefix}le="{_format_value(upper_bound)}"}} {cumulative}')
+        samples.append(f'{name}_sum{labels} {_format_value(total)}')
+        samples.append(f'{name}_count{labels} {cumulative}')
+        return samples
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), **kwargs):
+        """ 1 metric, a value per combination of label values,
+            hot paths keep the value returned by labels() instead of looking it up every time
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._values = {}
+        if not self.labelnames:
+            self._value = self.labels()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} has labels {self.labelnames}, got {values}')
+        key = tuple(str(value) for value in values)
+        value = self._values.get(key)
+        if value is None:
+            with self._lock:
+                value = self._values.setdefault(key, self._new_value())
+        return value
+
+    def expose(self) -> list:
+        lines = [f'# HELP {self.name} {_escape_help(self.documentation)}',
+                 f'# TYPE {self.name} {self.type}']
+        for key, value in sorted(self._values.items()):
+            lines.extend(value.samples(self.name, _format_labels(self.labelnames, key)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_value(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        self._value.inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_value(self) -> GaugeValue:
+        return GaugeValue()
+
+    def set(self, value: float):
+        self._value.set(value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def _new_value(self) -> HistogramValue:
+        return HistogramValue(self._kwargs.get('buckets', LATENCY_BUCKETS))
+
+    def observe(self, value: float):
+        self._value.observe(value)
+
+
+class Registry:
+    def __init__(self):
+        """ metrics of the process by name """
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def get_or_create(self, metric_class, name: str, documentation: str, labelnames: tuple = (), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, documentation, labelnames, **kwargs)
+            elif type(metric) is not metric_class or metric.labelnames != tuple(labelnames):
+                raise ValueError(f'Metric {name} already exists as a {metric.type} with labels {metric.labelnames}')
+            return metric
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return ''.join(line + '\n' for metric in metrics for line in metric.expose())
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    """ name without the _total suffix, it is added on exposition """
+    return REGISTRY.get_or_create(Counter, name, documentation, labelnames)
+
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+    return REGISTRY.get_or_create(Gauge, name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.get_or_create(Histogram, name, documentation, labelnames, buckets=tuple(sorted(buckets)))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood the log
+        pass
+
+
+def start_http_server(port: int, addr: str = '') -> ThreadingHTTPServer:
+    """ serve the metrics of this process in a background thread, port 0 picks a free port """
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f'Serving metrics on http://{addr or "0.0.0.0"}:{server.server_address[1]}/metrics')
+    return server
@@ -0,0 +1,95 @@
+import queue
+import logging
+import threading
+from time import monotonic
+
+
+class Batch(list):
+    def __init__(self, rows: list = (), shard_id: str = None, sequence_number: str = None,
+                 rereads: int = 0):  # times the shard was read again from its checkpoint before this read
+        """ rows of 1 shard read, with the sequence number of its last record as the read position """
+        super(Batch, self).__init__(rows)
+        self.shard_id = shard_id
+        self.sequence_number = sequence_number
+        self.rereads = rereads
+
+
+class StageMetrics:
+    def __init__(self):
+        """ throughput of 1 stage, rates are per second since the last report """
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._records = 0
+        self._busy = 0.0
+        self._since = monotonic()
+
+    def update(self, num_records: int, busy: float):
+        with self._lock:
+            self._batches += 1
+            self._records += num_records
+            self._busy += busy
+
+    def report(self) -> dict:
+        with self._lock:
+            now = monotonic()
+            elapsed = max(now - self._since, 1e-9)
+            metrics = {'batches_per_s': round(self._batches / elapsed, 2),
+                       'records_per_s': round(self._records / elapsed, 1),
+                       'utilization': round(self._busy / elapsed, 3)}
+            self._batches, self._records, self._busy, self._since = 0, 0, 0.0, now
+        return metrics
+
+
+class Stage:
+    def __init__(self, name: str, handler, inbox_size: int = 16, on_idle=None, idle_interval: float = 0.1):
+        """ worker thread applying handler to every batch of its bounded inbox,
+            a full inbox blocks the stage in front of it (backpressure),
+            on_idle is called every idle_interval seconds without a batch, e.g. to flush by time
+        """
+        self.name = name
+        self._handler = handler
+        self._on_idle = on_idle
+        self._idle_interval = idle_interval
+        self.inbox = queue.Queue(maxsize=inbox_size)
+        self.metrics = StageMetrics()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, batch: list):
+        """ hand a batch to this stage, waits while the inbox is full """
+        self.inbox.put(batch)
+
+    def offer(self, batch: list) -> bool:
+        """ hand a batch to this stage if its inbox has room, never waits """
+        try:
+            self.inbox.put_nowait(batch)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        while True:
+            if self._on_idle is None:
+                batch = self.inbox.get()
+            else:
+                try:
+                    batch = self.inbox.get(timeout=self._idle_interval)
+                except queue.Empty:
+                    try:
+                        self._on_idle()
+                    except Exception as generic:
+                        logging.error(f'Error in {self.name} stage: {generic}')
+                    continue
+            start = monotonic()
+            try:
+                self._handler(batch)
+            except Exception as generic:
+                logging.error(f'Error in {self.name} stage: {generic}')
+            self.metrics.update(len(batch), monotonic() - start)
+
+    def report(self) -> dict:
+        metrics = self.metrics.report()
+        metrics['queue_depth'] = self.inbox.qsize()
+        return metrics
@@ -1,61 +1,149 @@
 import sys
 import os
-import json
 import logging
+import queue
+import threading
+import numpy as np
 import pandas as pd
-from time import sleep
+from time import time, sleep, monotonic
 from datetime import datetime, timedelta
 from openeew.data.aws import AwsDataClient
 from openeew.data.df import get_df_from_records
-import boto3
+import transport
+import metrics
 from configparser import ConfigParser
+from batcher import KinesisBatcher, RECORDS_SENT, PUT_SECONDS
+from record_cache import RecordCache
+from record_codec import encode_interval
 
-config = ConfigParser()
-config.read_file(open('kinesis.cfg'))
-INPUT_STREAM = config.get('KINESIS', 'input_stream')
+READINGS_REPLAYED = metrics.counter('eew_producer_readings_replayed', 'Sensor readings encoded and sent to Kinesis')
+REPLAY_LAG = metrics.gauge('eew_producer_replay_lag_seconds', 'Seconds the last slice was released behind schedule')
+PRODUCER_ERRORS = metrics.counter('eew_producer_errors', 'Intervals that failed to be read or sent', ['operation'])
+
+
+class ReplayScheduler:
+    def __init__(self,
+                 speed: float = 1.0,           # 1 = real time, 10 = 10x faster, 0 = as fast as possible
+                 slice_duration: float = 0.25):  # seconds of sensor time released together
+        """ release readings by their sample_t relative to a wall-clock anchor,
+            the anchor is set by the first reading, so sending time never adds up across slices
+        """
+        self._speed = speed
+        self._slice_duration = slice_duration
+        self._wall_anchor = None
+        self._data_anchor = None
+
+        self.lag = 0.0  # seconds the last slice was released behind the target timeline
+        self.max_lag = 0.0
+        self.clock_offset = None  # wall-clock epoch minus sample_t at the anchor, maps replayed times to now
+
+    def slices(self, sample_t: np.ndarray, wait=sleep):
+        """ yield (start, stop) positions of sorted sample_t for every time slice once it is due,
+            wait(seconds) passes the time until then, e.g. KinesisBatcher.wait sending lingering records
+        """
+        if not len(sample_t):
+            return
+
+        if self._data_anchor is None:
+            self._data_anchor = sample_t[0]
+            self._wall_anchor = monotonic()
+            self.clock_offset = time() - self._data_anchor
+
+        slice_ids = np.floor((sample_t - self._data_anchor) / self._slice_duration)
+        boundaries = np.flatnonzero(np.diff(slice_ids)) + 1
+        starts = np.concatenate(([0], boundaries))
+        stops = np.concatenate((boundaries, [len(sample_t)]))
+
+        for start, stop in zip(starts, stops):
+            if self._speed > 0:
+                # a slice is due once its last reading has been sampled
+                target = self._wall_anchor + (slice_ids[start] + 1) * self._slice_duration / self._speed
+                now = monotonic()
+                if now < target:
+                    wait(target - now)
+                    self.lag = 0.0
+                else:
+                    self.lag = now - target
+                    self.max_lag = max(self.max_lag, self.lag)
+            yield start, stop
 
 
 class StreamProducer:
     def __init__(self,
-                 docker_device_id,
+                 device_ids,  # 1 device id, comma separated device ids or a list of them
                  country='mx',
                  stream_name='InputReadings',
                  start_date=datetime(2020, 1, 5, 4, 39, 0),
                  end_date=datetime(2020, 2, 5, 4, 40, 0),
                  kinesis_produce_many=False,
-                 kinesis_batch_size=20,
-                 reading_frequency=64,  # sensor readings per second
-                 reading_interval=30):  # reading raw data from S3
+                 kinesis_batch_size=500,
+                 kinesis_linger_time=0.5,  # seconds before a partial batch is sent
+                 replay_speed=1.0,  # 1 = sensor speed, 0 = as fast as possible
+                 replay_slice=0.25,  # seconds of readings sent together
+                 reading_interval=30,  # reading raw data from S3
+                 prefetch_intervals=0,  # intervals read ahead while sending, 0 = sequential
+                 record_cache: RecordCache = None,  # local copy of S3 records, None = always read S3
+                 record_format='json',  # 'json' = 1 reading per record, 'binary' = many readings per record
+                 readings_per_record=32):  # readings of 1 device packed into 1 binary record
         """ initialize Kinesis as consumer input,
             SNS as alert publishing system,
             PostgreSQL as output storage system
         """
-        self._docker_device_id = docker_device_id
+        if isinstance(device_ids, str):
+            device_ids = device_ids.split(',')
+        self._device_ids = list(device_ids)
         self._stream_name = stream_name
 
         self._start_date = start_date
         self._end_date = end_date
-        self._sleep_time = 1 / reading_frequency if reading_frequency > 0 else 1/32
+        self._scheduler = ReplayScheduler(replay_speed, replay_slice)
         self._interval = timedelta(seconds=reading_interval)
+        self._prefetch_intervals = prefetch_intervals
+
+        self._record_format = record_format
+        self._readings_per_record = readings_per_record
 
         self._kinesis_produce_many = kinesis_produce_many
-        self._kinesis_batch_size = kinesis_batch_size
-        self._kinesis = boto3.client('kinesis')  # , region_name='us-west-2')
+        self._kinesis = transport.client('kinesis')  # , region_name='us-west-2')
+        self._batcher = KinesisBatcher(self._kinesis,
+                                       stream_name,
+                                       max_records=kinesis_batch_size,
+                                       linger_time=kinesis_linger_time)
+        self._country = country
         self._data_client = AwsDataClient(country)
+        self._record_cache = record_cache
+
+        self._records_sent = RECORDS_SENT.labels(stream_name)
+        self._put_seconds = PUT_SECONDS.labels(stream_name, 'PutRecord')
 
     def _get_raw_data(self,
                       start_date: datetime,
                       end_date: datetime,
-                      device_id=None) -> pd.DataFrame:
-        """get sensor readings from S3 using OpenEEW API"""
-
-        records_df_per_device = get_df_from_records(
-            self._data_client.get_filtered_records(
-                str(start_date),  # utc date
-                str(end_date),    # utc date
-                [device_id]       # list of devices
-            )
+                      device_ids: list = None) -> pd.DataFrame:
+        """get sensor readings of all devices, only devices missing from the local cache are read from S3"""
+
+        if self._record_cache is None:
+            return self._fetch_raw_data(start_date, end_date, device_ids)
+
+        return self._record_cache.read_records(self._country, start_date, end_date, device_ids,
+                                               self._fetch_raw_data)
+
+    def _fetch_raw_data(self,
+                        start_date: datetime,
+                        end_date: datetime,
+                        device_ids: list = None) -> pd.DataFrame:
+        """get sensor readings of all devices from S3 using 1 OpenEEW API call"""
+
+        records = self._data_client.get_filtered_records(
+            str(start_date),  # utc date
+            str(end_date),    # utc date
+            device_ids        # list of devices
         )
+        if not records:
+            # no readings in this time interval
+            return pd.DataFrame(columns=['device_id', 'x', 'y', 'z', 'sample_t'])
+
+        records_df_per_device = get_df_from_records(records)
         # Select required columns
         records_df = records_df_per_device[
             [
@@ -68,51 +156,148 @@ class StreamProducer:
         ]
         return records_df
 
+    @staticmethod
+    def _encode_records(accelerator_data: pd.DataFrame) -> tuple:
+        """ serialize 1 time interval of readings into Kinesis payloads in a single columnar pass,
+            payloads keep the keys of itertuples()._asdict(): Index, device_id, x, y, z, sample_t
+        """
+        payloads = accelerator_data.rename_axis('Index').reset_index().to_json(orient='records',
+                                                                               lines=True,
+                                                                               double_precision=15)
+        partition_keys = accelerator_data['device_id'].astype(str).tolist()
+        return payloads.splitlines(), partition_keys
+
     def _send_data_to_kinesis(self, accelerator_data: pd.DataFrame):
-        """ send raw data for 1 time interval to Kinesis """
-        i = 0
-        records = []
+        """ send raw data for 1 time interval to Kinesis, paced by the replay scheduler,
+            readings of all devices are interleaved by sample_t and keyed by device
+        """
 
         if accelerator_data is not None and accelerator_data.size > 0:
-            num_readings = accelerator_data.size
-            # logging.info(f'Start_time: {str(start_date)}, Number of records: {str(num_readings)}')
-            for reading in accelerator_data.itertuples():
-                sleep(self._sleep_time)
-
-                device_id = str(reading.device_id)
-                data = dict(reading._asdict())  # convert named tuple to dict
-
+            READINGS_REPLAYED.inc(len(accelerator_data))
+            if self._record_format == 'binary':
+                # a record is released once its last reading has been sampled
+                payloads, partition_keys, release_t = encode_interval(accelerator_data, self._readings_per_record)
+            else:
+                accelerator_data = accelerator_data.sort_values('sample_t', kind='mergesort')
+                payloads, partition_keys = self._encode_records(accelerator_data)
+                release_t = accelerator_data['sample_t'].values
+            # logging.info(f'Start_time: {str(start_date)}, Number of records: {str(len(payloads))}')
+            # a partial batch is sent after linger time, also while waiting for the next slice
+            wait = self._batcher.wait if self._kinesis_produce_many else sleep
+            for start, stop in self._scheduler.slices(release_t, wait):
                 if self._kinesis_produce_many:
-                    # create a set of records to be pushed together
-                    i += 1
-                    record = {'Data': json.dumps(data), 'PartitionKey': str(reading.device_id)}
-                    records.append(record)
-
-                    if i % self._kinesis_batch_size == 0 or i == num_readings:
-                        self._kinesis.put_records(StreamName=self._stream_name, Records=records)
-                        records = []
+                    # batcher sends the set of records once it is full or has lingered long enough
+                    self._batcher.add_many(payloads[start:stop], partition_keys[start:stop])
                 else:
-                    self._kinesis.put_record(StreamName=self._stream_name,
-                                             Data=json.dumps(data),
-                                             PartitionKey=str(reading.device_id))
+                    for data, partition_key in zip(payloads[start:stop], partition_keys[start:stop]):
+                        put_start = monotonic()
+                        self._kinesis.put_record(StreamName=self._stream_name,
+                                                 Data=data,
+                                                 PartitionKey=partition_key)
+                        self._put_seconds.observe(monotonic() - put_start)
+                    self._records_sent.inc(stop - start)
+                REPLAY_LAG.set(self._scheduler.lag)
+
+            # do not hold a partial batch while the next interval is read from S3
+            self._batcher.flush()
+            logging.info(f'Replay lag {self._scheduler.lag:.3f} s, max lag {self._scheduler.max_lag:.3f} s')
+
+    @property
+    def clock_offset(self) -> float:
+        """ seconds between the replay and its sample_t, None before the first reading is sent """
+        return self._scheduler.clock_offset
+
+    def warm_cache(self):
+        """ read all time intervals into the local record cache without sending them """
+
+        start_date_time = self._start_date
+        while start_date_time < self._end_date:
+            end_date_time = start_date_time + self._interval
+            sensor_data = self._get_raw_data(start_date_time, end_date_time, self._device_ids)
+            logging.info(f'Cached {len(sensor_data) if sensor_data is not None else 0} readings '
+                         f'from {start_date_time} to {end_date_time}')
+            start_date_time = end_date_time
 
     def produce(self):
         """send sensor data to input Kinesis stream"""
 
+        if self._prefetch_intervals > 0:
+            self._produce_pipelined()
+        else:
+            self._produce_sequential()
+
+        self._batcher.flush()
+        logging.info(f'Kinesis batcher stats: {self._batcher.stats}')
+
+    def _produce_sequential(self):
+        """ read 1 time interval from S3, then send it """
+
         start_date_time = self._start_date
         end_date_time = self._start_date
 
         while end_date_time < self._end_date:  # True
             try:
                 end_date_time = start_date_time + self._interval
-                sensor_data = self._get_raw_data(start_date_time, end_date_time, self._docker_device_id)
+                sensor_data = self._get_raw_data(start_date_time, end_date_time, self._device_ids)
                 self._send_data_to_kinesis(sensor_data)
 
                 # move onto the next time interval
                 start_date_time = end_date_time
             except Exception as ex:
-                print('Exception in publishing message')
-                print(str(ex))
+                PRODUCER_ERRORS.labels('send').inc()
+                logging.error(f'Exception in publishing message: {ex}')
+
+    def _produce_pipelined(self):
+        """ send interval N while a background worker reads interval N+1 from S3,
+            the bounded queue caps the number of DataFrames held in memory
+        """
+        intervals = queue.Queue(maxsize=self._prefetch_intervals)
+        stopped = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_intervals,
+                                   args=(intervals, stopped),
+                                   name='s3-prefetch',
+                                   daemon=True)
+        fetcher.start()
+
+        try:
+            while True:
+                sensor_data = intervals.get()
+                if sensor_data is None:  # all intervals have been read
+                    break
+                try:
+                    self._send_data_to_kinesis(sensor_data)
+                except Exception as ex:
+                    PRODUCER_ERRORS.labels('send').inc()
+                    logging.error(f'Exception in publishing message: {ex}')
+        finally:
+            stopped.set()
+
+    def _fetch_intervals(self, intervals: queue.Queue, stopped: threading.Event):
+        """ read raw data interval by interval, blocks while the queue is full """
+
+        start_date_time = self._start_date
+        while start_date_time < self._end_date and not stopped.is_set():
+            end_date_time = start_date_time + self._interval
+            try:
+                sensor_data = self._get_raw_data(start_date_time, end_date_time, self._device_ids)
+            except Exception as ex:
+                # read the same interval again, as the sequential loop does
+                PRODUCER_ERRORS.labels('read').inc()
+                logging.error(f'Exception in reading raw data: {ex}')
+                continue
+
+            while not stopped.is_set():
+                try:
+                    intervals.put(sensor_data, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+            # move onto the next time interval
+            start_date_time = end_date_time
+
+        if not stopped.is_set():
+            intervals.put(None)
 
 
 def main():
@@ -125,13 +310,31 @@ def main():
         exit()
 
     country = sys.argv[1]
-    docker_device_id = os.environ['DEVICE']
-    if not docker_device_id:
-        docker_device_id = sys.argv[2]
-    logging.info('inputs are {}, {}'.format(country, docker_device_id))
+    # DEVICE holds 1 device id or a comma separated shard of device ids
+    device_ids = os.environ.get('DEVICE')
+    if not device_ids:
+        device_ids = sys.argv[2]
+    device_ids = device_ids.split(',')
+    logging.info('inputs are {}, {}'.format(country, device_ids))
+
+    metrics_port = os.environ.get('METRICS_PORT')
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
+
+    # read here instead of on import, the replay scheduler and the benchmark need no kinesis.cfg
+    config = ConfigParser()
+    config.read_file(open('kinesis.cfg'))
 
-    # send data to message broker
-    producer = StreamProducer(docker_device_id, stream_name=INPUT_STREAM)
+    # send data to message broker, several devices share 1 batcher
+    producer = StreamProducer(device_ids,
+                              country=country,
+                              stream_name=config.get('KINESIS', 'input_stream'),
+                              kinesis_produce_many=len(device_ids) > 1,
+                              replay_speed=float(os.environ.get('REPLAY_SPEED', 1)),
+                              prefetch_intervals=int(os.environ.get('PREFETCH_INTERVALS', 2)),
+                              record_cache=RecordCache(os.environ['RECORD_CACHE_DIR'])
+                              if os.environ.get('RECORD_CACHE_DIR') else None,
+                              record_format=os.environ.get('RECORD_FORMAT', 'json'))
     producer.produce()
 
 
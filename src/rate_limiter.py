@@ -0,0 +1,86 @@
+import threading
+from time import sleep, monotonic
+
+
+class TokenBucket:
+    def __init__(self, rate: float = 5.0, capacity: float = 5.0):
+        """ allow `rate` operations per second with bursts of up to `capacity`,
+            callers sleep until the next token is available instead of spinning
+        """
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """ take 1 token, returns the seconds spent waiting for it """
+        waited = 0.0
+        with self._lock:
+            self._refill(monotonic())
+            while self._tokens < 1:
+                wait = (1 - self._tokens) / self._rate
+                sleep(wait)
+                waited += wait
+                self._refill(monotonic())
+            self._tokens -= 1
+        return waited
+
+
+class AdaptivePoller:
+    def __init__(self,
+                 records_limit: int,
+                 min_interval: float = 0.0,   # seconds between reads while catching up
+                 max_interval: float = 1.0,   # seconds between reads of an idle shard
+                 lag_threshold: int = 1000):  # MillisBehindLatest above which reads go full speed
+        """ poll interval that follows how full get_records responses are """
+        self._records_limit = records_limit
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._lag_threshold = lag_threshold
+        self.interval = min_interval
+
+    def update(self, num_records: int, millis_behind: int) -> float:
+        """ next poll interval after a read of num_records """
+        if num_records >= self._records_limit or millis_behind > self._lag_threshold:
+            # a full page or growing lag, read again as soon as a token is available
+            self.interval = self._min_interval
+        elif num_records == 0:
+            # nothing new, back off exponentially
+            self.interval = min(self._max_interval, max(2 * self.interval, 0.05))
+        else:
+            self.interval = max(self._min_interval, self.interval / 2)
+        return self.interval
+
+
+class ReadMetrics:
+    def __init__(self):
+        """ read rate and lag of 1 shard, rates are per second since the last report """
+        self._lock = threading.Lock()
+        self._reads = 0
+        self._records = 0
+        self._since = monotonic()
+        self.millis_behind_latest = 0
+        self.poll_interval = 0.0
+
+    def update(self, num_records: int, millis_behind: int, poll_interval: float):
+        with self._lock:
+            self._reads += 1
+            self._records += num_records
+        self.millis_behind_latest = millis_behind
+        self.poll_interval = poll_interval
+
+    def report(self) -> dict:
+        with self._lock:
+            now = monotonic()
+            elapsed = max(now - self._since, 1e-9)
+            metrics = {'reads_per_s': round(self._reads / elapsed, 2),
+                       'records_per_s': round(self._records / elapsed, 1),
+                       'millis_behind_latest': self.millis_behind_latest,
+                       'poll_interval': round(self.poll_interval, 3)}
+            self._reads, self._records, self._since = 0, 0, now
+        return metrics
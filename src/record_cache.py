@@ -0,0 +1,227 @@
+"""
+this script pre-populates the local cache of OpenEEW records for a date range
+    python record_cache.py mx "2020-01-05 04:39:00" "2020-01-05 05:39:00" 001,002,005
+"""
+
+import os
+import sys
+import math
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = '/tmp/eew-record-cache'
+CACHE_MAX_BYTES = 10 * 1024 ** 3
+
+# rows of a cached array, one column per reading
+CACHED_COLUMNS = ['Index', 'x', 'y', 'z', 'sample_t']
+
+# seconds of readings per cache file, files start at multiples of it so any window of a replay or backfill hits them
+BLOCK_SECONDS = 60
+
+# seconds read from S3 past the end of the blocks, S3 filters by the cloud_t of a record
+# while its readings go back up to 1 record before it
+FETCH_MARGIN = 5
+
+# seconds between scans of the cache directory, which also count files written by other processes
+SCAN_INTERVAL = 60
+
+
+def _epoch(date: datetime) -> float:
+    """ dates without a time zone are UTC like the dates of the OpenEEW API """
+    return (date.replace(tzinfo=timezone.utc) if date.tzinfo is None else date).timestamp()
+
+
+class RecordCache:
+    def __init__(self, cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        """ local cache of S3 records, 1 memory-mappable .npy file per country, device and BLOCK_SECONDS of readings,
+            least recently used files are evicted once the cache directory grows above max_bytes
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        # bytes in the cache directory at the last scan plus the bytes written since
+        self._size = 0
+        self._scanned = None
+        with self._lock:
+            self._evict()
+
+    def _scan(self) -> list:
+        """ files of all processes sharing the cache directory, file modification time is the last use """
+        files = []
+        for root, _, names in os.walk(self._cache_dir):
+            for name in names:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        # evicted by another process meanwhile
+                        continue
+                    files.append((stat.st_mtime, path, stat.st_size))
+        return sorted(files)
+
+    def _entry_path(self, country: str, device_id: str, block_t: float) -> str:
+        return os.path.join(self._cache_dir,
+                            country,
+                            str(device_id),
+                            f'{datetime.fromtimestamp(block_t, timezone.utc):%Y%m%dT%H%M%S}.npy')
+
+    @staticmethod
+    def aligned(start_date: datetime, end_date: datetime) -> tuple:
+        """ the window of whole blocks covering start_date to end_date """
+        return (start_date - timedelta(seconds=_epoch(start_date) % BLOCK_SECONDS),
+                end_date + timedelta(seconds=-_epoch(end_date) % BLOCK_SECONDS))
+
+    def get(self, country: str, device_id: str, block_t: float) -> np.ndarray:
+        """ cached readings of 1 device and block as an array of CACHED_COLUMNS rows, None on a miss """
+        path = self._entry_path(country, device_id, block_t)
+        try:
+            os.utime(path)
+            readings = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            # never cached, or evicted by any process sharing the cache directory
+            return None
+        except ValueError:
+            # empty blocks cannot be memory-mapped by older numpy
+            readings = np.load(path)
+        return readings
+
+    def put(self, country: str, device_id: str, block_t: float, readings: np.ndarray):
+        """ store readings of 1 device and block, an empty array records a block without data """
+        path = self._entry_path(country, device_id, block_t)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(readings, dtype=np.float64))
+        os.replace(tmp_path, path)  # readers never see a partial file
+        size = os.path.getsize(path)
+
+        with self._lock:
+            self._size += size
+            if self._size > self._max_bytes or monotonic() - self._scanned > SCAN_INTERVAL:
+                self._evict()
+
+    def _evict(self):
+        """ remove the least recently used files of the cache directory until it fits into max_bytes """
+        files = self._scan()
+        self._size = sum(size for _, _, size in files)
+        for _, path, size in files[:-1]:
+            if self._size <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+        self._scanned = monotonic()
+
+    def get_records(self, country: str, start_date: datetime, end_date: datetime, device_ids: list) -> tuple:
+        """ cached readings of all devices sampled from start_date to end_date as 1 DataFrame
+            and the list of devices with any block of the window missing from the cache
+        """
+        start_t = _epoch(start_date)
+        end_t = _epoch(end_date)
+        blocks = range(math.floor(start_t / BLOCK_SECONDS) * BLOCK_SECONDS, math.ceil(end_t), BLOCK_SECONDS)
+
+        frames = []
+        missing = []
+        for device_id in device_ids:
+            arrays = []
+            for block_t in blocks:
+                readings = self.get(country, device_id, block_t)
+                if readings is None:
+                    missing.append(device_id)
+                    break
+                arrays.append(readings)
+            else:
+                readings = np.hstack(arrays) if arrays else np.empty((len(CACHED_COLUMNS), 0))
+                readings = readings[:, (readings[4] >= start_t) & (readings[4] < end_t)]
+                if readings.shape[1]:
+                    frames.append(self._to_df(device_id, readings))
+        return (pd.concat(frames) if frames else None), missing
+
+    def put_records(self, country: str, start_date: datetime, end_date: datetime, device_ids: list,
+                    records_df: pd.DataFrame):
+        """ split readings fetched for several devices into 1 cache entry per device and block,
+            only blocks from start_date to end_date that have all their readings in records_df are stored
+        """
+        start_t = _epoch(start_date)
+        end_t = _epoch(end_date)
+        blocks = range(math.ceil(start_t / BLOCK_SECONDS) * BLOCK_SECONDS,
+                       math.floor(end_t / BLOCK_SECONDS) * BLOCK_SECONDS,
+                       BLOCK_SECONDS)
+
+        by_device = dict(tuple(records_df.groupby('device_id'))) if len(records_df) else {}
+        for device_id in device_ids:
+            device_df = by_device.get(device_id)
+            if device_df is None:
+                readings = np.empty((len(CACHED_COLUMNS), 0))
+            else:
+                readings = np.vstack([device_df.index.values] +
+                                     [device_df[column].values for column in CACHED_COLUMNS[1:]]).astype(np.float64)
+            reading_blocks = np.floor(readings[4] / BLOCK_SECONDS) * BLOCK_SECONDS
+            for block_t in blocks:
+                self.put(country, device_id, block_t, readings[:, reading_blocks == block_t])
+
+    def read_records(self, country: str, start_date: datetime, end_date: datetime, device_ids: list,
+                     fetch) -> pd.DataFrame:
+        """ readings of all devices sampled from start_date to end_date, devices missing from the cache
+            are read with fetch(start_date, end_date, device_ids) for whole blocks, which are cached
+        """
+        cached_df, missing = self.get_records(country, start_date, end_date, device_ids)
+        if not missing:
+            return cached_df
+
+        block_start, block_end = self.aligned(start_date, end_date)
+        records_df = fetch(block_start, block_end + timedelta(seconds=FETCH_MARGIN), missing)
+        self.put_records(country, block_start, block_end, missing, records_df)
+
+        sample_t = records_df['sample_t'].astype(np.float64)
+        records_df = records_df[(sample_t >= _epoch(start_date)) & (sample_t < _epoch(end_date))]
+        return records_df if cached_df is None else pd.concat([cached_df, records_df])
+
+    @staticmethod
+    def _to_df(device_id: str, readings: np.ndarray) -> pd.DataFrame:
+        records_df = pd.DataFrame({'device_id': device_id,
+                                   'x': readings[1],
+                                   'y': readings[2],
+                                   'z': readings[3],
+                                   'sample_t': readings[4]},
+                                  index=readings[0].astype(np.int64))
+        return records_df
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s:  %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S')
+
+    if len(sys.argv) != 5:
+        print('Please provide 4 arguments = country, start date, end date and comma separated device ids')
+        exit()
+
+    # imported here, producer itself depends on this module
+    from producer import StreamProducer
+
+    country = sys.argv[1]
+    start_date = datetime.fromisoformat(sys.argv[2])
+    end_date = datetime.fromisoformat(sys.argv[3])
+    device_ids = sys.argv[4].split(',')
+
+    cache = RecordCache(os.environ.get('RECORD_CACHE_DIR', CACHE_DIR))
+    producer = StreamProducer(device_ids,
+                              country=country,
+                              start_date=start_date,
+                              end_date=end_date,
+                              record_cache=cache)
+    producer.warm_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import json
+import struct
+import numpy as np
+import pandas as pd
+
+# binary record layout, little endian:
+#   header   magic 'EW', version, device id (5 bytes, null padded), number of readings, sample_t of 1st reading
+#   offsets  uint32 microseconds of every reading after the 1st reading's sample_t
+#   readings float32 x, y, z triplets
+MAGIC = b'EW'
+VERSION = 1
+DEVICE_ID_BYTES = 5
+HEADER = struct.Struct(f'<2sB{DEVICE_ID_BYTES}sHd')
+MAX_READINGS_PER_RECORD = 0xFFFF
+OFFSET_DTYPE = np.dtype('<u4')
+READING_DTYPE = np.dtype('<f4')
+
+
+def encode_readings(device_id: str, sample_t: np.ndarray, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> bytes:
+    """ pack readings of 1 device into 1 binary Kinesis record, 16 bytes per reading + 18 bytes header """
+    count = len(sample_t)
+    if count > MAX_READINGS_PER_RECORD:
+        raise ValueError(f'{count} readings do not fit into 1 record, maximum is {MAX_READINGS_PER_RECORD}')
+
+    t0 = float(sample_t[0]) if count else 0.0
+    offsets = np.rint((np.asarray(sample_t) - t0) * 1e6).astype(OFFSET_DTYPE)
+    readings = np.empty((count, 3), dtype=READING_DTYPE)
+    readings[:, 0] = x
+    readings[:, 1] = y
+    readings[:, 2] = z
+    return HEADER.pack(MAGIC, VERSION, str(device_id).encode('ascii'), count, t0) \
+        + offsets.tobytes() + readings.tobytes()
+
+
+def decode_readings(data: bytes) -> tuple:
+    """ unpack 1 binary record into device id and sample_t, x, y, z arrays """
+    magic, version, device_id, count, t0 = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Not a binary readings record: magic {magic}, version {version}')
+
+    offsets = np.frombuffer(data, dtype=OFFSET_DTYPE, count=count, offset=HEADER.size)
+    readings = np.frombuffer(data, dtype=READING_DTYPE, count=3 * count,
+                             offset=HEADER.size + count * OFFSET_DTYPE.itemsize).reshape(count, 3)
+    sample_t = t0 + offsets / 1e6
+    return device_id.rstrip(b'\0').decode('ascii'), sample_t, readings[:, 0], readings[:, 1], readings[:, 2]
+
+
+def is_binary(data) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:2]) == MAGIC
+
+
+def encode_interval(accelerator_data: pd.DataFrame, readings_per_record: int = 32) -> tuple:
+    """ pack 1 time interval into binary records of up to readings_per_record readings of 1 device,
+        returns payloads, partition keys and the sample_t at which each record is complete,
+        all ordered by that time
+    """
+    readings_per_record = min(readings_per_record, MAX_READINGS_PER_RECORD)
+    readings_df = accelerator_data.sort_values(['device_id', 'sample_t'], kind='mergesort')
+
+    device_ids = readings_df['device_id'].astype(str).values
+    sample_t = readings_df['sample_t'].values
+    x, y, z = (readings_df[column].values for column in ('x', 'y', 'z'))
+
+    # chunk every device's readings, a chunk never spans 2 devices
+    device_starts = np.flatnonzero(np.r_[True, device_ids[1:] != device_ids[:-1]])
+    device_stops = np.r_[device_starts[1:], len(device_ids)]
+    # struct.pack would cut longer device ids to the size of the header field
+    too_long = [device_ids[start] for start in device_starts
+                if len(device_ids[start].encode('ascii')) > DEVICE_ID_BYTES]
+    if too_long:
+        raise ValueError(f'Device ids {too_long} are longer than the {DEVICE_ID_BYTES} bytes of a record header')
+    chunks = [(start, min(start + readings_per_record, stop))
+              for device_start, stop in zip(device_starts, device_stops)
+              for start in range(device_start, stop, readings_per_record)]
+
+    payloads = [encode_readings(device_ids[start], sample_t[start:stop], x[start:stop], y[start:stop], z[start:stop])
+                for start, stop in chunks]
+    partition_keys = [device_ids[start] for start, _ in chunks]
+    release_t = np.array([sample_t[stop - 1] for _, stop in chunks])
+
+    order = np.argsort(release_t, kind='mergesort')
+    return [payloads[i] for i in order], [partition_keys[i] for i in order], release_t[order]
+
+
+def decode_records(records: list) -> pd.DataFrame:
+    """ decode a batch of Kinesis input records, binary or JSON, into device_id, x, y, z, sample_t columns """
+    columns = {'device_id': [], 'x': [], 'y': [], 'z': [], 'sample_t': []}
+    json_readings = []
+
+    for record in records:
+        data = record['Data']
+        if is_binary(data):
+            device_id, sample_t, x, y, z = decode_readings(data)
+            columns['device_id'].append(np.full(len(sample_t), device_id, dtype=object))
+            columns['x'].append(x)
+            columns['y'].append(y)
+            columns['z'].append(z)
+            columns['sample_t'].append(sample_t)
+        else:
+            json_readings.append(json.loads(data))
+
+    if json_readings:
+        json_df = pd.DataFrame(json_readings, columns=list(columns))
+        for column in columns:
+            columns[column].append(json_df[column].values)
+
+    if not columns['sample_t']:
+        return pd.DataFrame(columns=list(columns))
+    return pd.DataFrame({column: np.concatenate(values) for column, values in columns.items()})
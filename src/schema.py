@@ -0,0 +1,156 @@
+import logging
+import threading
+from datetime import date, datetime, timedelta
+import psycopg2
+import psycopg2.extensions
+
+
+class PartitionedTable:
+    def __init__(self,
+                 name: str,
+                 time_column: str,
+                 columns: str,                # column definitions, without the id and the time column
+                 days_ahead: int = 7,         # daily partitions created ahead of today
+                 retention_days: int = None):  # partitions older than this are dropped, None = keep all
+        """ table partitioned by day on its time column, with a DEFAULT partition for days without one,
+            a unique (device_id, time) index for per-device queries and idempotent writes,
+            and a BRIN index for time ranges
+        """
+        self.name = name
+        self._time_column = time_column
+        self._columns = columns
+        self._days_ahead = days_ahead
+        self._retention_days = retention_days
+
+        self._partitioned = True
+        self._days = set()  # days with their own partition, or whose rows already sit in the default partition
+        self._uncommitted = {}  # day -> id of the transaction that created its partition, until it ends
+        self._lock = threading.Lock()
+
+    def _partition_name(self, day: date) -> str:
+        return f'{self.name}_p{day:%Y%m%d}'
+
+    def setup(self, cur: psycopg2.extensions.cursor):
+        """ create the table if needed, existing data is kept """
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (self.name,))
+        relkind = cur.fetchone()
+        if relkind and relkind[0] == 'r':
+            logging.warning(f'Table {self.name} exists and is not partitioned, it is used as is')
+            self._partitioned = False
+            self._create_unique_index(cur)
+            return
+
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {self.name} (
+                            {self._columns},
+                            {self._time_column}     TIMESTAMP NOT NULL,
+                            id                      BIGSERIAL,
+                            PRIMARY KEY (id, {self._time_column})
+                        ) PARTITION BY RANGE ({self._time_column});""")
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {self.name}_default PARTITION OF {self.name} DEFAULT")
+        self._create_unique_index(cur)
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {self.name}_time_brin "
+                    f"ON {self.name} USING BRIN ({self._time_column})")
+
+        with self._lock:
+            self._days = set(self._existing_partitions(cur))
+        self.maintain(cur)
+
+    def _create_unique_index(self, cur: psycopg2.extensions.cursor):
+        """ rows are unique per device and time, so INSERT ... ON CONFLICT DO NOTHING skips replayed rows """
+        in_transaction = not cur.connection.autocommit
+        if in_transaction:
+            cur.execute('SAVEPOINT unique_index')
+        try:
+            cur.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {self.name}_device_time_key "
+                        f"ON {self.name} (device_id, {self._time_column})")
+        except psycopg2.Error as e:
+            if in_transaction:
+                cur.execute('ROLLBACK TO SAVEPOINT unique_index')
+            # e.g. duplicates saved before the index existed
+            logging.warning(f'Rows of {self.name} are not unique per device and time, '
+                            f'replayed rows are saved again: {e}')
+
+    def _existing_partitions(self, cur: psycopg2.extensions.cursor) -> dict:
+        """ day -> partition name of every daily partition """
+        cur.execute("""SELECT child.relname
+                       FROM pg_inherits
+                       JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+                       JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+                       WHERE parent.relname = %s""", (self.name,))
+        partitions = {}
+        prefix = f'{self.name}_p'
+        for (relname,) in cur.fetchall():
+            if relname.startswith(prefix):
+                try:
+                    partitions[datetime.strptime(relname[len(prefix):], '%Y%m%d').date()] = relname
+                except ValueError:
+                    pass
+        return partitions
+
+    def maintain(self, cur: psycopg2.extensions.cursor):
+        """ create partitions ahead of today and drop the ones past retention """
+        if not self._partitioned:
+            return
+        today = datetime.utcnow().date()
+        self.ensure_partitions(cur, [today + timedelta(days=i) for i in range(self._days_ahead + 1)])
+        if self._retention_days is not None:
+            self.drop_partitions_before(cur, today - timedelta(days=self._retention_days))
+
+    def ensure_partitions(self, cur: psycopg2.extensions.cursor, days: list):
+        """ create the daily partitions of the given days unless they exist """
+        if not self._partitioned:
+            return
+        with self._lock:
+            if self._uncommitted:
+                self._forget_rolled_back(cur)
+            missing = sorted(set(days) - self._days)
+            in_transaction = not cur.connection.autocommit
+            transaction_id = None
+            for day in missing:
+                # the savepoint keeps an open transaction usable when the partition cannot be created
+                if in_transaction:
+                    cur.execute('SAVEPOINT create_partition')
+                try:
+                    cur.execute(f"CREATE TABLE IF NOT EXISTS {self._partition_name(day)} PARTITION OF {self.name} "
+                                f"FOR VALUES FROM (%s) TO (%s)", (day, day + timedelta(days=1)))
+                    if in_transaction:
+                        # the partition is gone if the transaction of the caller rolls back
+                        if transaction_id is None:
+                            cur.execute('SELECT txid_current()')
+                            transaction_id = cur.fetchone()[0]
+                        self._uncommitted[day] = transaction_id
+                except psycopg2.Error as e:
+                    if in_transaction:
+                        cur.execute('ROLLBACK TO SAVEPOINT create_partition')
+                    # e.g. rows of this day were already saved in the default partition
+                    logging.warning(f'Rows of {day} stay in {self.name}_default: {e}')
+                self._days.add(day)
+
+    def _forget_rolled_back(self, cur: psycopg2.extensions.cursor):
+        """ days whose partitions were created by transactions that rolled back are created again """
+        for transaction_id in set(self._uncommitted.values()):
+            cur.execute('SELECT txid_status(%s)', (transaction_id,))
+            status = cur.fetchone()[0]
+            if status == 'in progress':
+                continue
+            days = [day for day, created_by in self._uncommitted.items() if created_by == transaction_id]
+            for day in days:
+                del self._uncommitted[day]
+            if status != 'committed':
+                self._days.difference_update(days)
+                logging.warning(f'Partitions of {self.name} for {days} were rolled back, creating them again')
+
+    def ensure_partitions_for(self, cur: psycopg2.extensions.cursor, times: list):
+        """ create partitions for the days of TIMESTAMP strings like 2020-01-05 04:39:00.000 """
+        if self._partitioned:
+            days = {time[:10] for time in times if time}
+            self.ensure_partitions(cur, [date.fromisoformat(day) for day in days])
+
+    def drop_partitions_before(self, cur: psycopg2.extensions.cursor, day: date):
+        """ retention: drop whole daily partitions older than day """
+        with self._lock:
+            for partition_day, relname in sorted(self._existing_partitions(cur).items()):
+                if partition_day < day:
+                    cur.execute(f"DROP TABLE IF EXISTS {relname}")
+                    self._days.discard(partition_day)
+                    logging.info(f'Dropped partition {relname}')
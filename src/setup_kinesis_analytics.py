@@ -1,4 +1,4 @@
-import boto3
+import transport
 import time
 import logging
 import sys
@@ -104,9 +104,9 @@ OUTPUT_WARNING_STREAM_SHARDS = config.get('KINESIS', 'output_warning_stream_shar
 
 class AwsSetup:
     def __init__(self):
-        self._iam_client = boto3.client('iam')
-        self._kinesis_client = boto3.client('kinesis')
-        self._kinesisanalytics_client = boto3.client('kinesisanalytics')
+        self._iam_client = transport.client('iam')
+        self._kinesis_client = transport.client('kinesis')
+        self._kinesisanalytics_client = transport.client('kinesisanalytics')
 
         self._roleArn = self._create_role(AWS_KINESIS_ROLE)
         self._input_stream_arn = self._create_stream(INPUT_STREAM, INPUT_STREAM_SHARDS)
@@ -238,7 +238,7 @@ class AwsSetup:
     @staticmethod
     def start_application():
         logging.info(f'Starting Kinesis Analytics application ... ')
-        kinesisanalytics_client = boto3.client('kinesisanalytics')
+        kinesisanalytics_client = transport.client('kinesisanalytics')
         app_desc = kinesisanalytics_client.describe_application(ApplicationName=APPNAME). \
             get('ApplicationDetail')
 
@@ -261,7 +261,7 @@ class AwsSetup:
     @staticmethod
     def stop_application():
         logging.info(f'Stopping Kinesis Analytics application ... ')
-        kinesisanalytics_client = boto3.client('kinesisanalytics')
+        kinesisanalytics_client = transport.client('kinesisanalytics')
         app_desc = kinesisanalytics_client.describe_application(ApplicationName=APPNAME). \
             get('ApplicationDetail')
 
@@ -276,7 +276,7 @@ class AwsSetup:
 
     @staticmethod
     def _stream_exists(stream_name: str) -> bool:
-        kinesis_client = boto3.client('kinesis')
+        kinesis_client = transport.client('kinesis')
         streams = kinesis_client.list_streams()
         if stream_name in streams.get('StreamNames'):
             return True
@@ -285,7 +285,7 @@ class AwsSetup:
 
     @staticmethod
     def _role_exsits(role_name: str) -> bool:
-        iam_client = boto3.client('iam')
+        iam_client = transport.client('iam')
         roles_dict = iam_client.list_roles()
         roles_list = roles_dict.get('Roles')
         role_names = [role.get('RoleName') for role in roles_list]
@@ -296,7 +296,7 @@ class AwsSetup:
 
     @staticmethod
     def _application_exists(app_name: str) -> bool:
-        kinesisanalytics_client = boto3.client('kinesisanalytics')
+        kinesisanalytics_client = transport.client('kinesisanalytics')
         apps_dict = kinesisanalytics_client.list_applications()
         apps_list = apps_dict.get('ApplicationSummaries')
         app_names = [app.get('ApplicationName') for app in apps_list]
@@ -308,7 +308,7 @@ class AwsSetup:
     @staticmethod
     def delete_streams():
         logging.info(f'Deleting input and output streams ... ')
-        kinesis_client = boto3.client('kinesis')
+        kinesis_client = transport.client('kinesis')
         if AwsSetup._stream_exists(INPUT_STREAM):
             kinesis_client.delete_stream(StreamName=INPUT_STREAM)
         if AwsSetup._stream_exists(OUTPUT_ACCEL_STREAM):
@@ -319,7 +319,7 @@ class AwsSetup:
     @staticmethod
     def delete_role():
         logging.info(f'Deleting IAM role for Kinesis Analytics ... ')
-        iam_client = boto3.client('iam')
+        iam_client = transport.client('iam')
         if AwsSetup._role_exsits(AWS_KINESIS_ROLE):
             iam_client.detach_role_policy(RoleName=AWS_KINESIS_ROLE,
                                           PolicyArn="arn:aws:iam::aws:policy/AmazonKinesisAnalyticsFullAccess")
@@ -328,7 +328,7 @@ class AwsSetup:
     @staticmethod
     def delete_application():
         logging.info(f'Deleting Kinesis Analytics application ... ')
-        kinesisanalytics_client = boto3.client('kinesisanalytics')
+        kinesisanalytics_client = transport.client('kinesisanalytics')
 
         if AwsSetup._application_exists(APPNAME):
             app_desc = kinesisanalytics_client.describe_application(ApplicationName=APPNAME). \
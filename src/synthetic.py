@@ -0,0 +1,109 @@
+"""
+synthetic sensor readings with known shaking, shared by benchmark.py and the tests in tests/
+"""
+
+import numpy as np
+import pandas as pd
+from record_codec import encode_interval
+from detection import PWavePicker
+from event_associator import warning_timestamp
+
+
+def synthetic_readings(devices: int = 1,
+                       seconds: int = 300,
+                       frequency: int = 32,
+                       start_t: float = 1578199140.0) -> pd.DataFrame:
+    """ build readings shaped like get_df_from_records output for the selected columns """
+    rng = np.random.default_rng(0)
+    num_samples = seconds * frequency
+    sample_t = start_t + np.arange(num_samples) / frequency
+
+    readings_df = pd.DataFrame({
+        'device_id': np.repeat([f'{device:03d}' for device in range(devices)], num_samples),
+        'x': rng.normal(0, 0.05, devices * num_samples).round(6),
+        'y': rng.normal(0, 0.05, devices * num_samples).round(6),
+        'z': rng.normal(-1, 0.05, devices * num_samples).round(6),
+        'sample_t': np.tile(sample_t, devices)
+    })
+    return readings_df
+
+
+def sites_with_shaking(devices: int = 40,
+                       seconds: int = 60,
+                       frequency: int = 32,
+                       onset: float = 40.0,
+                       start_t: float = 1578199140.0) -> tuple:
+    """ readings without gravity of quiet (noise 0.01) and noisy (noise 0.3) sites, every other site of both
+        shakes at 2 Hz from onset, 0.3 on quiet and 3.0 on noisy sites, returns (readings_df, shaking device ids)
+    """
+    rng = np.random.default_rng(1)
+    num_samples = seconds * frequency
+    sample_t = start_t + np.arange(num_samples) / frequency
+    noise = np.repeat(np.where(np.arange(devices) < devices // 2, 0.01, 0.3), num_samples)
+    readings_df = pd.DataFrame({
+        'device_id': np.repeat([f'{device:03d}' for device in range(devices)], num_samples),
+        'x': rng.normal(0, 1, devices * num_samples) * noise,
+        'y': rng.normal(0, 1, devices * num_samples) * noise,
+        'z': rng.normal(0, 1, devices * num_samples) * noise,
+        'sample_t': np.tile(sample_t, devices)
+    })
+    shaking_ids = [f'{device:03d}' for device in range(0, devices, 2)]
+    shaking = readings_df['device_id'].isin(shaking_ids) & (readings_df['sample_t'] >= start_t + onset)
+    amplitude = np.where(noise > 0.01, 3.0, 0.3)
+    readings_df.loc[shaking, 'y'] += amplitude[shaking] * np.sin(2 * np.pi * 2 * (readings_df.loc[shaking, 'sample_t']
+                                                                                    - start_t - onset))
+    return readings_df.sort_values('sample_t', kind='mergesort'), shaking_ids
+
+
+def first_warnings(detector, readings_df: pd.DataFrame, batch_seconds: float = 0.25, after: float = 0.0) -> dict:
+    """ device id -> (WARNING_TIME, sample_t of the last reading fed when the warning came out) of its 1st warning
+        at or after the after time, readings are fed in time slices like the stream delivers them
+    """
+    first = {}
+    slices = np.floor((readings_df['sample_t'].values - readings_df['sample_t'].values[0]) / batch_seconds)
+    for _, batch in readings_df.groupby(slices, sort=True):
+        rows = detector.process(batch['device_id'].values, batch['sample_t'].values,
+                                batch['x'].values, batch['y'].values, batch['z'].values)[1]
+        for row in rows:
+            if warning_timestamp(row['WARNING_TIME']) >= after:
+                first.setdefault(row['DEVICE_ID'], (warning_timestamp(row['WARNING_TIME']), batch['sample_t'].max()))
+    return first
+
+
+def p_wave_sites(devices: int = 20,
+                 seconds: int = 40,
+                 frequency: int = 32,
+                 start_t: float = 1578199140.0) -> tuple:
+    """ readings of quiet (noise 0.01) and noisy (noise 0.2) sites, every site gets a 5 Hz P wave growing
+        to 10 times its noise within 0.2 s from an onset at a random time between samples,
+        returns (readings_df, onset of every device)
+    """
+    rng = np.random.default_rng(2)
+    num_samples = seconds * frequency
+    sample_t = start_t + np.arange(num_samples) / frequency
+    onsets = start_t + 25 + rng.uniform(0, 1, devices)
+    readings = []
+    for device in range(devices):
+        noise = 0.01 if device % 2 else 0.2
+        x, y, z = rng.normal(0, noise, (3, num_samples))
+        shaking = sample_t >= onsets[device]
+        elapsed = sample_t[shaking] - onsets[device]
+        y[shaking] += 10 * noise * np.sin(2 * np.pi * 5 * elapsed) * np.minimum(1, 0.3 + elapsed / 0.3)
+        readings.append(pd.DataFrame({'device_id': f'{device:03d}', 'x': x, 'y': y, 'z': z, 'sample_t': sample_t}))
+    return pd.concat(readings, ignore_index=True), {f'{device:03d}': onsets[device] for device in range(devices)}
+
+
+def first_picks(readings_df: pd.DataFrame, readings_per_record: int = 32) -> tuple:
+    """ binary records are fed 1 by 1 once complete, as the producer sends them, returns
+        device id -> (onset, trigger time, sample_t at which its record was complete) of its 1st pick,
+        and the number of records
+    """
+    payloads, _, release_t = encode_interval(readings_df, readings_per_record)
+    picker = PWavePicker()
+    picks = {}
+    for payload, released in zip(payloads, release_t):
+        for row in picker.process_records([{'Data': payload}])[1]:
+            picks.setdefault(row['DEVICE_ID'], (warning_timestamp(row['WARNING_TIME']),
+                                                warning_timestamp(row['TRIGGER_TIME']),
+                                                released))
+    return picks, len(payloads)
@@ -0,0 +1,264 @@
+"""
+clients of the AWS services used by the pipeline, EEW_TRANSPORT selects what they talk to:
+    aws     boto3 clients (default), <SERVICE>_ENDPOINT_URL points one of them to a local endpoint,
+            e.g. KINESIS_ENDPOINT_URL=http://localhost:4567 for kinesalite
+    memory  in-process Kinesis broker, Kinesis Analytics running a detector, IAM and SNS stubs,
+            producer, analytics and consumers have to run in the same process, e.g. benchmark.py e2e,
+            DETECTOR selects the detector: peak (the Kinesis Analytics rule, default), sta_lta or p_wave
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from time import time, sleep
+from datetime import datetime
+
+TRANSPORTS = ('aws', 'memory')
+# columns of the warnings stream of the Kinesis Analytics SQL
+WARNING_COLUMNS = ('DEVICE_ID', 'WARNING_ACCELERATION', 'WARNING_TIME')
+
+_local_clients = {}
+_local_lock = threading.Lock()
+
+
+def transport() -> str:
+    name = os.environ.get('EEW_TRANSPORT', 'aws')
+    if name not in TRANSPORTS:
+        raise ValueError(f'EEW_TRANSPORT must be one of {", ".join(TRANSPORTS)}, not {name}')
+    return name
+
+
+def client(service_name: str, **kwargs):
+    """ boto3.client replacement, in memory all callers share 1 client per service,
+        boto3 and the in-memory dependencies are imported on first use to keep startup short
+    """
+    if transport() == 'memory':
+        from alert_dispatcher import StubSnsClient
+        with _local_lock:
+            if not _local_clients:
+                kinesis = LocalKinesis()
+                _local_clients.update({'kinesis': kinesis,
+                                       'kinesisanalytics': LocalAnalytics(kinesis),
+                                       'iam': LocalIam(),
+                                       'sns': StubSnsClient()})
+        return _local_clients[service_name]
+
+    endpoint_url = os.environ.get(f'{service_name.upper()}_ENDPOINT_URL')
+    if endpoint_url and 'endpoint_url' not in kwargs:
+        kwargs['endpoint_url'] = endpoint_url
+    import boto3
+    return boto3.client(service_name, **kwargs)
+
+
+class LocalShard:
+    def __init__(self, shard_id: str):
+        """ append-only list of records, the position of a record is its sequence number """
+        self.shard_id = shard_id
+        self.records = []
+        self.lock = threading.Lock()
+
+    def append(self, data, partition_key: str) -> str:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        with self.lock:
+            sequence_number = str(len(self.records))
+            self.records.append({'SequenceNumber': sequence_number,
+                                 'ApproximateArrivalTimestamp': time(),
+                                 'Data': data,
+                                 'PartitionKey': partition_key})
+        return sequence_number
+
+
+class LocalKinesis:
+    def __init__(self, default_shards: int = 1):
+        """ in-memory Kinesis Data Streams with the calls and responses the pipeline uses,
+            streams are created on first use, records are kept until the process ends
+        """
+        self._default_shards = default_shards
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def _stream(self, stream_name: str) -> list:
+        with self._lock:
+            if stream_name not in self._streams:
+                self._streams[stream_name] = [LocalShard(f'shardId-{i:012d}') for i in range(self._default_shards)]
+            return self._streams[stream_name]
+
+    def _shard(self, stream_name: str, shard_id: str) -> LocalShard:
+        return next(shard for shard in self._stream(stream_name) if shard.shard_id == shard_id)
+
+    def create_stream(self, StreamName: str, ShardCount: int):
+        with self._lock:
+            self._streams[StreamName] = [LocalShard(f'shardId-{i:012d}') for i in range(int(ShardCount))]
+
+    def delete_stream(self, StreamName: str):
+        with self._lock:
+            self._streams.pop(StreamName, None)
+
+    def list_streams(self, **kwargs) -> dict:
+        with self._lock:
+            return {'StreamNames': list(self._streams), 'HasMoreStreams': False}
+
+    def describe_stream_summary(self, StreamName: str) -> dict:
+        return {'StreamDescriptionSummary': {'StreamName': StreamName,
+                                             'StreamARN': f'arn:aws:kinesis:local:000000000000:stream/{StreamName}',
+                                             'StreamStatus': 'ACTIVE',
+                                             'OpenShardCount': len(self._stream(StreamName))}}
+
+    def list_shards(self, StreamName: str, **kwargs) -> dict:
+        return {'Shards': [{'ShardId': shard.shard_id,
+                            'SequenceNumberRange': {'StartingSequenceNumber': '0'}}
+                           for shard in self._stream(StreamName)]}
+
+    def put_record(self, StreamName: str, Data, PartitionKey: str, **kwargs) -> dict:
+        shards = self._stream(StreamName)
+        # shards own ranges of the MD5 hash of the partition key, as in Kinesis
+        shard = shards[int(hashlib.md5(PartitionKey.encode('utf-8')).hexdigest(), 16) * len(shards) >> 128]
+        return {'ShardId': shard.shard_id, 'SequenceNumber': shard.append(Data, PartitionKey)}
+
+    def put_records(self, StreamName: str, Records: list) -> dict:
+        results = [self.put_record(StreamName, record['Data'], record['PartitionKey']) for record in Records]
+        return {'FailedRecordCount': 0, 'Records': results}
+
+    def get_shard_iterator(self, StreamName: str, ShardId: str, ShardIteratorType: str,
+                           StartingSequenceNumber: str = None, **kwargs) -> dict:
+        shard = self._shard(StreamName, ShardId)
+        if ShardIteratorType == 'TRIM_HORIZON':
+            position = 0
+        elif ShardIteratorType == 'LATEST':
+            position = len(shard.records)
+        elif ShardIteratorType == 'AT_SEQUENCE_NUMBER':
+            position = int(StartingSequenceNumber)
+        elif ShardIteratorType == 'AFTER_SEQUENCE_NUMBER':
+            position = int(StartingSequenceNumber) + 1
+        else:
+            raise ValueError(f'Unsupported shard iterator type {ShardIteratorType}')
+        return {'ShardIterator': f'{StreamName}|{ShardId}|{position}'}
+
+    def get_records(self, ShardIterator: str, Limit: int = 10000) -> dict:
+        stream_name, shard_id, position = ShardIterator.rsplit('|', 2)
+        shard = self._shard(stream_name, shard_id)
+        position = int(position)
+        records = shard.records[position:position + Limit]
+        position += len(records)
+
+        now = time()
+        behind = shard.records[position:position + 1]
+        millis_behind = int((now - behind[0]['ApproximateArrivalTimestamp']) * 1000) if behind else 0
+        return {'Records': records,
+                'NextShardIterator': f'{stream_name}|{shard_id}|{position}',
+                'MillisBehindLatest': millis_behind,
+                'ResponseMetadata': {'HTTPHeaders': {'date': datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')}}}
+
+
+class LocalAnalytics:
+    def __init__(self, kinesis: LocalKinesis, poll_interval: float = 0.05):
+        """ Kinesis Analytics application stand-in, DetectionEngine applies the same SQL to the input stream
+            and writes DESTINATION_SQL_STREAM_001 and DESTINATION_SQL_STREAM_002 to their output streams,
+            DETECTOR=sta_lta writes warnings of StaLtaDetector instead
+        """
+        self._kinesis = kinesis
+        self._poll_interval = poll_interval
+        self._applications = {}
+
+    def list_applications(self, **kwargs) -> dict:
+        return {'ApplicationSummaries': [{'ApplicationName': name, 'ApplicationStatus': application['status']}
+                                         for name, application in self._applications.items()]}
+
+    def create_application(self, ApplicationName: str, Inputs: list, Outputs: list, **kwargs):
+        self._applications[ApplicationName] = {'status': 'READY', 'inputs': Inputs, 'outputs': Outputs,
+                                               'stopped': threading.Event()}
+
+    def delete_application(self, ApplicationName: str, **kwargs):
+        self.stop_application(ApplicationName)
+        self._applications.pop(ApplicationName, None)
+
+    def describe_application(self, ApplicationName: str) -> dict:
+        application = self._applications[ApplicationName]
+        return {'ApplicationDetail': {'ApplicationName': ApplicationName,
+                                      'ApplicationStatus': application['status'],
+                                      'CreateTimestamp': datetime.utcnow(),
+                                      'InputDescriptions': [{'InputId': f'{i + 1}.1'}
+                                                            for i in range(len(application['inputs']))]}}
+
+    def start_application(self, ApplicationName: str, InputConfigurations: list):
+        application = self._applications[ApplicationName]
+        position = InputConfigurations[0]['InputStartingPositionConfiguration']['InputStartingPosition']
+        application['status'] = 'RUNNING'
+        application['stopped'].clear()
+        threading.Thread(target=self._run,
+                         args=(application, 'LATEST' if position == 'NOW' else 'TRIM_HORIZON'),
+                         name='analytics',
+                         daemon=True).start()
+
+    def stop_application(self, ApplicationName: str):
+        application = self._applications.get(ApplicationName)
+        if application is not None:
+            application['stopped'].set()
+            application['status'] = 'READY'
+
+    @staticmethod
+    def _stream_name(arn: str) -> str:
+        return arn.rsplit('/', 1)[-1]
+
+    def _run(self, application: dict, iterator_type: str):
+        from detection import create_detector, to_kinesis_records
+
+        input_stream = self._stream_name(application['inputs'][0]['KinesisStreamsInput']['ResourceARN'])
+        outputs = {output['Name']: self._stream_name(output['KinesisStreamsOutput']['ResourceARN'])
+                   for output in application['outputs']}
+
+        iterators = [self._kinesis.get_shard_iterator(StreamName=input_stream,
+                                                      ShardId=shard['ShardId'],
+                                                      ShardIteratorType=iterator_type)['ShardIterator']
+                     for shard in self._kinesis.list_shards(StreamName=input_stream)['Shards']]
+        engine = create_detector(os.environ.get('DETECTOR', 'peak'))
+        while not application['stopped'].is_set():
+            num_records = 0
+            for i, iterator in enumerate(iterators):
+                response = self._kinesis.get_records(ShardIterator=iterator)
+                iterators[i] = response['NextShardIterator']
+                if not response['Records']:
+                    continue
+                num_records += len(response['Records'])
+                try:
+                    accel_rows, warning_rows = engine.process_records(response['Records'])
+                except Exception as generic:
+                    logging.error(f'Error in local Kinesis Analytics: {generic}')
+                    continue
+                # the warnings stream has the 3 columns of the SQL, a picker adds TRIGGER_TIME
+                warning_rows = [{key: row[key] for key in WARNING_COLUMNS} for row in warning_rows]
+                for name, rows in (('DESTINATION_SQL_STREAM_001', accel_rows),
+                                   ('DESTINATION_SQL_STREAM_002', warning_rows)):
+                    if rows and name in outputs:
+                        self._kinesis.put_records(StreamName=outputs[name],
+                                                  Records=[dict(record, PartitionKey=row['DEVICE_ID'])
+                                                           for record, row in zip(to_kinesis_records(rows), rows)])
+            if not num_records:
+                sleep(self._poll_interval)
+
+
+class LocalIam:
+    def __init__(self):
+        """ IAM roles of AwsSetup, kept in memory """
+        self._roles = {}
+
+    def list_roles(self, **kwargs) -> dict:
+        return {'Roles': list(self._roles.values())}
+
+    def create_role(self, RoleName: str, **kwargs) -> dict:
+        self._roles[RoleName] = {'RoleName': RoleName, 'Arn': f'arn:aws:iam::000000000000:role/{RoleName}'}
+        return {'Role': self._roles[RoleName]}
+
+    def get_role(self, RoleName: str) -> dict:
+        return {'Role': self._roles[RoleName]}
+
+    def delete_role(self, RoleName: str):
+        self._roles.pop(RoleName, None)
+
+    def attach_role_policy(self, RoleName: str, PolicyArn: str):
+        pass
+
+    def detach_role_policy(self, RoleName: str, PolicyArn: str):
+        pass
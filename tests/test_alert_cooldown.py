@@ -0,0 +1,73 @@
+import os
+import alert_cooldown
+from alert_cooldown import AlertCooldown
+
+T0 = 1578199140.0  # 2020-01-05 04:39:00
+
+
+def test_device_cools_down_for_the_cooldown_only():
+    cooldown = AlertCooldown(cooldown=600)
+    cooldown.add('001', T0)
+    assert cooldown.active('001', T0 + 599)
+    assert not cooldown.active('001', T0 + 600)
+    # warnings from before the alert are not held back
+    assert not cooldown.active('001', T0 - 1)
+    assert not cooldown.active('002', T0)
+
+    # expired alerts are dropped once a later alert moves the clock
+    cooldown.add('002', T0 + 700)
+    assert len(cooldown) == 1
+
+
+def test_oldest_alerts_are_evicted_above_the_cap():
+    cooldown = AlertCooldown(cooldown=600, max_devices=2)
+    cooldown.add('001', T0)
+    cooldown.add('002', T0 + 1)
+    # alerting again makes 001 the newest
+    cooldown.add('001', T0 + 2)
+    cooldown.add('003', T0 + 3)
+    assert len(cooldown) == 2
+    assert not cooldown.active('002', T0 + 4)
+    assert cooldown.active('001', T0 + 4)
+    assert cooldown.active('003', T0 + 4)
+
+
+def test_state_is_kept_across_restarts(tmp_path):
+    path = str(tmp_path / 'state' / 'cooldown.json')
+    cooldown = AlertCooldown(cooldown=600, path=path)
+    cooldown.add('001', T0)
+    cooldown.add('002', T0 + 300)
+    cooldown.save()
+    assert os.listdir(tmp_path / 'state') == ['cooldown.json']
+
+    # after the restart 001 has expired by the time of the latest alert
+    restarted = AlertCooldown(cooldown=300, path=path)
+    assert len(restarted) == 1
+    assert restarted.active('002', T0 + 301)
+
+
+def test_failed_save_keeps_the_previous_state(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cooldown.json')
+    cooldown = AlertCooldown(path=path)
+    cooldown.add('001', T0)
+    cooldown.save()
+
+    def partial_dump(alerted, f):
+        f.write('{"002": ')
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(alert_cooldown.json, 'dump', partial_dump)
+    cooldown.add('002', T0 + 1)
+    cooldown.save()
+    monkeypatch.undo()
+    assert os.listdir(tmp_path) == ['cooldown.json']
+
+    restarted = AlertCooldown(path=path)
+    assert restarted.active('001', T0 + 1)
+    assert not restarted.active('002', T0 + 2)
+
+
+def test_broken_state_file_starts_empty(tmp_path):
+    path = tmp_path / 'cooldown.json'
+    path.write_text('{"001": ')
+    assert len(AlertCooldown(path=str(path))) == 0
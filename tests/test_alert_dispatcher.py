@@ -0,0 +1,50 @@
+from time import time, monotonic
+from alert_dispatcher import AlertDispatcher, StubSnsClient
+
+
+class UnreachableSnsClient(StubSnsClient):
+    def create_topic(self, Name: str) -> dict:
+        raise ConnectionError('SNS is unreachable')
+
+
+class FlakySubscribeSnsClient(StubSnsClient):
+    def __init__(self):
+        """ the first subscribe fails """
+        super(FlakySubscribeSnsClient, self).__init__()
+        self.failures = 1
+
+    def subscribe(self, TopicArn: str, Protocol: str, Endpoint: str) -> dict:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('SNS is unreachable')
+        return super(FlakySubscribeSnsClient, self).subscribe(TopicArn, Protocol, Endpoint)
+
+
+def test_publish_waits_for_the_topic_and_measures_latency():
+    sns_client = StubSnsClient()
+    dispatcher = AlertDispatcher(sns_client, numbers=['+10000000000'])
+    dispatcher.start()
+    assert dispatcher.publish(['Warning!', 'message'], warning_t=time() - 1)
+    assert sns_client.messages == ['Warning!', 'message']
+    assert dispatcher.stats['publishes'] == 2
+    assert dispatcher.report()['alert_latency']['max'] >= 1
+
+
+def test_alerts_are_dropped_once_the_topic_is_late():
+    dispatcher = AlertDispatcher(UnreachableSnsClient(), ready_timeout=0.2)
+    dispatcher.start(retry_interval=60)
+    start = monotonic()
+    assert not dispatcher.publish(['Warning!', 'message'])
+    assert not dispatcher.publish(['Warning!', 'message'])
+    # the second alert does not wait again
+    assert monotonic() - start < 1
+    assert dispatcher.stats['dropped'] == 2
+
+
+def test_failed_subscribe_is_retried_before_alerts_are_published():
+    sns_client = FlakySubscribeSnsClient()
+    dispatcher = AlertDispatcher(sns_client, numbers=['+10000000000'], emails=['a@example.com'])
+    dispatcher.start(retry_interval=0.05)
+    assert dispatcher.publish(['Warning!'])
+    assert sorted(subscription['Endpoint'] for subscription in sns_client.subscriptions) == \
+        ['+10000000000', 'a@example.com']
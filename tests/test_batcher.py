@@ -0,0 +1,93 @@
+import pytest
+from botocore.exceptions import ClientError
+import batcher
+from batcher import KinesisBatcher
+
+
+class FakeKinesis:
+    def __init__(self, clock: list = None):
+        """ PutRecords stand-in, entries whose data is in `failing` fail that many more times """
+        self.clock = clock
+        self.calls = []
+        self.failing = {}
+        self.throttled_calls = 0
+
+    def put_records(self, StreamName: str, Records: list) -> dict:
+        self.calls.append(([record['Data'] for record in Records], self.clock[0] if self.clock else None))
+        if self.throttled_calls:
+            self.throttled_calls -= 1
+            raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'PutRecords')
+        results = []
+        for record in Records:
+            if self.failing.get(record['Data']):
+                self.failing[record['Data']] -= 1
+                results.append({'ErrorCode': 'ProvisionedThroughputExceededException'})
+            else:
+                results.append({'SequenceNumber': '1', 'ShardId': 'shardId-000000000000'})
+        return {'FailedRecordCount': sum('ErrorCode' in result for result in results), 'Records': results}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(batcher, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(batcher, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+    return clock
+
+
+def test_only_failed_entries_are_sent_again(clock):
+    kinesis = FakeKinesis()
+    kinesis.failing = {b'b': 1, b'd': 2}
+    records = KinesisBatcher(kinesis, 'InputReadings')
+    records.add_many([b'a', b'b', b'c', b'd'], ['1', '2', '3', '4'])
+    records.flush()
+
+    assert [data for data, _ in kinesis.calls] == [[b'a', b'b', b'c', b'd'], [b'b', b'd'], [b'd']]
+    assert records.stats['retries'] == 2
+    assert records.stats['dropped'] == 0
+
+
+def test_throttled_call_is_sent_again_then_given_up(clock):
+    kinesis = FakeKinesis()
+    kinesis.throttled_calls = 1
+    kinesis.failing = {b'b': 10}
+    records = KinesisBatcher(kinesis, 'InputReadings', max_retries=2)
+    records.add_many([b'a', b'b'], ['1', '2'])
+    records.flush()
+
+    assert [data for data, _ in kinesis.calls] == [[b'a', b'b'], [b'a', b'b'], [b'b']]
+    assert records.stats['dropped'] == 1
+
+
+def test_batches_split_at_500_records_and_5_mb(clock):
+    kinesis = FakeKinesis()
+    records = KinesisBatcher(kinesis, 'InputReadings')
+    records.add_many([b'x'] * 1200, ['1'] * 1200)
+    records.flush()
+    assert [len(data) for data, _ in kinesis.calls] == [500, 500, 200]
+
+    kinesis.calls = []
+    # 5 records of 1 MB fit into the 5 MiB of a call
+    records.add_many([b'x' * 1000000] * 6, ['1'] * 6)
+    records.flush()
+    assert [len(data) for data, _ in kinesis.calls] == [5, 1]
+
+    # above the 1 MiB of a record
+    records.add(b'x' * (1024 * 1024), '1')
+    assert records.stats['dropped'] == 1
+    assert len(records) == 0
+
+
+def test_partial_batch_is_sent_after_linger_time(clock):
+    kinesis = FakeKinesis(clock)
+    records = KinesisBatcher(kinesis, 'InputReadings', linger_time=0.5)
+    records.add(b'a', '1')
+    clock[0] += 0.3
+    records.add(b'b', '2')
+    assert kinesis.calls == []
+
+    # the next records are 1 second away, the batch does not wait for them
+    records.wait(1.0)
+    assert [data for data, _ in kinesis.calls] == [[b'a', b'b']]
+    assert kinesis.calls[0][1] == pytest.approx(100.5)
+    assert clock[0] == pytest.approx(101.3)
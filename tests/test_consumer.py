@@ -0,0 +1,101 @@
+import csv
+import io
+import pytest
+from record_codec import encode_interval
+import consumer
+from consumer import StreamConsumer, StreamFactory, InputPickStream, OutputWarningStream, SHARD_READS_PER_SECOND
+from synthetic import p_wave_sites
+
+
+def shard(shard_id: str, parent: str = None, adjacent_parent: str = None, closed: bool = False) -> dict:
+    """ a shard as listed by ListShards """
+    listed = {'ShardId': shard_id, 'SequenceNumberRange': {'StartingSequenceNumber': '0'}}
+    if parent:
+        listed['ParentShardId'] = parent
+    if adjacent_parent:
+        listed['AdjacentParentShardId'] = adjacent_parent
+    if closed:
+        listed['SequenceNumberRange']['EndingSequenceNumber'] = '100'
+    return listed
+
+
+def test_first_start_reads_open_shards_from_latest():
+    shards = [shard('0', closed=True), shard('1', parent='0'), shard('2', parent='0')]
+    assert StreamConsumer.start_positions(shards, {}) == (['1', '2'], {'0'})
+
+
+def test_shard_without_checkpoint_or_parent_is_read_from_latest():
+    # shard 1 had no records during the last run
+    shards = [shard('0'), shard('1')]
+    assert StreamConsumer.start_positions(shards, {'0': '42'}) == (['0', '1'], set())
+
+
+def test_children_of_checkpointed_shards_wait_for_trim_horizon():
+    # 0 was split into 1 and 2 while the consumer was down, 2 was merged with 3 into 4
+    shards = [shard('0', closed=True), shard('1', parent='0'), shard('2', parent='0', closed=True),
+              shard('3', closed=True), shard('4', parent='2', adjacent_parent='3'), shard('5')]
+    open_shards, finished_shards = StreamConsumer.start_positions(shards, {'0': '42'})
+    assert open_shards == ['0', '5']
+    assert finished_shards == {'3'}
+
+
+def test_children_of_expired_parents_are_read_from_latest():
+    shards = [shard('1', parent='0'), shard('2', parent='0')]
+    assert StreamConsumer.start_positions(shards, {'1': '42'}) == (['1', '2'], set())
+
+
+@pytest.mark.parametrize('detector', ['p_wave', 'sta_lta'])
+def test_picks_have_the_columns_of_the_picks_table(detector):
+    readings_df, onsets = p_wave_sites()
+    payloads, _, _ = encode_interval(readings_df, readings_per_record=32)
+    stream = InputPickStream('InputReadings', detector=detector)
+
+    picks = stream.decode_records([{'Data': data} for data in payloads])
+    assert sorted(pick['DEVICE_ID'] for pick in picks) == sorted(onsets)
+    for pick in picks:
+        assert list(pick) == ['DEVICE_ID', 'WARNING_ACCELERATION', 'WARNING_TIME', 'TRIGGER_TIME']
+        assert pick['WARNING_TIME'] <= pick['TRIGGER_TIME']
+
+
+@pytest.mark.parametrize('alert_source', ['warnings', 'picks'])
+def test_only_the_alert_source_raises_alerts(monkeypatch, alert_source):
+    monkeypatch.setattr(consumer, 'input_stream', lambda: 'InputReadings')
+    monkeypatch.setattr(consumer, 'output_streams', lambda: ('OutputAccelerations', 'OutputWarnings'))
+    streams = {name: StreamFactory.produce_stream(name, alert_source=alert_source)
+               for name in ('InputReadings', 'OutputAccelerations', 'OutputWarnings')}
+
+    alerting = [name for name, stream in streams.items() if stream.raises_alerts]
+    assert alerting == ['InputReadings' if alert_source == 'picks' else 'OutputWarnings']
+    # Kinesis Analytics reads the input stream too
+    assert streams['InputReadings'].shard_reads_per_second < SHARD_READS_PER_SECOND
+    assert streams['OutputWarnings'].shard_reads_per_second == SHARD_READS_PER_SECOND
+
+    with pytest.raises(ValueError):
+        StreamFactory.produce_stream('OutputWarnings', alert_source='both')
+
+
+class FakeCopyCursor:
+    def __init__(self):
+        """ keeps the statements and the text sent with COPY FROM STDIN """
+        self.statements = []
+        self.copied = None
+
+    def execute(self, sql: str):
+        self.statements.append(sql)
+
+    def copy_expert(self, sql: str, buffer: io.StringIO):
+        self.statements.append(sql)
+        self.copied = buffer.read()
+
+
+def test_copied_values_keep_separators_line_breaks_and_nulls():
+    rows = [{'DEVICE_ID': '0\t1', 'WARNING_ACCELERATION': 0.25, 'WARNING_TIME': '2020-01-05 04:39:00.000'},
+            {'DEVICE_ID': 'a,\\"\r\nb', 'WARNING_ACCELERATION': None, 'WARNING_TIME': '2020-01-05 04:39:01.000'}]
+    cur = FakeCopyCursor()
+    OutputWarningStream('OutputWarnings').copy_rows(cur, rows)
+
+    assert 'WITH (FORMAT csv)' in cur.statements[2]
+    copied = list(csv.reader(io.StringIO(cur.copied)))
+    assert copied == [['0\t1', '0.25', '2020-01-05 04:39:00.000'], ['a,\\"\r\nb', '', '2020-01-05 04:39:01.000']]
+    # NULL is the unquoted empty value
+    assert cur.copied.splitlines()[-1].endswith(',,2020-01-05 04:39:01.000')
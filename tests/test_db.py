@@ -0,0 +1,100 @@
+import threading
+from contextlib import contextmanager
+import psycopg2
+import pytest
+import db
+from db import TransactionBatcher
+from pipeline import Batch
+
+
+class FakeConnections:
+    def __init__(self):
+        """ ConnectionManager stand-in, the next `failures` transactions fail """
+        self.failures = 0
+
+    @contextmanager
+    def connection(self, autocommit: bool = False):
+        if self.failures:
+            self.failures -= 1
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        yield self
+
+    @contextmanager
+    def cursor(self):
+        yield None
+
+
+@pytest.fixture
+def batcher(monkeypatch):
+    monkeypatch.setattr(db, 'sleep', lambda seconds: None)
+    connections = FakeConnections()
+    saved, checkpoints, rereads = [], [], []
+    batcher = TransactionBatcher(connections,
+                                 lambda cur, rows: saved.extend(rows),
+                                 max_rows=2,
+                                 max_attempts=2,
+                                 checkpoint=lambda cur, positions: checkpoints.append(dict(positions)),
+                                 reread=rereads.append)
+    return batcher, connections, saved, checkpoints, rereads
+
+
+def test_rows_and_read_positions_commit_together(batcher):
+    batcher, connections, saved, checkpoints, _ = batcher
+    batcher.add(Batch([1], 'shard-a', '10'))
+    batcher.add(Batch([2], 'shard-b', '20'))
+    assert saved == [1, 2]
+    assert checkpoints == [{'shard-a': '10', 'shard-b': '20'}]
+
+
+def test_shards_of_dropped_rows_are_not_checkpointed_until_read_again(batcher):
+    batcher, connections, saved, checkpoints, rereads = batcher
+    connections.failures = 2
+    batcher.add(Batch([1], 'shard-a', '10'))
+    batcher.add(Batch([2], 'shard-b', '20'))
+    assert batcher.stats['dropped'] == 2
+    assert rereads == [{'shard-a': None, 'shard-b': None}]
+
+    batcher.add(Batch([3], 'shard-a', '11'))
+    batcher.add(Batch([4], 'shard-c', '30'))
+    assert saved == [3, 4]
+    # the checkpoints of a and b stay before rows 1 and 2
+    assert checkpoints == [{'shard-c': '30'}]
+
+
+def test_rows_held_back_before_ready_are_bounded():
+    ready = threading.Event()
+    saved, checkpoints = [], []
+    batcher = TransactionBatcher(FakeConnections(),
+                                 lambda cur, rows: saved.extend(rows),
+                                 max_rows=2,
+                                 max_pending=3,
+                                 checkpoint=lambda cur, positions: checkpoints.append(dict(positions)),
+                                 ready=ready)
+    for row in range(4):
+        batcher.add(Batch([row], 'shard-a', str(row)))
+    assert batcher.stats['dropped'] == 4
+
+    ready.set()
+    batcher.add(Batch([4], 'shard-a', '4'))
+    batcher.add(Batch([5], 'shard-b', '5'))
+    assert saved == [4, 5]
+    assert checkpoints == [{'shard-b': '5'}]
+
+
+def test_checkpoint_advances_again_once_dropped_rows_are_read_again(batcher):
+    batcher, connections, saved, checkpoints, rereads = batcher
+    batcher.add(Batch([1], 'shard-a', '10'))
+    batcher.add(Batch([2], 'shard-b', '20'))
+    connections.failures = 2
+    batcher.add(Batch([3], 'shard-a', '11'))
+    batcher.add(Batch([4], 'shard-a', '12'))
+    assert rereads == [{'shard-a': '10'}]
+
+    # rows read before the shard was read again, then the first read again that ends before the dropped rows
+    batcher.add(Batch([5], 'shard-a', '13'))
+    batcher.add(Batch([3], 'shard-a', '11', rereads=1))
+    batcher.add(Batch([4, 5], 'shard-a', '13', rereads=1))
+    batcher.add(Batch([6], 'shard-a', '14', rereads=1))
+    batcher.add(Batch([7], 'shard-a', '15', rereads=1))
+    assert saved == [1, 2, 5, 3, 4, 5, 6, 7]
+    assert checkpoints == [{'shard-a': '10', 'shard-b': '20'}, {'shard-a': '13'}, {'shard-a': '15'}]
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from detection import DetectionEngine, StaLtaDetector, PWavePicker, create_detector
+from backfill import compute_peaks, to_stream_rows
+from event_associator import warning_timestamp
+from synthetic import synthetic_readings, sites_with_shaking, p_wave_sites, first_picks, first_warnings
+
+T0 = 1578199140.0  # 2020-01-05 04:39:00
+
+
+def test_detection_engine_matches_kinesis_analytics():
+    """ DetectionEngine against rows computed by hand from the Kinesis Analytics SQL """
+    # device_id, sample_t offset, y, z -> acceleration SQRT(y*y + z*z)
+    readings = [('001', 0.0, 0.6, 0.8),      # 1.0
+                ('002', 0.1, 0.0, 0.2),      # 0.2
+                ('001', 0.5, 0.0, 0.3),      # 0.3
+                ('001', 1.25, 0.0, 0.4),     # 0.4
+                ('001', 2.0, 0.3, 0.4),      # 0.5
+                ('001', 2.96875, 0.0, 0.2),  # 0.2, second batch starts at the next reading
+                ('002', 3.0, 0.0, 0.6),      # 0.6
+                ('001', 1.5, 0.0, 9.0),      # late, window of second 1 is closed
+                ('001', 3.5, 0.0, 0.9),      # 0.9
+                ('001', 4.1, 0.0, 0.7),      # 0.7
+                ('001', 5.0, 0.0, 0.6),      # 0.6
+                ('001', 6.0, 0.0, 0.55)]     # 0.55, closed by flush
+    expected_accel = [('001', 2, 1.0, '04:39:00'), ('001', 1, 0.4, '04:39:01'), ('001', 2, 0.5, '04:39:02'),
+                      ('001', 1, 0.9, '04:39:03'), ('001', 1, 0.7, '04:39:04'), ('001', 1, 0.6, '04:39:05'),
+                      ('001', 1, 0.55, '04:39:06'), ('002', 1, 0.2, '04:39:00'), ('002', 1, 0.6, '04:39:03')]
+    # MIN over the current and 3 preceding rows of a device:
+    # 001: 1.0, 0.4, 0.4, 0.4, 0.4, 0.5, 0.55    002: 0.2, 0.2
+    expected_warnings = [('001', 1.0, '04:39:00'), ('001', 0.5, '04:39:05'), ('001', 0.55, '04:39:06')]
+
+    engine = DetectionEngine()
+    accel_rows, warning_rows = [], []
+    for batch in (readings[:6], readings[6:]):
+        device_ids, offsets, y, z = zip(*batch)
+        rows = engine.process(device_ids, T0 + np.array(offsets), np.zeros(len(y)), y, z)
+        accel_rows += rows[0]
+        warning_rows += rows[1]
+    rows = engine.flush()
+    accel_rows += rows[0]
+    warning_rows += rows[1]
+
+    accel = sorted((row['DEVICE_ID'], row['COUNT_ACCEL'], round(row['PEAK_ACCELERATION'], 6),
+                    row['ACCELERATION_TIME']) for row in accel_rows)
+    warnings = sorted((row['DEVICE_ID'], round(row['WARNING_ACCELERATION'], 6), row['WARNING_TIME'])
+                      for row in warning_rows)
+    assert accel == sorted((d, c, p, f'2020-01-05 {t}.000') for d, c, p, t in expected_accel)
+    assert warnings == sorted((d, p, f'2020-01-05 {t}.000') for d, p, t in expected_warnings)
+    assert engine.late_samples == 1
+
+
+def test_backfill_matches_detection_engine():
+    readings_df = synthetic_readings(devices=10, seconds=200)
+    # without gravity, and strong shaking on every device for 5 seconds, so there are warnings to compare
+    readings_df['z'] += 1
+    shaking = readings_df['sample_t'] - readings_df['sample_t'].min()
+    readings_df.loc[(shaking >= 100) & (shaking < 105), 'y'] = 0.8
+
+    accel_rows, warning_rows = to_stream_rows(*compute_peaks(readings_df))
+
+    engine = DetectionEngine()
+    expected = engine.process(readings_df['device_id'].values, readings_df['sample_t'].values,
+                              readings_df['x'].values, readings_df['y'].values, readings_df['z'].values)
+    flushed = engine.flush()
+
+    def rounded(rows: list) -> list:
+        return sorted(tuple(round(value, 9) if isinstance(value, float) else value for value in row.values())
+                      for row in rows)
+
+    assert warning_rows
+    assert rounded(accel_rows) == rounded(expected[0] + flushed[0])
+    assert rounded(warning_rows) == rounded(expected[1] + flushed[1])
+
+
+def test_sta_lta_triggers_shaking_sites_only():
+    """ every shaking site triggers within half a second of its onset, sites without shaking never do,
+        whether quiet or noisy
+    """
+    onset = 40.0
+    readings_df, shaking_ids = sites_with_shaking(onset=onset, start_t=T0)
+    triggered = first_warnings(StaLtaDetector(peaks=False), readings_df)
+
+    assert sorted(triggered) == shaking_ids
+    assert all(time >= T0 + onset for time, _ in triggered.values())
+    assert max(emitted - T0 - onset for _, emitted in triggered.values()) < 0.5
+
+
+@pytest.mark.parametrize('readings_per_record', [32, 8])
+def test_picker_picks_every_onset(readings_per_record):
+    """ onsets between samples are picked within 0.15 s, before the trigger, on quiet and noisy sites """
+    readings_df, onsets = p_wave_sites()
+    picks, _ = first_picks(readings_df, readings_per_record)
+
+    assert sorted(picks) == sorted(onsets)
+    for device_id, (pick_t, trigger_t, _) in picks.items():
+        assert abs(pick_t - onsets[device_id]) < 0.15
+        assert pick_t <= trigger_t
+
+
+def test_create_detector_by_name():
+    assert isinstance(create_detector('p_wave', aic_window=1.0), PWavePicker)
+    with pytest.raises(ValueError):
+        create_detector('aic')
+
+
+def test_warning_timestamp_keeps_milliseconds():
+    assert warning_timestamp('2020-01-05 04:39:00.250') == T0 + 0.25
+    assert warning_timestamp('2020-01-05 04:39:00') == T0
@@ -0,0 +1,61 @@
+import json
+from device_registry import DeviceRegistry
+from event_associator import EventAssociator
+
+# 002 and 003 are 11 and 22 km north of 001, 101 is 111 km north
+DEVICES = [{'device_id': '001', 'latitude': 19.43, 'longitude': -99.13},
+           {'device_id': '002', 'latitude': 19.53, 'longitude': -99.13},
+           {'device_id': '003', 'latitude': 19.63, 'longitude': -99.13},
+           {'device_id': '101', 'latitude': 20.43, 'longitude': -99.13}]
+
+
+def associator(tmp_path, min_stations: int) -> EventAssociator:
+    devices_file = tmp_path / 'devices.json'
+    devices_file.write_text(json.dumps(DEVICES))
+    devices = DeviceRegistry(devices_file=str(devices_file))
+    devices.load()
+    return EventAssociator(devices, min_stations=min_stations, radius_km=50.0, window=10.0)
+
+
+def warning(device_id: str, second: int) -> dict:
+    return {'DEVICE_ID': device_id, 'WARNING_ACCELERATION': 0.5, 'WARNING_TIME': f'2020-01-05 04:39:{second:02d}.000'}
+
+
+def test_event_is_published_once_min_stations_agree(tmp_path):
+    events = associator(tmp_path, min_stations=3)
+    assert events.add([warning('001', 0), warning('002', 1)]) == []
+
+    published = events.add([warning('003', 2)])
+    assert len(published) == 1
+    assert sorted(published[0].warnings) == ['001', '002', '003']
+    assert published[0].first_warning['DEVICE_ID'] == '001'
+    # later warnings of the same devices do not publish it again
+    assert events.add([warning('001', 3), warning('003', 4)]) == []
+    assert events.stats['published'] == 1
+
+
+def test_warnings_further_apart_than_the_window_are_not_associated(tmp_path):
+    events = associator(tmp_path, min_stations=2)
+    assert events.add([warning('001', 0), warning('002', 11)]) == []
+    assert events.stats['events'] == 0
+
+    assert len(events.add([warning('003', 12)])) == 1
+
+
+def test_devices_beyond_the_radius_are_not_associated(tmp_path):
+    events = associator(tmp_path, min_stations=2)
+    assert events.add([warning('001', 0), warning('101', 1)]) == []
+
+    published = events.add([warning('002', 2)])
+    assert sorted(published[0].warnings) == ['001', '002']
+
+
+def test_pending_warnings_expire_after_the_window(tmp_path):
+    events = associator(tmp_path, min_stations=2)
+    events.add([warning('001', 0)])
+    # a warning far away moves the warning clock past the window of 001
+    events.add([warning('101', 20)])
+
+    # 002 arrives late, 1 second after 001, which is not pending anymore
+    assert events.add([warning('002', 1)]) == []
+    assert events.stats['events'] == 0
@@ -0,0 +1,58 @@
+import re
+import urllib.request
+import pytest
+import metrics
+
+# sample line of the Prometheus text format: name{label="value",...} value
+SAMPLE_LINE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="([^"\\]|\\.)*",?)*\})? '
+                         r'(-?[0-9.e+-]+|\+Inf|-Inf|NaN)$')
+
+
+def check_exposition(text: str):
+    """ every line is a comment or a sample, histogram buckets are cumulative and end with _count """
+    buckets = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        assert SAMPLE_LINE.match(line), line
+        name_labels, value = line.rsplit(' ', 1)
+        if '_bucket{' in name_labels:
+            series = re.sub(r',?le="[^"]*"', '', name_labels.replace('_bucket', ''))
+            assert float(value) >= buckets.get(series, 0), line
+            buckets[series] = float(value)
+        elif name_labels.split('{')[0].endswith('_count') and name_labels.replace('_count', '') in buckets:
+            assert float(value) == buckets[name_labels.replace('_count', '')], line
+
+
+def test_exposition_format():
+    metrics.counter('eew_test_updates', 'Test counter', ['stream']).labels('a "quoted"\nstream').inc(3)
+    metrics.gauge('eew_test_value', 'Test gauge with a \\ backslash').set(-1.5)
+    histogram = metrics.histogram('eew_test_seconds', 'Test histogram', ['stream'], buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.labels('a').observe(value)
+
+    text = metrics.REGISTRY.expose()
+    check_exposition(text)
+    assert 'eew_test_updates_total{stream="a \\"quoted\\"\\nstream"} 3.0' in text
+    assert '# HELP eew_test_value Test gauge with a \\\\ backslash' in text
+    assert 'eew_test_seconds_bucket{stream="a",le="0.1"} 1' in text
+    assert 'eew_test_seconds_bucket{stream="a",le="+Inf"} 3' in text
+    assert 'eew_test_seconds_count{stream="a"} 3' in text
+
+
+def test_same_name_is_shared_and_type_is_checked():
+    assert metrics.counter('eew_test_shared', 'Shared') is metrics.counter('eew_test_shared', 'Shared')
+    with pytest.raises(ValueError):
+        metrics.gauge('eew_test_shared', 'Shared')
+
+
+def test_http_endpoint():
+    server = metrics.start_http_server(0, '127.0.0.1')
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            content_type = response.headers['Content-Type']
+            text = response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+    assert content_type.startswith('text/plain; version=0.0.4')
+    check_exposition(text)
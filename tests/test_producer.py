@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import producer
+from producer import ReplayScheduler
+
+T0 = 1578199140.0  # 2020-01-05 04:39:00
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(producer, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(producer, 'time', lambda: T0 + 60 + clock[0])
+    return clock
+
+
+def sleep(clock: list):
+    return lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+
+
+def seconds_of_readings(start_t: float, seconds: int) -> np.ndarray:
+    return start_t + np.arange(seconds * 32) / 32
+
+
+def test_slices_keep_the_timeline_of_the_first_reading(clock):
+    scheduler = ReplayScheduler(speed=1.0, slice_duration=0.25)
+    released = []
+    for start, stop in scheduler.slices(seconds_of_readings(T0, 2), wait=sleep(clock)):
+        released.append(clock[0])
+        assert stop - start == 8
+        clock[0] += 0.1  # sending the slice
+    assert released == pytest.approx([100.25 + 0.25 * i for i in range(8)])
+    assert scheduler.clock_offset == pytest.approx(160.0)
+
+    # reading the next interval took a while, its slices are still due on the first timeline
+    clock[0] += 0.1
+    released = [clock[0] for _ in scheduler.slices(seconds_of_readings(T0 + 2, 1), wait=sleep(clock))]
+    assert released == pytest.approx([102.25, 102.5, 102.75, 103.0])
+    assert scheduler.max_lag == 0.0
+
+
+def test_slices_after_a_slow_slice_catch_up_and_report_the_lag(clock):
+    scheduler = ReplayScheduler(speed=1.0, slice_duration=0.25)
+    released = []
+    lags = []
+    for number, _ in enumerate(scheduler.slices(seconds_of_readings(T0, 2), wait=sleep(clock))):
+        released.append(clock[0])
+        lags.append(scheduler.lag)
+        clock[0] += 0.6 if number == 1 else 0.01
+
+    # slices 2 and 3 are sent right away until the replay is back on schedule
+    assert released == pytest.approx([100.25, 100.5, 101.1, 101.11, 101.25, 101.5, 101.75, 102.0])
+    assert lags == pytest.approx([0.0, 0.0, 0.35, 0.11, 0.0, 0.0, 0.0, 0.0])
+    assert scheduler.max_lag == pytest.approx(0.35)
+
+
+def test_speed_shortens_the_timeline(clock):
+    scheduler = ReplayScheduler(speed=10.0, slice_duration=0.25)
+    released = [clock[0] for _ in scheduler.slices(seconds_of_readings(T0, 1), wait=sleep(clock))]
+    assert released == pytest.approx([100.025, 100.05, 100.075, 100.1])
+
+    # as fast as possible never waits
+    scheduler = ReplayScheduler(speed=0)
+    assert len(list(scheduler.slices(seconds_of_readings(T0, 1), wait=None))) == 4
+    assert clock[0] == pytest.approx(100.1)
@@ -0,0 +1,34 @@
+import rate_limiter
+from rate_limiter import AdaptivePoller, TokenBucket
+
+
+def test_poller_backs_off_up_to_max_interval_and_catches_up():
+    poller = AdaptivePoller(records_limit=100, max_interval=0.2)
+    intervals = [poller.update(0, 0) for _ in range(10)]
+    assert intervals[:3] == [0.05, 0.1, 0.2]
+    assert max(intervals) == 0.2
+    assert poller.update(100, 0) == 0.0
+    assert poller.update(0, 5000) == 0.0
+
+
+def test_token_bucket_allows_a_burst_then_waits():
+    tokens = TokenBucket(rate=100, capacity=2)
+    assert tokens.acquire() == 0.0
+    assert tokens.acquire() == 0.0
+    assert tokens.acquire() > 0.0
+
+
+def test_token_bucket_of_1_stays_under_the_rate_in_every_second(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(rate_limiter, 'monotonic', lambda: clock[0])
+    # a sleep never ends early
+    monkeypatch.setattr(rate_limiter, 'sleep', lambda seconds: clock.__setitem__(0, clock[0] + seconds + 1e-6))
+    tokens = TokenBucket(rate=5, capacity=1)
+
+    reads = []
+    for _ in range(50):
+        tokens.acquire()
+        reads.append(clock[0])
+        clock[0] += 0.01  # the GetRecords call
+    # reads in the sliding window of 1 second starting at every read
+    assert max(sum(start <= read < start + 1 for read in reads) for start in reads) <= 5
@@ -0,0 +1,90 @@
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import record_cache
+from record_cache import RecordCache
+
+START = datetime(2020, 1, 5, 4, 39, 0)
+T0 = 1578199140.0  # 2020-01-05 04:39:00
+
+
+def readings(device_id: str, start_t: float, seconds: int, frequency: int = 32) -> pd.DataFrame:
+    sample_t = start_t + np.arange(seconds * frequency) / frequency
+    return pd.DataFrame({'device_id': device_id, 'x': 0.1, 'y': 0.2, 'z': 0.3, 'sample_t': sample_t})
+
+
+class FakeS3:
+    def __init__(self, records_df: pd.DataFrame):
+        """ get_filtered_records stand-in, records of 1 second of readings reach the cloud 1 second later """
+        self.records_df = records_df
+        self.calls = []
+
+    def fetch(self, start_date: datetime, end_date: datetime, device_ids: list) -> pd.DataFrame:
+        self.calls.append((start_date, end_date, device_ids))
+        cloud_t = np.floor(self.records_df['sample_t']) + 2
+        found = ((cloud_t >= record_cache._epoch(start_date)) & (cloud_t <= record_cache._epoch(end_date)) &
+                 self.records_df['device_id'].isin(device_ids))
+        return self.records_df[found]
+
+
+def test_windows_of_any_alignment_hit_the_blocks_read_once(tmp_path):
+    s3 = FakeS3(pd.concat([readings('001', T0, 180), readings('002', T0, 180)]))
+    cache = RecordCache(str(tmp_path))
+
+    first = cache.read_records('mx', START + timedelta(seconds=10), START + timedelta(seconds=40), ['001'], s3.fetch)
+    assert len(first) == 30 * 32
+    assert s3.calls == [(START, START + timedelta(seconds=65), ['001'])]
+
+    # a replay with another interval and a backfill window with a lead-in read the same block
+    for start, end in [(0, 60), (15, 45), (59, 60)]:
+        records_df = cache.read_records('mx', START + timedelta(seconds=start), START + timedelta(seconds=end),
+                                        ['001'], s3.fetch)
+        assert len(records_df) == (end - start) * 32
+        assert records_df['sample_t'].min() == T0 + start
+    assert len(s3.calls) == 1
+
+
+def test_missing_blocks_and_devices_are_read_from_s3(tmp_path):
+    s3 = FakeS3(pd.concat([readings('001', T0, 180), readings('002', T0, 180)]))
+    cache = RecordCache(str(tmp_path))
+    cache.read_records('mx', START, START + timedelta(seconds=60), ['001'], s3.fetch)
+
+    # the window reaches into the next block of 001, 002 is not cached at all
+    records_df, missing = cache.get_records('mx', START + timedelta(seconds=30), START + timedelta(seconds=90),
+                                            ['001', '002'])
+    assert records_df is None
+    assert missing == ['001', '002']
+
+    records_df = cache.read_records('mx', START + timedelta(seconds=30), START + timedelta(seconds=90),
+                                    ['001', '002'], s3.fetch)
+    assert s3.calls[-1] == (START, START + timedelta(seconds=125), ['001', '002'])
+    assert records_df.groupby('device_id').size().to_dict() == {'001': 60 * 32, '002': 60 * 32}
+
+    # a block without readings is cached as well
+    assert cache.read_records('mx', START + timedelta(seconds=300), START + timedelta(seconds=330), ['001'],
+                              s3.fetch).empty
+    calls = len(s3.calls)
+    records_df, missing = cache.get_records('mx', START + timedelta(seconds=300), START + timedelta(seconds=330),
+                                            ['001'])
+    assert (records_df, missing) == (None, [])
+    assert len(s3.calls) == calls
+
+
+def test_least_recently_used_blocks_of_all_processes_are_evicted(tmp_path):
+    s3 = FakeS3(pd.concat([readings(device_id, T0, 60) for device_id in ['001', '002', '003']]))
+    other_process = RecordCache(str(tmp_path))
+    other_process.read_records('mx', START, START + timedelta(seconds=60), ['001', '002'], s3.fetch)
+    files = sorted(str(path) for path in tmp_path.rglob('*.npy'))
+    block_size = os.path.getsize(files[0])
+    # 001 was used last
+    os.utime(files[1], (1, 1))
+    os.utime(files[0], (2, 2))
+
+    # room for 2 blocks, this process counts the blocks the other one wrote
+    cache = RecordCache(str(tmp_path), max_bytes=2 * block_size)
+    cache.read_records('mx', START, START + timedelta(seconds=60), ['003'], s3.fetch)
+    assert sorted(path.parent.name for path in tmp_path.rglob('*.npy')) == ['001', '003']
+
+    _, missing = cache.get_records('mx', START, START + timedelta(seconds=60), ['001', '002', '003'])
+    assert missing == ['002']
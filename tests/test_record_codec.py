@@ -0,0 +1,42 @@
+import json
+import numpy as np
+import pytest
+from record_codec import encode_interval, decode_records
+from synthetic import synthetic_readings
+
+
+def test_binary_records_round_trip():
+    readings_df = synthetic_readings(devices=3, seconds=10)
+    payloads, partition_keys, release_t = encode_interval(readings_df, readings_per_record=32)
+
+    assert len(payloads) == 3 * 10
+    assert (np.diff(release_t) >= 0).all()
+    decoded_df = decode_records([{'Data': data} for data in payloads])
+    decoded_df = decoded_df.sort_values(['device_id', 'sample_t'], kind='mergesort').reset_index(drop=True)
+    expected_df = readings_df.sort_values(['device_id', 'sample_t'], kind='mergesort').reset_index(drop=True)
+    assert (decoded_df['device_id'].values == expected_df['device_id'].values).all()
+    # microsecond offsets and float32 readings
+    assert np.abs(decoded_df['sample_t'].values - expected_df['sample_t'].values).max() < 1e-6
+    for column in ('x', 'y', 'z'):
+        assert np.allclose(decoded_df[column].values, expected_df[column].values, atol=1e-6)
+
+
+def test_json_and_binary_records_decode_together():
+    readings_df = synthetic_readings(devices=1, seconds=1)
+    payloads, _, _ = encode_interval(readings_df)
+    reading = {'device_id': '999', 'x': 0.1, 'y': 0.2, 'z': -1.0, 'sample_t': 1578199140.5}
+
+    decoded_df = decode_records([{'Data': payloads[0]}, {'Data': json.dumps(reading)}])
+    assert len(decoded_df) == len(readings_df) + 1
+    assert decoded_df['device_id'].values[-1] == '999'
+
+
+def test_device_ids_longer_than_the_header_field_are_refused():
+    readings_df = synthetic_readings(devices=2, seconds=1)
+    readings_df['device_id'] = np.where(readings_df['device_id'] == '000', '00000', '000001')
+
+    with pytest.raises(ValueError, match='000001'):
+        encode_interval(readings_df)
+    # 5 characters still fit
+    payloads, _, _ = encode_interval(readings_df[readings_df['device_id'] == '00000'])
+    assert set(decode_records([{'Data': data} for data in payloads])['device_id']) == {'00000'}
@@ -0,0 +1,43 @@
+from datetime import date
+from schema import PartitionedTable
+
+
+class FakeCursor:
+    def __init__(self):
+        """ cursor of 1 connection in a transaction, txid_status answers from `statuses` """
+        self.connection = self
+        self.autocommit = False
+        self.statuses = {}
+        self.created = []
+        self._result = None
+
+    def execute(self, sql: str, params: tuple = ()):
+        if sql.startswith('CREATE TABLE'):
+            self.created.append(params[0])
+        elif sql == 'SELECT txid_current()':
+            self._result = (len(self.created),)
+        elif sql.startswith('SELECT txid_status'):
+            self._result = (self.statuses.get(params[0], 'in progress'),)
+
+    def fetchone(self) -> tuple:
+        return self._result
+
+
+def test_partitions_of_rolled_back_transactions_are_created_again():
+    table = PartitionedTable('peak_accel', 'acceleration_time', 'device_id VARCHAR(5) NOT NULL')
+    cur = FakeCursor()
+    day = date(2020, 1, 5)
+
+    table.ensure_partitions(cur, [day])
+    # same transaction, still in progress
+    table.ensure_partitions(cur, [day])
+    assert cur.created == [day]
+
+    cur.statuses[1] = 'aborted'
+    table.ensure_partitions(cur, [day])
+    assert cur.created == [day, day]
+
+    cur.statuses[2] = 'committed'
+    table.ensure_partitions(cur, [day])
+    table.ensure_partitions(cur, [day])
+    assert cur.created == [day, day]